@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import AuthenticationFailed, ParseError
+from rest_framework.parsers import FormParser, JSONParser
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .authentication import VersionedRefreshToken
+from .backends import aauthenticate
+from .models import Patient
+from .nifti import NiftiError
+from .outbox import patient_info_email
+from .ranges import ranged_file_response
+from .passwords import HashingPoolBusy
+from .serializers import PatientSerializer
+from .throttling import LoginEmailRateThrottle, LoginIPRateThrottle
+from .uploads import PartFile, copy_stream, mri_sniffer
+
+logger = logging.getLogger(__name__)
+
+# Async counterparts of the slow, I/O-bound endpoints, for ASGI deployments. Plain Django
+# async views (DRF's APIView is synchronous): the ORM is used through its async API and
+# file I/O runs on the default executor, so a slow client costs a coroutine, not a thread.
+
+
+@sync_to_async
+def authenticate(request):
+    # The same authentication classes as the DRF views, including their per-process user cache.
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            result = authentication_class().authenticate(request)
+        except AuthenticationFailed:
+            return None
+        if result is not None:
+            return result[0]
+    return None
+
+
+def async_api_view(methods):
+    """
+    Authenticate the request and check its method before running an async view.
+    """
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+            user = await authenticate(request)
+            if user is None or not user.is_active:
+                return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+            request.user = user
+            return await view(request, *args, **kwargs)
+        return wrapped
+    return decorator
+
+
+async def get_patient(request, pk):
+    return await (Patient.objects.select_related('volume_metadata')
+                  .filter(pk=pk, physician=request.user).afirst())
+
+
+@sync_to_async
+def serialize_patient(request, patient):
+    # Expanded fields such as ?expand=processing query the database while serializing.
+    return PatientSerializer(patient, context={'request': request}).data
+
+
+def not_found():
+    return JsonResponse({'error': 'Patient not found'}, status=404)
+
+
+@sync_to_async
+def login_wait(request):
+    # The same throttles as LoginView, counted in the same auth cache; None when allowed.
+    for throttle in (LoginIPRateThrottle(), LoginEmailRateThrottle()):
+        if not throttle.allow_request(request, None):
+            return throttle.wait()
+    return None
+
+
+@sync_to_async
+def login_tokens(user):
+    refresh = VersionedRefreshToken.for_user(user)
+    return {'refresh': str(refresh), 'access': str(refresh.access_token), 'message': 'Login Successful'}
+
+
+def too_many_attempts(wait):
+    response = JsonResponse({'detail': 'Request was throttled.'}, status=429)
+    if wait:
+        response['Retry-After'] = str(int(wait))
+    return response
+
+
+@csrf_exempt
+async def login(request):
+    """
+    LoginView for ASGI: the password hash is awaited on the hashing pool, so a login
+    costs a coroutine rather than a thread blocked on the pool.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    request = Request(request, parsers=[JSONParser(), FormParser()])
+    try:
+        data = await sync_to_async(lambda: request.data)()
+    except ParseError:
+        data = None
+    if not hasattr(data, 'get'):
+        return JsonResponse({'error': 'Invalid request body'}, status=400)
+    wait = await login_wait(request)
+    if wait is not None:
+        return too_many_attempts(wait)
+    try:
+        user = await aauthenticate(request, username=data.get('email'), password=data.get('password'))
+    except HashingPoolBusy as e:
+        return too_many_attempts(e.wait)
+    if user is None:
+        return JsonResponse({'message': 'Invalid Credentials'}, status=401)
+    return JsonResponse(await login_tokens(user))
+
+
+@async_api_view(['GET', 'PATCH', 'DELETE'])
+async def patient_detail(request, pk):
+    patient = await get_patient(request, pk)
+    if patient is None:
+        return not_found()
+    if request.method == 'DELETE':
+        await patient.adelete()
+        return HttpResponse(status=204)
+    if request.method == 'PATCH':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        serializer = PatientSerializer(patient, data=data, partial=True, context={'request': request})
+        # Validation runs unique-email queries and save() runs the model signals; both are sync.
+        if not await sync_to_async(serializer.is_valid)():
+            return JsonResponse(serializer.errors, status=400)
+        await sync_to_async(serializer.save)()
+    return JsonResponse(await serialize_patient(request, patient))
+
+
+@async_api_view(['GET', 'PUT'])
+async def patient_mri_file(request, pk):
+    """
+    GET streams the patient's MRI file (Range supported); PUT replaces it with the raw request body.
+    """
+    patient = await get_patient(request, pk)
+    if patient is None:
+        return not_found()
+    if request.method == 'GET':
+        if not patient.mri_file:
+            return JsonResponse({'error': 'Patient has no MRI file'}, status=404)
+        return ranged_file_response(request, patient.mri_file.path, asynchronous=True)
+
+    # The ASGI handler has already received the body; copy it off the event loop.
+    loop = asyncio.get_running_loop()
+    path = os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{uuid.uuid4()}.part")
+    sniffer = mri_sniffer()
+    try:
+        sha256 = await loop.run_in_executor(None, copy_stream, request, path, sniffer)
+        header = sniffer.finish()
+    except NiftiError as e:
+        if os.path.exists(path):
+            os.remove(path)
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        expected = request.headers.get('X-Content-SHA256', '')
+        if expected and expected.lower() != sha256:
+            return JsonResponse({'error': 'File checksum mismatch'}, status=400)
+        filename = os.path.basename(request.GET.get('filename') or 'mri.nii.gz')
+        await sync_to_async(save_mri_file)(patient, filename, path, header)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    logger.info(f"MRI file uploaded for patient {patient.id}")
+    return JsonResponse(await serialize_patient(request, patient))
+
+
+def save_mri_file(patient, filename, path, header):
+    with open(path, 'rb') as f:
+        patient._nifti_header = header
+        patient.mri_file.save(filename, PartFile(f), save=True)
+
+
+@async_api_view(['POST'])
+async def send_patient_info(request, patient_id):
+    patient = await Patient.objects.filter(id=patient_id, physician=request.user).afirst()
+    if patient is None:
+        return not_found()
+    await patient_info_email(request.user, patient).asave()
+    return JsonResponse({"status": "Email queued"}, status=202)
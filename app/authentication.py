@@ -0,0 +1,213 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.utils import timezone
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import RevokedCredential
+
+# JWT claims: the physician's token_version when the token was issued, and the jti of
+# the refresh token it descends from (copied into every access token minted from it).
+VERSION_CLAIM = 'ver'
+SESSION_CLAIM = 'sid'
+
+
+class TTLCache:
+    """
+    Thread-safe LRU of short-lived entries for this process.
+    """
+
+    def __init__(self, max_entries=10000):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+    @property
+    def ttl(self):
+        return settings.AUTH_USER_CACHE_TTL
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, predicate):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = TTLCache()  # (user id, token_version) -> Physician
+token_cache = TTLCache()  # DRF token key -> Token
+
+
+def shared_cache():
+    return caches[settings.AUTH_CACHE_ALIAS]
+
+
+def version_key(user_id):
+    return f"auth:user:{user_id}:version"
+
+
+def revocation_digest(value):
+    return hashlib.sha256(str(value).encode()).hexdigest()
+
+
+def revoked_key(value):
+    return f"auth:revoked:{revocation_digest(value)}"
+
+
+def revoke(value, timeout):
+    """
+    Deny a JWT session id or DRF token key on every process for `timeout` seconds.
+
+    The denylist is the RevokedCredential table; the shared cache only saves the
+    lookup, so a culled or flushed cache entry is re-read rather than forgotten.
+    """
+    timeout = max(int(timeout), 1)
+    now = timezone.now()
+    RevokedCredential.objects.filter(expires_at__lte=now).delete()
+    RevokedCredential.objects.update_or_create(
+        digest=revocation_digest(value), defaults={'expires_at': now + timedelta(seconds=timeout)},
+    )
+    shared_cache().set(revoked_key(value), True, timeout)
+
+
+def is_revoked(value):
+    revoked = RevokedCredential.objects.filter(
+        digest=revocation_digest(value), expires_at__gt=timezone.now(),
+    ).exists()
+    # Either answer is cached for AUTH_USER_CACHE_TTL; add() never overwrites a concurrent revoke().
+    shared_cache().add(revoked_key(value), revoked, settings.AUTH_USER_CACHE_TTL)
+    return revoked
+
+
+def revoke_credentials(auth):
+    """
+    Revoke what a request was authenticated with; returns False if it cannot be revoked.
+    """
+    if isinstance(auth, Token):
+        auth.delete()  # app.signals denies the key to processes that still cache it
+        return True
+    session = auth.get(SESSION_CLAIM) if auth is not None and hasattr(auth, 'get') else None
+    if session is None:
+        return False
+    # The session id is shared by the refresh token and all its access tokens, so deny it
+    # for as long as the refresh token could still be used.
+    revoke(session, api_settings.REFRESH_TOKEN_LIFETIME.total_seconds())
+    return True
+
+
+def publish_user(user):
+    # Called after every Physician save: the new version reaches every process through
+    # the shared cache, and this process drops its stale copies straight away.
+    shared_cache().set(version_key(user.pk), user.token_version, None)
+    user_cache.discard(lambda key: key[0] == user.pk)
+
+
+def forget_user(user_id):
+    shared_cache().delete(version_key(user_id))
+    user_cache.discard(lambda key: key[0] == user_id)
+
+
+def resolve_user(user_id, token_version=None, revocable=None):
+    """
+    Return Physician `user_id` (active or not), or None if it does not exist.
+
+    One shared-cache round trip answers both "is this token revoked" and "what is the
+    user's current token_version"; the user row itself comes from this process's
+    cache while that version is current, so a warm request runs no query. A revocation
+    status missing from the shared cache is read from the RevokedCredential table.
+    """
+    keys = [version_key(user_id)] + ([revoked_key(revocable)] if revocable is not None else [])
+    values = shared_cache().get_many(keys)
+    if revocable is not None:
+        revoked = values.get(revoked_key(revocable))
+        if revoked if revoked is not None else is_revoked(revocable):
+            raise AuthenticationFailed('Token has been revoked.', code='token_revoked')
+
+    version = values.get(version_key(user_id))
+    user = user_cache.get((user_id, version)) if version is not None else None
+    if user is None:
+        user = get_user_model().objects.filter(pk=user_id).first()
+        if user is None:
+            return None
+        version = user.token_version
+        shared_cache().add(version_key(user_id), version, None)
+        user_cache.set((user_id, version), user)
+    if token_version is not None and token_version < version:
+        raise AuthenticationFailed('Token has been revoked.', code='token_revoked')
+    # Middleware and views set attributes on request.user (e.g. otp_device); keep those per request.
+    return copy.copy(user)
+
+
+class VersionedRefreshToken(RefreshToken):
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token[VERSION_CLAIM] = user.token_version
+        token[SESSION_CLAIM] = token[api_settings.JTI_CLAIM]
+        return token
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+        user = resolve_user(
+            user_id,
+            token_version=validated_token.get(VERSION_CLAIM, 0),
+            revocable=validated_token.get(SESSION_CLAIM),
+        )
+        if user is None:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        if not user.is_active:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            try:
+                token = Token.objects.get(key=key)
+            except Token.DoesNotExist:
+                raise AuthenticationFailed('Invalid token.')
+            token_cache.set(key, token)
+        user = resolve_user(token.user_id, revocable=key)
+        if user is None or not user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        return (user, token)
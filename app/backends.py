@@ -1,19 +1,94 @@
-from django.contrib.auth import get_user_model
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_backends, get_user_model
 from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import PermissionDenied
+from rest_framework.request import Request
+
+from .authentication import resolve_user
+from .passwords import HashingPoolBusy, hashing_pool, verify
 
 class EmailAuthenticationBackend(ModelBackend):
+    # Every attempt costs exactly one password hash, run on the bounded hashing pool:
+    # unknown emails and inactive users are checked against a dummy hash, and this is
+    # the only backend that checks passwords (see AUTHENTICATION_BACKENDS).
     def authenticate(self, request, username=None, password=None, **kwargs):
-        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(get_user_model().USERNAME_FIELD)  # simplejwt passes email=
+        if username is None or password is None:
+            return None
+        user = get_user_model().objects.filter(email=username).first()
         try:
-            user = UserModel.objects.get(email=username)
-            if user.check_password(password):
-                return user
-        except UserModel.DoesNotExist:
+            is_correct, must_update = hashing_pool.run(verify, password, user.password if user else None)
+        except HashingPoolBusy as e:
+            self.pool_busy(request, e)
+        if is_correct and must_update:
+            self.upgrade_hash(user, password)
+        return user if is_correct and self.user_can_authenticate(user) else None
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        # Called by app.backends.aauthenticate (async_views.login); awaiting the pool keeps
+        # the hash off the event loop without tying up a thread while it runs.
+        if username is None:
+            username = kwargs.get(get_user_model().USERNAME_FIELD)
+        if username is None or password is None:
             return None
+        user = await get_user_model().objects.filter(email=username).afirst()
+        try:
+            is_correct, must_update = await hashing_pool.arun(verify, password, user.password if user else None)
+        except HashingPoolBusy as e:
+            self.pool_busy(request, e)
+        if is_correct and must_update:
+            await self.aupgrade_hash(user, password)
+        return user if is_correct and self.user_can_authenticate(user) else None
+
+    def pool_busy(self, request, error):
+        # DRF views turn HashingPoolBusy (a Throttled) into a 429. Anywhere else, such as
+        # the admin login, it would be a 500, so the attempt just fails instead.
+        if isinstance(request, Request):
+            raise error
+        raise PermissionDenied
+
+    def upgrade_hash(self, user, password):
+        # Re-hash with the current hasher/iterations; not a password change, so tokens stay valid.
+        try:
+            user.password = hashing_pool.run(make_password, password)
+        except HashingPoolBusy:
+            return  # The next login upgrades it.
+        user._password_rehash = True
+        user.save(update_fields=['password'])
+
+    async def aupgrade_hash(self, user, password):
+        try:
+            user.password = await hashing_pool.arun(make_password, password)
+        except HashingPoolBusy:
+            return
+        user._password_rehash = True
+        await user.asave(update_fields=['password'])
 
     def get_user(self, user_id):
-        UserModel = get_user_model()
+        # Session requests resolve the user through the same per-process cache as token auth.
+        user = resolve_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+
+async def aauthenticate(request, **credentials):
+    """
+    Authenticate against AUTHENTICATION_BACKENDS, awaiting each backend's aauthenticate().
+
+    django.contrib.auth.aauthenticate (Django 5.0) only runs authenticate() in a
+    thread, which then blocks on the hashing pool; backends without an async
+    method still run that way here.
+    """
+    for backend in get_backends():
         try:
-            return UserModel.objects.get(pk=user_id)
-        except UserModel.DoesNotExist:
+            if hasattr(backend, 'aauthenticate'):
+                user = await backend.aauthenticate(request, **credentials)
+            else:
+                user = await sync_to_async(backend.authenticate)(request, **credentials)
+        except PermissionDenied:
             return None
+        if user is not None:
+            user.backend = f"{backend.__module__}.{backend.__class__.__qualname__}"
+            return user
+    return None
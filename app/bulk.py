@@ -0,0 +1,149 @@
+from django.db import IntegrityError, transaction
+
+from .models import Patient
+from .realtime import CREATED, UPDATED, publish_patient_changes
+from .response_cache import bump_versions_on_commit
+from .serializers import BulkPatientSerializer
+
+# Rows per INSERT/UPDATE statement and per transaction; also keeps IN lists well
+# under SQLite's bound-parameter limit.
+CHUNK_SIZE = 500
+MAX_ITEMS = 10000
+
+
+def publish_on_commit(physician, results, status, action):
+    # bulk_create/bulk_update send no post_save, so sockets are told here, in one message.
+    changes = [(result['id'], action) for result in results if result['status'] == status]
+    transaction.on_commit(lambda: publish_patient_changes(physician.pk, changes))
+
+
+def chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def taken_emails(emails, exclude_ids=()):
+    taken = set()
+    for chunk in chunks(list(emails)):
+        taken.update(Patient.objects.filter(email__in=chunk).exclude(id__in=exclude_ids).values_list('email', flat=True))
+    return taken
+
+
+def validate_items(items, partial=False):
+    """
+    Validate every item; returns (results, valid) where valid is a list of (index, data).
+    """
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        serializer = BulkPatientSerializer(data=item, partial=partial)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            results[index] = {'index': index, 'status': 'error', 'errors': serializer.errors}
+    return results, valid
+
+
+def reject_duplicate_emails(results, valid, exclude_ids=()):
+    # One IN query for emails already in the database, plus repeats inside the batch.
+    taken = taken_emails({data['email'] for _, data in valid if 'email' in data}, exclude_ids)
+    seen = set()
+    kept = []
+    for index, data in valid:
+        email = data.get('email')
+        if email is not None and (email in taken or email in seen):
+            results[index] = {'index': index, 'status': 'error',
+                              'errors': {'email': ['patient with this email already exists.']}}
+            continue
+        if email is not None:
+            seen.add(email)
+        kept.append((index, data))
+    return kept
+
+
+def bulk_create_patients(physician, items):
+    # bulk_create/bulk_update send no post_save, so cached responses are invalidated here.
+    bump_versions_on_commit([physician.pk])
+    results, valid = validate_items(items)
+    valid = reject_duplicate_emails(results, valid)
+    for chunk in chunks(valid):
+        patients = [Patient(physician=physician, **{k: v for k, v in data.items() if k != 'id'}) for _, data in chunk]
+        try:
+            with transaction.atomic():
+                Patient.objects.bulk_create(patients)
+        except IntegrityError:
+            # Lost a race with a concurrent writer; fall back to row-by-row for this chunk.
+            for (index, _), patient in zip(chunk, patients):
+                patient.pk = None
+                try:
+                    with transaction.atomic():
+                        patient.save()
+                except IntegrityError as e:
+                    results[index] = {'index': index, 'status': 'error', 'errors': {'non_field_errors': [str(e)]}}
+        for (index, _), patient in zip(chunk, patients):
+            if results[index] is None:
+                results[index] = {'index': index, 'status': 'created', 'id': patient.pk}
+    publish_on_commit(physician, results, 'created', CREATED)
+    return results
+
+
+def bulk_update_patients(physician, items):
+    bump_versions_on_commit([physician.pk])
+    results, valid = validate_items(items, partial=True)
+    for index, data in valid:
+        if 'id' not in data:
+            results[index] = {'index': index, 'status': 'error', 'errors': {'id': ['This field is required.']}}
+    valid = [(index, data) for index, data in valid if results[index] is None]
+
+    ids = [data['id'] for _, data in valid]
+    patients = {}
+    for chunk in chunks(ids):
+        patients.update(Patient.objects.filter(physician=physician, id__in=chunk).in_bulk())
+    for index, data in valid:
+        if data['id'] not in patients:
+            results[index] = {'index': index, 'status': 'error', 'errors': {'id': ['Patient not found.']}}
+    valid = [(index, data) for index, data in valid if results[index] is None]
+    # Rows whose email is being replaced in this batch may hand theirs to another item.
+    valid = reject_duplicate_emails(results, valid, exclude_ids=[data['id'] for _, data in valid if 'email' in data])
+
+    for chunk in chunks(valid):
+        changed, fields = [], set()
+        for _, data in chunk:
+            patient = patients[data['id']]
+            for field, value in data.items():
+                if field != 'id':
+                    setattr(patient, field, value)
+                    fields.add(field)
+            changed.append(patient)
+        try:
+            if fields:
+                with transaction.atomic():
+                    Patient.objects.bulk_update(changed, sorted(fields))
+        except IntegrityError:
+            # e.g. two items swapping emails or a concurrent writer; retry row by row.
+            for (index, data), patient in zip(chunk, changed):
+                try:
+                    with transaction.atomic():
+                        patient.save(update_fields=[field for field in data if field != 'id'])
+                except IntegrityError as e:
+                    results[index] = {'index': index, 'status': 'error', 'errors': {'non_field_errors': [str(e)]}}
+        for index, data in chunk:
+            if results[index] is None:
+                results[index] = {'index': index, 'status': 'updated', 'id': data['id']}
+    publish_on_commit(physician, results, 'updated', UPDATED)
+    return results
+
+
+def bulk_delete_patients(physician, ids):
+    existing = set()
+    for chunk in chunks(ids):
+        with transaction.atomic():
+            found = list(Patient.objects.filter(physician=physician, id__in=chunk).values_list('id', flat=True))
+            # Deleting through the queryset still sends post_delete, which releases MRI blobs.
+            Patient.objects.filter(id__in=found).delete()
+        existing.update(found)
+    return [
+        {'index': index, 'status': 'deleted', 'id': pk} if pk in existing
+        else {'index': index, 'status': 'error', 'id': pk, 'errors': {'id': ['Patient not found.']}}
+        for index, pk in enumerate(ids)
+    ]
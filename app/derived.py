@@ -0,0 +1,34 @@
+import fcntl
+import os
+import tempfile
+
+
+def build_once(path, write):
+    """
+    Create the derived file at `path` with `write(tmp_path)` unless it already exists.
+
+    Artifacts derived from a volume are named by its content hash, so an existing
+    file is always current. The build runs under an flock and the result is
+    renamed into place, so concurrent workers never see a partial file or build
+    the same artifact twice.
+    """
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # One lock file per artifact, never removed: a worker blocked on it must end up
+    # holding the same lock any later caller would take.
+    with open(f"{path}.lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(path):
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                os.close(fd)
+                try:
+                    write(tmp_path)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return path
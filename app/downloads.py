@@ -0,0 +1,83 @@
+import mimetypes
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.http import content_disposition_header, http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from .encryption import is_encrypted
+from .ranges import ranged_file_response
+from .storage import content_hash
+
+
+def file_etag(name, stat):
+    # Content-addressed blobs never change under their name, so the hash is a strong validator.
+    return quote_etag(content_hash(name) or f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+
+def not_modified(request, etag, last_modified):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2).
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etags == ['*'] or etag in etags
+    since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return since is not None and last_modified <= since
+
+
+def range_applies(request, etag, last_modified):
+    # A Range guarded by If-Range is only honoured while the client's copy is current;
+    # otherwise the whole file is sent. Entity tags are compared strongly.
+    if_range = request.headers.get('If-Range', '').strip()
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    if if_range.startswith('W/'):
+        return False
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def offload_response(name, path, content_type):
+    """
+    Hand the file to the front proxy: X-Accel-Redirect (nginx) or X-Sendfile (Apache, lighttpd).
+
+    The proxy sends the bytes itself and handles Range and If-Range against the
+    file; Django only checked access.
+    """
+    response = HttpResponse(content_type=content_type)
+    if settings.FILE_DOWNLOAD_OFFLOAD == 'x-accel':
+        response['X-Accel-Redirect'] = settings.FILE_DOWNLOAD_ACCEL_PREFIX + quote(name)
+    else:
+        response['X-Sendfile'] = os.path.abspath(path)
+    return response
+
+
+def download_response(request, fieldfile, filename=None):
+    """
+    Serve a stored file with conditional GET (ETag, Last-Modified), Range and If-Range.
+
+    Cleartext files are offloaded to the front proxy when FILE_DOWNLOAD_OFFLOAD is
+    set and sent with sendfile() otherwise. Encrypted records always go through
+    Python, since only the application holds the key.
+    """
+    path = fieldfile.path
+    stat = os.stat(path)
+    etag, last_modified = file_etag(fieldfile.name, stat), int(stat.st_mtime)
+    content_type = mimetypes.guess_type(filename or fieldfile.name)[0] or 'application/octet-stream'
+    encrypted = is_encrypted(path)
+
+    if not_modified(request, etag, last_modified):
+        response = HttpResponse(status=304)
+    elif settings.FILE_DOWNLOAD_OFFLOAD and not encrypted:
+        response = offload_response(fieldfile.name, path, content_type)
+    else:
+        response = ranged_file_response(request, path, content_type, decrypt=encrypted,
+                                        use_range=range_applies(request, etag, last_modified))
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    if filename and response.status_code != 304:
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
@@ -0,0 +1,335 @@
+import base64
+import hashlib
+import io
+import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Encrypted files are a header followed by fixed-size AES-256-GCM chunks:
+#
+#   b'NMREC\x02' | key id (8 bytes) | chunk size (u32) | nonce prefix (8 random bytes)
+#   chunk 0 ciphertext + 16-byte tag | chunk 1 ... | last chunk (may be short or empty)
+#
+# Chunk i uses the nonce prefix + i (u32) and authenticates the header plus a flag
+# marking the last chunk, so chunks cannot be reordered, swapped between files or
+# dropped from the end. Any chunk can be located and decrypted on its own. The key
+# id names the key a file was written with, so retired keys (RECORD_ENCRYPTION_OLD_KEYS)
+# still decrypt it after a rotation.
+MAGIC = b'NMREC\x02'
+HEADER = struct.Struct('>8sI8s')
+# The first format had no key id; those files are decrypted by trying each known key.
+LEGACY_MAGIC = b'NMREC\x01'
+LEGACY_HEADER = struct.Struct('>I8s')
+TAG_SIZE = 16
+
+
+class CorruptRecord(Exception):
+    pass
+
+
+def decode_key(value):
+    try:
+        key = base64.b64decode(value, validate=True)
+    except ValueError:
+        key = b''
+    if len(key) != 32:
+        raise ImproperlyConfigured('Record encryption keys must be base64 of 32 bytes')
+    return key
+
+
+def key_id(key):
+    return hashlib.sha256(b'secure-patient-records key id' + key).digest()[:8]
+
+
+@lru_cache(maxsize=4)
+def _keyring(current, old):
+    # {key id: cipher}, current key first.
+    return {key_id(key): AESGCM(key) for key in map(decode_key, (current,) + old)}
+
+
+def keyring():
+    """
+    {key id: AESGCM} for RECORD_ENCRYPTION_KEY followed by RECORD_ENCRYPTION_OLD_KEYS.
+    """
+    if not settings.RECORD_ENCRYPTION_KEY:
+        raise ImproperlyConfigured('RECORD_ENCRYPTION_KEY must be set to store secure patient records')
+    return _keyring(settings.RECORD_ENCRYPTION_KEY, tuple(settings.RECORD_ENCRYPTION_OLD_KEYS))
+
+
+def record_cipher():
+    # (key id, cipher) new files are written with.
+    return next(iter(keyring().items()))
+
+
+@lru_cache(maxsize=4)
+def _legacy_key_cipher(secret_key):
+    # Files in the first format were written with this key when RECORD_ENCRYPTION_KEY was empty.
+    return AESGCM(HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                       info=b'secure-patient-records').derive(secret_key.encode()))
+
+
+def legacy_ciphers():
+    return list(keyring().values()) + [_legacy_key_cipher(settings.SECRET_KEY)]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.RECORD_ENCRYPTION_WORKERS,
+                                           thread_name_prefix='record-crypto')
+    return _executor
+
+
+def window_size():
+    # Chunks in flight at once; this bounds memory to a few chunks per worker.
+    return 2 * settings.RECORD_ENCRYPTION_WORKERS
+
+
+def _nonce(prefix, index):
+    return prefix + struct.pack('>I', index)
+
+
+def _aad(header, last):
+    return header + (b'\x01' if last else b'\x00')
+
+
+def fixed_chunks(blocks, size):
+    """
+    Regroup an iterable of byte blocks into (chunk, is_last) pairs of exactly `size` bytes,
+    except the last; an empty stream gives one empty last chunk.
+    """
+    held = None  # A full chunk waiting to learn whether it is the last one.
+    buffer = bytearray()
+    for block in blocks:
+        if not buffer and len(block) == size:
+            full = [bytes(block)]  # Reads aligned to the chunk size need no copying.
+        else:
+            buffer += block
+            aligned = len(buffer) // size * size
+            with memoryview(buffer) as view:
+                full = [bytes(view[i:i + size]) for i in range(0, aligned, size)]
+            del buffer[:aligned]
+        for chunk in full:
+            if held is not None:
+                yield held, False
+            held = chunk
+    if buffer or held is None:
+        if held is not None:
+            yield held, False
+        yield bytes(buffer), True
+    else:
+        yield held, True
+
+
+def encrypt_stream(blocks, out):
+    """
+    Encrypt plaintext `blocks` into the file object `out`; returns (sha256 of the plaintext, size).
+
+    Chunks are sealed on the thread pool while the next ones are read, with a
+    bounded number in flight, so memory stays constant whatever the file size.
+    """
+    current_id, cipher = record_cipher()
+    prefix = os.urandom(8)
+    header = MAGIC + HEADER.pack(current_id, settings.RECORD_ENCRYPTION_CHUNK_SIZE, prefix)
+    out.write(header)
+
+    def seal(index, chunk, last):
+        return cipher.encrypt(_nonce(prefix, index), chunk, _aad(header, last))
+
+    digest, size = hashlib.sha256(), 0
+    pending = deque()
+    pool = executor()
+    for index, (chunk, last) in enumerate(fixed_chunks(blocks, settings.RECORD_ENCRYPTION_CHUNK_SIZE)):
+        digest.update(chunk)
+        size += len(chunk)
+        pending.append(pool.submit(seal, index, chunk, last))
+        if len(pending) >= window_size():
+            out.write(pending.popleft().result())
+    while pending:
+        out.write(pending.popleft().result())
+    return digest.hexdigest(), size
+
+
+def is_encrypted(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) in (MAGIC, LEGACY_MAGIC)
+
+
+class EncryptedFile(io.RawIOBase):
+    """
+    Read-only, seekable view of the plaintext of an encrypted file.
+
+    Reads decrypt only the chunks they touch; iter_range() decrypts a span of
+    chunks in parallel for streaming responses.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.name = path
+        self._file = open(path, 'rb')
+        try:
+            self._read_header()
+        except BaseException:
+            self._file.close()
+            raise
+        self._position = 0
+        self._cached = (None, b'')
+
+    def _read_header(self):
+        magic = self._file.read(len(MAGIC))
+        layout = {MAGIC: HEADER, LEGACY_MAGIC: LEGACY_HEADER}.get(magic)
+        fields = self._file.read(layout.size) if layout else b''
+        if layout is None or len(fields) != layout.size:
+            raise CorruptRecord(f"{self.name} is not an encrypted record")
+        self._header = magic + fields
+        if magic == MAGIC:
+            self.key_id, self.chunk_size, self._prefix = HEADER.unpack(fields)
+        else:
+            self.key_id = None
+            self.chunk_size, self._prefix = LEGACY_HEADER.unpack(fields)
+        body = os.fstat(self._file.fileno()).st_size - len(self._header)
+        self._chunks = max(-(-body // (self.chunk_size + TAG_SIZE)), 1)
+        self.size = body - self._chunks * TAG_SIZE
+        if self.key_id is not None:
+            self._cipher = keyring().get(self.key_id)
+            if self._cipher is None:
+                raise CorruptRecord(f"{self.name} was encrypted with a key that is not configured")
+        else:
+            self._cipher = self._find_legacy_cipher()
+
+    def _find_legacy_cipher(self):
+        # The key that authenticates the last chunk (the smallest one) is the file's key.
+        sealed = self._read_chunk(self._chunks - 1)
+        for cipher in legacy_ciphers():
+            self._cipher = cipher
+            try:
+                self._open_chunk(self._chunks - 1, sealed)
+            except CorruptRecord:
+                continue
+            return cipher
+        raise CorruptRecord(f"No configured key decrypts {self.name}")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position')
+        self._position = offset
+        return offset
+
+    def _read_chunk(self, index):
+        self._file.seek(len(self._header) + index * (self.chunk_size + TAG_SIZE))
+        return self._file.read(self.chunk_size + TAG_SIZE)
+
+    def _open_chunk(self, index, sealed):
+        try:
+            return self._cipher.decrypt(_nonce(self._prefix, index), sealed,
+                                        _aad(self._header, index == self._chunks - 1))
+        except InvalidTag:
+            raise CorruptRecord(f"Chunk {index} of {self.name} failed authentication")
+
+    def chunk(self, index):
+        if self._cached[0] != index:
+            self._cached = (index, self._open_chunk(index, self._read_chunk(index)))
+        return self._cached[1]
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        index, offset = divmod(self._position, self.chunk_size)
+        data = self.chunk(index)[offset:offset + len(buffer)]
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def iter_range(self, start, end):
+        """
+        Yield the plaintext bytes start..end (inclusive), decrypting only the chunks they span.
+        """
+        end = min(end, self.size - 1)
+        if end < start:
+            return
+        first, last = start // self.chunk_size, end // self.chunk_size
+
+        def plaintext(index, future):
+            base = index * self.chunk_size
+            return future.result()[max(start - base, 0):end - base + 1]
+
+        pending = deque()
+        pool = executor()
+        for index in range(first, last + 1):
+            pending.append((index, pool.submit(self._open_chunk, index, self._read_chunk(index))))
+            if len(pending) >= window_size():
+                yield plaintext(*pending.popleft())
+        while pending:
+            yield plaintext(*pending.popleft())
+
+    def close(self):
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
+        super().close()
+
+
+def plaintext_size(path):
+    with EncryptedFile(path) as f:
+        return f.size
+
+
+def iter_decrypted_range(path, start, end):
+    with EncryptedFile(path) as f:
+        yield from f.iter_range(start, end)
+
+
+def current_key_id():
+    return record_cipher()[0]
+
+
+def file_key_id(path):
+    """
+    Key id in the header of an encrypted file; None for the first format, which has none.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        return HEADER.unpack(f.read(HEADER.size))[0] if magic == MAGIC else None
+
+
+def encrypt_file(path):
+    """
+    Encrypt a file in place with the current key (through a temporary file and an atomic
+    rename): cleartext files, or records written with an older key or format.
+    """
+    tmp_path = f"{path}.{os.getpid()}.enc.tmp"
+    try:
+        with (EncryptedFile(path) if is_encrypted(path) else open(path, 'rb')) as src, open(tmp_path, 'wb') as out:
+            sha256, size = encrypt_stream(iter(lambda: src.read(1024 * 1024), b''), out)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return sha256, size
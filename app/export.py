@@ -0,0 +1,54 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Patient, SecurePatientRecord
+
+CHUNK_SIZE = 2000
+
+PATIENT_COLUMNS = (
+    'id', 'first_name', 'last_name', 'email', 'dob', 'mri_file',
+    'volume_metadata__sha256', 'volume_metadata__tumor_volume_ml', 'volume_metadata__labels',
+)
+RECORD_COLUMNS = ('id', 'record_date', 'description', 'file_path')
+
+
+def patient_rows(physician):
+    return (Patient.objects.filter(physician=physician).order_by('id')
+            .values(*PATIENT_COLUMNS).iterator(chunk_size=CHUNK_SIZE))
+
+
+def record_rows(physician):
+    return (SecurePatientRecord.objects.filter(physician=physician).order_by('id')
+            .values(*RECORD_COLUMNS).iterator(chunk_size=CHUNK_SIZE))
+
+
+def iter_ndjson(physician):
+    """
+    One JSON object per line: every patient, then every record, tagged with its type.
+    """
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    for kind, rows in (('patient', patient_rows(physician)), ('record', record_rows(physician))):
+        for row in rows:
+            yield encoder.encode({'type': kind, **row}) + '\n'
+
+
+class Echo:
+    # File-like object whose write() hands back the line csv.writer produced.
+    def write(self, value):
+        return value
+
+
+def iter_csv(physician, table):
+    if table == 'records':
+        columns, rows = RECORD_COLUMNS, record_rows(physician)
+    else:
+        columns, rows = PATIENT_COLUMNS, patient_rows(physician)
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(
+            json.dumps(row[column]) if isinstance(row[column], (dict, list)) else row[column]
+            for column in columns
+        )
@@ -0,0 +1,194 @@
+import logging
+import os
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .labelmap import NotALabelMap, build_label_map
+from .meshes import build_meshes
+from .models import Job, Patient
+from .pyramid import build_pyramid
+from .response_cache import bump_versions_on_commit
+from .storage import content_hash
+from .volumetrics import update_volume_metadata
+
+logger = logging.getLogger(__name__)
+
+# kind -> (handler(payload), default priority)
+HANDLERS = {}
+
+# A worker that dies mid-job leaves it 'running'; it is claimed again after this.
+JOB_LEASE = timedelta(minutes=30)
+
+
+def handler(kind, priority=0):
+    def register(fn):
+        HANDLERS[kind] = (fn, priority)
+        return fn
+    return register
+
+
+def enqueue(kind, key, payload=None, priority=None):
+    """
+    Queue a job unless the same (kind, key) is already waiting; returns True if one was added.
+
+    Runs in the caller's transaction, so a job only becomes visible to workers when
+    the write that needs it commits.
+    """
+    priority = HANDLERS[kind][1] if priority is None else priority
+    try:
+        with transaction.atomic():
+            Job.objects.create(kind=kind, key=key, payload=payload or {}, priority=priority)
+        return True
+    except IntegrityError:
+        # Already queued: keep the waiting job, at the higher of the two priorities.
+        Job.objects.filter(kind=kind, key=key, status=Job.STATUS_QUEUED).update(priority=Greatest('priority', priority))
+        return False
+
+
+def due_jobs(now):
+    return (Job.objects.filter(Q(status=Job.STATUS_QUEUED, run_after__lte=now) |
+                               Q(status=Job.STATUS_RUNNING, locked_at__lt=now - JOB_LEASE))
+            .order_by('-priority', 'run_after', 'id'))
+
+
+def claim(worker_id):
+    """
+    Take the most urgent due job for `worker_id`, or return None.
+
+    Uses SELECT ... FOR UPDATE SKIP LOCKED where the database has it; on SQLite a
+    conditional UPDATE on the status is the claim, and a worker that loses the race
+    for one row moves on to the next candidate.
+    """
+    now = timezone.now()
+    claimed = {'status': Job.STATUS_RUNNING, 'locked_by': worker_id, 'locked_at': now}
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = due_jobs(now).select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            Job.objects.filter(pk=job.pk).update(**claimed)
+        return Job.objects.get(pk=job.pk)
+    for pk, status, locked_at in due_jobs(now).values_list('pk', 'status', 'locked_at')[:10]:
+        # Matching the row's current status and lock time makes the UPDATE a compare-and-swap.
+        if Job.objects.filter(pk=pk, status=status, locked_at=locked_at).update(**claimed):
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def run(job):
+    fn, _ = HANDLERS[job.kind]
+    job.attempts += 1
+    try:
+        fn(job.payload)
+    except Exception:
+        job.last_error = traceback.format_exc(limit=5)
+        if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+            job.status = Job.STATUS_FAILED
+            job.finished_at = timezone.now()
+        else:
+            job.status = Job.STATUS_QUEUED
+            job.run_after = timezone.now() + timedelta(seconds=settings.JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+        logger.exception(f"Job {job.pk} {job.kind} failed (attempt {job.attempts})")
+    else:
+        job.status = Job.STATUS_DONE
+        job.finished_at = timezone.now()
+        job.last_error = ''
+    try:
+        job.save(update_fields=['status', 'attempts', 'run_after', 'finished_at', 'last_error'])
+    except IntegrityError:
+        # Requeueing collided with a newer queued job for the same (kind, key); that one covers it.
+        Job.objects.filter(pk=job.pk).update(status=Job.STATUS_DONE, finished_at=timezone.now())
+    if job.kind in VOLUME_JOBS:
+        # Cached patient responses carry the processing state (and the metadata); refresh them.
+        bump_versions_on_commit(
+            Patient.objects.filter(mri_file=job.payload['name']).values_list('physician_id', flat=True)
+        )
+
+
+def work(worker_id=None, once=False):
+    """
+    Claim and run jobs until interrupted, or until nothing is due when `once`; returns the count run.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    done = 0
+    while True:
+        job = claim(worker_id)
+        if job is None:
+            if once:
+                return done
+            time.sleep(settings.JOB_POLL_INTERVAL)
+            continue
+        run(job)
+        done += 1
+
+
+def job_statuses(keys):
+    """
+    {key: {kind: status}} of the latest job of each kind for these content hashes.
+    """
+    statuses = {}
+    keys = [key for key in keys if key]
+    if keys:
+        for key, kind, status in Job.objects.filter(key__in=keys).order_by('id').values_list('key', 'kind', 'status'):
+            statuses.setdefault(key, {})[kind] = status
+    return statuses
+
+
+def volume_job_key(name):
+    return content_hash(name) or name
+
+
+def enqueue_volume_jobs(name, header=None):
+    payload = {'name': name}
+    if header is not None:
+        payload['header'] = header
+    for kind in VOLUME_JOBS:
+        enqueue(kind, volume_job_key(name), payload)
+
+
+def stored_volume(payload):
+    # Any patient pointing at the blob gives a FieldFile for it; None once all are gone.
+    patient = Patient.objects.filter(mri_file=payload['name']).first()
+    return patient.mri_file if patient else None
+
+
+@handler('volume.metadata', priority=30)
+def volume_metadata(payload):
+    for patient in Patient.objects.filter(mri_file=payload['name']):
+        update_volume_metadata(patient, payload.get('header'))
+
+
+@handler('volume.pyramid', priority=20)
+def volume_pyramid(payload):
+    fieldfile = stored_volume(payload)
+    if fieldfile:
+        build_pyramid(fieldfile)
+
+
+@handler('volume.labelmap', priority=20)
+def volume_label_map(payload):
+    fieldfile = stored_volume(payload)
+    if fieldfile:
+        try:
+            build_label_map(fieldfile)
+        except NotALabelMap:
+            pass  # Intensity images have no label map to encode.
+
+
+@handler('volume.meshes', priority=10)
+def volume_meshes(payload):
+    fieldfile = stored_volume(payload)
+    if fieldfile:
+        build_meshes(fieldfile)
+
+
+# Jobs queued for every new MRI file; the metadata job updates every patient sharing the blob.
+VOLUME_JOBS = ('volume.metadata', 'volume.pyramid', 'volume.labelmap', 'volume.meshes')
@@ -0,0 +1,103 @@
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+from .derived import build_once
+from .render import first_frame
+from .volume_cache import get_volume, volume_key
+from .volumetrics import label_dtype
+
+# Sparse label-map transfer format: MAGIC, uint32 JSON header length, the JSON
+# header, then one zlib stream holding, for every run of identical non-zero labels
+# along x (Fortran order, never crossing a row):
+#   - the run's flat start index, delta-encoded against the previous run (uint32)
+#   - its length (uint16, or uint32 for rows longer than 65535 voxels)
+#   - its label (the header's label_dtype: uint8, or uint16 for labels past 255)
+# each as a contiguous little-endian array. Everything outside the runs is 0.
+# A 4D series is encoded from its first frame.
+MAGIC = b'NMRLE001'
+
+
+class NotALabelMap(ValueError):
+    pass
+
+
+def labelmap_path(key):
+    return os.path.join(str(settings.LABELMAP_DIR), f"{key}.rle")
+
+
+def encode_runs(volume):
+    """
+    Return (starts, lengths, labels) of the non-zero runs of a 3D label volume.
+
+    Labels keep their values: they come back as uint8, or uint16 past 255. Volumes
+    that are not label maps raise NotALabelMap.
+    """
+    volume = np.asarray(first_frame(volume))
+    dtype = label_dtype(volume)
+    if dtype is None:
+        raise NotALabelMap('The volume is not a label map')
+    flat = volume.reshape(-1, order='F')
+    row = volume.shape[0]
+    nonzero = np.flatnonzero(flat)
+    values = flat[nonzero].astype(dtype)
+    breaks = np.ones(len(nonzero), dtype=bool)
+    breaks[1:] = (np.diff(nonzero) != 1) | (values[1:] != values[:-1]) | (nonzero[1:] % row == 0)
+    first = np.flatnonzero(breaks)
+    lengths = np.diff(np.append(first, len(nonzero)))
+    return nonzero[first], lengths, values[first]
+
+
+def decode_runs(shape, starts, lengths, labels):
+    total = int(lengths.sum())
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    flat = np.zeros(int(np.prod(shape)), dtype=labels.dtype)
+    flat[np.repeat(starts, lengths) + offsets] = np.repeat(labels, lengths)
+    return flat.reshape(shape, order='F')
+
+
+def encode_label_map(volume):
+    starts, lengths, labels = encode_runs(volume)
+    shape = volume.shape[:3]
+    length_dtype = '<u2' if shape[0] <= 0xFFFF else '<u4'
+    header = json.dumps({
+        'shape': list(shape),
+        'order': 'F',
+        'runs': len(starts),
+        'length_dtype': length_dtype,
+        'label_dtype': labels.dtype.str.lstrip('|'),
+    }, separators=(',', ':')).encode()
+    deltas = np.diff(starts, prepend=0).astype('<u4')
+    payload = deltas.tobytes() + lengths.astype(length_dtype).tobytes() + labels.tobytes()
+    return MAGIC + struct.pack('<I', len(header)) + header + zlib.compress(payload, 9)
+
+
+def decode_label_map(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a sparse label map')
+    (length,) = struct.unpack_from('<I', data, len(MAGIC))
+    start = len(MAGIC) + 4
+    header = json.loads(data[start:start + length])
+    payload = zlib.decompress(data[start + length:])
+    runs, length_dtype = header['runs'], np.dtype(header['length_dtype'])
+    value_dtype = np.dtype(header.get('label_dtype', 'u1'))  # Older files are uint8 throughout.
+    deltas = np.frombuffer(payload, dtype='<u4', count=runs)
+    lengths = np.frombuffer(payload, dtype=length_dtype, count=runs, offset=runs * 4)
+    labels = np.frombuffer(payload, dtype=value_dtype, count=runs, offset=runs * (4 + length_dtype.itemsize))
+    starts = np.cumsum(deltas, dtype=np.int64)
+    return decode_runs(tuple(header['shape']), starts, lengths.astype(np.int64), labels)
+
+
+def build_label_map(fieldfile):
+    """
+    Encode and store the sparse label map of a stored volume unless it exists; returns the path.
+    """
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as out:
+            out.write(encode_label_map(get_volume(fieldfile)))
+
+    return build_once(labelmap_path(volume_key(fieldfile)), write)
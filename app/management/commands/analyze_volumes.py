@@ -0,0 +1,120 @@
+import hashlib
+import os
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from app.models import Patient, Physician, VolumeMetadata
+from app.nifti import load_volume
+from app.response_cache import bump_versions_on_commit
+from app.storage import content_hash
+from app.volumetrics import metadata_fields
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def analyze_path(path, known_sha256):
+    """
+    Worker: analyze one volume file; returns None when its content hash is `known_sha256`.
+
+    Runs in a child process, so it only touches the file, never the database.
+    """
+    sha256 = content_hash(path)
+    if sha256 is None:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+    if sha256 == known_sha256:
+        return None
+    with open(path, 'rb') as f:
+        header, volume = load_volume(f)
+    return {'sha256': sha256, **metadata_fields(header, volume)}
+
+
+class Command(BaseCommand):
+    help = 'Compute volumetrics for every patient MRI file across a process pool, skipping unchanged studies.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--physician', help='Only analyze patients of the physician with this email.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes (default: one per core).')
+        parser.add_argument('--batch-size', type=int, default=500, help='Results written per database transaction.')
+        parser.add_argument('--force', action='store_true', help='Re-analyze studies whose content hash is unchanged.')
+
+    def handle(self, *args, **options):
+        patients = Patient.objects.exclude(mri_file='').exclude(mri_file__isnull=True)
+        if options['physician']:
+            try:
+                patients = patients.filter(physician=Physician.objects.get(email=options['physician']))
+            except Physician.DoesNotExist:
+                raise CommandError(f"No physician with email {options['physician']}")
+
+        # Identical files (same blob name) are analyzed once and fanned out to every patient.
+        work = defaultdict(list)
+        known = {}
+        rows = patients.values_list('pk', 'mri_file', 'volume_metadata__sha256')
+        for pk, name, sha256 in rows.iterator(chunk_size=2000):
+            work[name].append(pk)
+            # Only skip a shared file if every patient already has metadata for it.
+            known[name] = None if options['force'] or known.get(name, sha256) != sha256 else sha256
+
+        storage = Patient._meta.get_field('mri_file').storage
+        self.analyzed = self.skipped = self.failed = 0
+        pending_rows = []
+        # Don't hand open database connections to forked workers.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            in_flight = {}
+            names = iter(work)
+            while True:
+                # Keep a bounded number of tasks queued so memory stays flat for large cohorts.
+                while len(in_flight) < options['workers'] * 4:
+                    name = next(names, None)
+                    if name is None:
+                        break
+                    in_flight[executor.submit(analyze_path, storage.path(name), known[name])] = name
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self.failed += len(work[name])
+                        self.stderr.write(f"{name}: {e}")
+                        continue
+                    if result is None:
+                        self.skipped += len(work[name])
+                        continue
+                    pending_rows.extend((pk, result) for pk in work[name])
+                    if len(pending_rows) >= options['batch_size']:
+                        self.write_batch(pending_rows)
+                        pending_rows = []
+        self.write_batch(pending_rows)
+        self.stdout.write(f"Analyzed {self.analyzed}, skipped {self.skipped} unchanged, {self.failed} failed")
+
+    def write_batch(self, rows):
+        if not rows:
+            return
+        results = dict(rows)
+        fields = ['sha256', 'shape', 'spacing', 'dtype', 'affine', 'labels', 'tumor_volume_ml', 'thumbnails']
+        now = timezone.now()
+        with transaction.atomic():
+            existing = list(VolumeMetadata.objects.filter(patient_id__in=results))
+            for metadata in existing:
+                for field, value in results.pop(metadata.patient_id).items():
+                    setattr(metadata, field, value)
+                metadata.computed_at = now
+            VolumeMetadata.objects.bulk_update(existing, fields + ['computed_at'])
+            VolumeMetadata.objects.bulk_create(
+                [VolumeMetadata(patient_id=pk, **result) for pk, result in results.items()]
+            )
+            bump_versions_on_commit(
+                Patient.objects.filter(pk__in=[pk for pk, _ in rows]).values_list('physician_id', flat=True)
+            )
+        self.analyzed += len(rows)
@@ -0,0 +1,40 @@
+import fcntl
+import os
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Remove upload session lock files whose session has been committed or deleted.'
+
+    def handle(self, *args, **options):
+        directory = settings.CHUNKED_UPLOAD_DIR
+        if not os.path.isdir(directory):
+            return
+        locks = {}
+        for name in os.listdir(directory):
+            if name.endswith('.lock'):
+                try:
+                    locks[str(uuid.UUID(name[:-len('.lock')]))] = os.path.join(directory, name)
+                except ValueError:
+                    continue
+        open_ids = {str(pk) for pk in UploadSession.objects.filter(
+            id__in=list(locks), status=UploadSession.STATUS_OPEN).values_list('id', flat=True)}
+        removed = 0
+        for session_id, path in locks.items():
+            if session_id in open_ids:
+                continue
+            # Requests that still hold or wait for the lock only find the session gone or
+            # committed; skip it anyway while one holds it.
+            with open(path, 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                os.remove(path)
+            removed += 1
+        self.stdout.write(f"Removed {removed} upload lock files")
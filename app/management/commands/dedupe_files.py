@@ -0,0 +1,91 @@
+import os
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from app.models import StoredBlob
+from app.response_cache import bump_versions_on_commit
+from app.signals import BLOB_FIELDS
+from app.storage import content_addressed_storage, content_hash
+from app.uploads import PartFile
+
+
+class Command(BaseCommand):
+    help = 'Fold existing MRI and patient record files into deduplicated, content-addressed blobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without touching anything.')
+        parser.add_argument('--prune', action='store_true', help='Also delete blobs that no row refers to.')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        for model, field_name in BLOB_FIELDS.items():
+            field = model._meta.get_field(field_name)
+            self.fold_model(model, field, dry_run)
+            self.fold_orphans(model, field, dry_run)
+        if options['prune']:
+            self.prune(dry_run)
+
+    def fold_model(self, model, field, dry_run):
+        storage = field.storage
+        # Group rows by their legacy name so shared names are moved once.
+        legacy = defaultdict(list)
+        rows = model.objects.exclude(**{field.attname: ''}).exclude(**{f'{field.attname}__isnull': True})
+        for pk, name in rows.values_list('pk', field.attname).iterator(chunk_size=1000):
+            if not content_hash(name):
+                legacy[name].append(pk)
+
+        for name, pks in legacy.items():
+            if not storage.exists(name):
+                self.stderr.write(f"{model.__name__} {pks}: {name} is missing, skipping")
+                continue
+            if dry_run:
+                self.stdout.write(f"Would fold {name} ({len(pks)} {model.__name__} rows)")
+                continue
+            with storage.open(name, 'rb') as f:
+                # Moves the file into place when its content is new.
+                new_name = storage.save(name, PartFile(f))
+            model.objects.filter(pk__in=pks).update(**{field.attname: new_name})
+            bump_versions_on_commit(model.objects.filter(pk__in=pks).values_list('physician_id', flat=True))
+            # save() took the reference for the first row.
+            for _ in pks[1:]:
+                storage.acquire(new_name)
+            if storage.exists(name):
+                storage.delete(name)
+            self.stdout.write(f"Folded {name} -> {new_name}")
+
+    def fold_orphans(self, model, field, dry_run):
+        # Unreferenced copies left behind in the upload_to directory.
+        storage = field.storage
+        directory = field.upload_to.rstrip('/')
+        if not storage.exists(directory):
+            return
+        referenced = set(model.objects.values_list(field.attname, flat=True))
+        _, files = storage.listdir(directory)
+        for filename in files:
+            name = f"{directory}/{filename}"
+            if name in referenced:
+                continue
+            sha256, _ = storage._hash_file(storage.path(name))
+            duplicate = StoredBlob.objects.filter(sha256=sha256, name__startswith=f"{directory}/").first()
+            if duplicate is None:
+                self.stdout.write(f"Unreferenced file {name} has no blob copy, leaving it")
+            elif dry_run:
+                self.stdout.write(f"Would delete {name} (duplicate of {duplicate.name})")
+            else:
+                os.remove(storage.path(name))
+                self.stdout.write(f"Deleted {name} (duplicate of {duplicate.name})")
+
+    def prune(self, dry_run):
+        referenced = set()
+        for model, field_name in BLOB_FIELDS.items():
+            referenced.update(model.objects.values_list(field_name, flat=True))
+        for blob in StoredBlob.objects.filter(ref_count=0).iterator():
+            if blob.name in referenced:
+                self.stderr.write(f"{blob.name} has no counted references but rows still point at it, leaving it")
+                continue
+            if dry_run:
+                self.stdout.write(f"Would prune {blob.name}")
+                continue
+            content_addressed_storage.delete(blob.name)
+            self.stdout.write(f"Pruned {blob.name}")
@@ -0,0 +1,37 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from app.encryption import current_key_id, encrypt_file, file_key_id, is_encrypted
+from app.models import SecurePatientRecord
+
+
+class Command(BaseCommand):
+    help = ('Encrypt patient record files that were stored in cleartext before encryption at rest was enabled; '
+            'with --rotate, also re-encrypt records written with a key other than RECORD_ENCRYPTION_KEY.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without touching anything.')
+        parser.add_argument('--rotate', action='store_true',
+                            help='Re-encrypt records under old keys, so those can be dropped from RECORD_ENCRYPTION_OLD_KEYS.')
+
+    def handle(self, *args, **options):
+        storage = SecurePatientRecord._meta.get_field('file_path').storage
+        names = (SecurePatientRecord.objects.exclude(file_path='')
+                 .values_list('file_path', flat=True).distinct().iterator(chunk_size=1000))
+        encrypted = 0
+        current = current_key_id()
+        for name in names:
+            path = storage.path(name)
+            if not os.path.exists(path):
+                self.stderr.write(f"{name} is missing, skipping")
+                continue
+            if is_encrypted(path) and (not options['rotate'] or file_key_id(path) == current):
+                continue
+            if options['dry_run']:
+                self.stdout.write(f"Would encrypt {name}")
+                continue
+            # Blob names come from the plaintext hash, so they stay valid once encrypted.
+            encrypt_file(path)
+            encrypted += 1
+        self.stdout.write(f"Encrypted {encrypted} record files")
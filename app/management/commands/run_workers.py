@@ -0,0 +1,46 @@
+import multiprocessing
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.jobs import work
+
+
+def worker_main(worker_id, once):
+    work(worker_id, once=once)
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs (derived imaging data and other post-upload work) across worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=os.cpu_count(), help='Worker processes (default: one per core).')
+        parser.add_argument('--once', action='store_true', help='Exit once no job is due instead of polling.')
+
+    def handle(self, *args, **options):
+        concurrency = max(options['concurrency'], 1)
+        if concurrency == 1:
+            # Run in this process, e.g. for development or a container per worker.
+            done = work(once=options['once'])
+            self.stdout.write(f"Ran {done} jobs")
+            return
+
+        # Don't hand open database connections to forked workers.
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=worker_main, args=(f"{os.uname().nodename}:{os.getpid()}:{i}", options['once']))
+            for i in range(concurrency)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
+        self.stdout.write(f"{concurrency} workers stopped")
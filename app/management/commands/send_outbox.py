@@ -0,0 +1,40 @@
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from app.outbox import claim_batch, deliver_batch
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued outbound email in batches over one persistent SMTP connection, retrying with backoff.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE, help='Messages claimed per batch.')
+        parser.add_argument('--once', action='store_true', help='Exit once nothing is due instead of polling.')
+
+    def handle(self, *args, **options):
+        sent = failed = 0
+        connection = get_connection()
+        try:
+            while True:
+                batch = claim_batch(options['batch_size'])
+                if not batch:
+                    if options['once']:
+                        break
+                    # Nothing due: don't hold the SMTP session open while idle.
+                    connection.close()
+                    time.sleep(settings.OUTBOX_POLL_INTERVAL)
+                    continue
+                # deliver_batch() opens the connection on first use and it stays open across batches.
+                batch_sent, batch_failed = deliver_batch(batch, connection)
+                sent += batch_sent
+                failed += batch_failed
+                if options['verbosity'] > 1:
+                    self.stdout.write(f"Sent {batch_sent}, {batch_failed} failed")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
+        self.stdout.write(f"Sent {sent}, {failed} failed")
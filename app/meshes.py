@@ -0,0 +1,119 @@
+import json
+import os
+import struct
+
+import numpy as np
+from django.conf import settings
+
+from .derived import build_once
+from .nifti import read_header
+from .pyramid import downsample
+from .render import first_frame
+from .volume_cache import get_volume, volume_key
+
+# BraTS labels a surface is extracted for: necrotic core, edema, enhancing tumor.
+MESH_LABELS = {1: 'necrotic_core', 2: 'edema', 3: 'enhancing_tumor'}
+# Levels of detail, as the factor the label mask is downsampled by before extraction.
+LOD_FACTORS = (1, 2, 4)
+
+# File layout: MAGIC, uint32 JSON index length, the JSON index, then for every
+# (label, lod) its vertices as little-endian uint16 xyz triples and its triangles
+# as little-endian uint32 index triples. Offsets in the index count from the first
+# byte after the index.
+# Vertices are voxel-corner coordinates of the full-resolution grid; multiply by
+# the index's spacing (and apply the affine) for millimetres.
+MAGIC = b'NMMESH01'
+
+
+def mesh_path(key):
+    return os.path.join(str(settings.MESH_DIR), f"{key}.mesh")
+
+
+def extract_surface(mask):
+    """
+    Boundary surface of a boolean voxel mask as (vertices, triangles).
+
+    Every face between a voxel inside the mask and one outside becomes two
+    triangles wound so their normals point outwards; shared corners are merged.
+    """
+    if not mask.any():
+        return np.zeros((0, 3), dtype=np.int64), np.zeros((0, 3), dtype=np.int64)
+    # Crop to the mask's bounding box (plus a one-voxel border) before scanning.
+    extent = [np.flatnonzero(mask.any(axis=tuple(i for i in range(3) if i != a))) for a in range(3)]
+    low = [int(e[0]) for e in extent]
+    high = [int(e[-1]) + 1 for e in extent]
+    padded = np.pad(mask[low[0]:high[0], low[1]:high[1], low[2]:high[2]], 1)
+
+    quads = []
+    for a in range(3):
+        b, c = (a + 1) % 3, (a + 2) % 3
+        eb, ec = np.eye(3, dtype=np.int64)[b], np.eye(3, dtype=np.int64)[c]
+        for sign in (1, -1):
+            faces = np.argwhere(padded & ~np.roll(padded, -sign, axis=a))
+            if sign == 1:
+                faces[:, a] += 1
+            corners = [faces, faces + eb, faces + eb + ec, faces + ec]
+            quads.append(np.stack(corners if sign == 1 else corners[::-1], axis=1))
+    quads = np.concatenate(quads) - 1 + np.array(low)
+
+    vertices, inverse = np.unique(quads.reshape(-1, 3), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1, 4)
+    triangles = np.concatenate([inverse[:, [0, 1, 2]], inverse[:, [0, 2, 3]]])
+    return vertices, triangles
+
+
+def write_meshes(volume, header, path):
+    labels = first_frame(np.asarray(volume))  # Surfaces of a 4D series come from its first frame.
+    index = {'spacing': list(header['spacing'][:3]), 'affine': header['affine'], 'vertex_dtype': '<u2',
+             'index_dtype': '<u4', 'labels': []}
+    blobs = []
+    offset = 0
+    for label, name in MESH_LABELS.items():
+        mask = labels == label
+        if not mask.any():
+            continue
+        entry = {'label': label, 'name': name, 'lods': []}
+        for lod, factor in enumerate(LOD_FACTORS):
+            coarse = mask if factor == 1 else downsample(mask, factor)
+            vertices, triangles = extract_surface(coarse)
+            vertex_bytes = (vertices * factor).astype('<u2').tobytes()
+            index_bytes = triangles.astype('<u4').tobytes()
+            entry['lods'].append({
+                'lod': lod,
+                'factor': factor,
+                'vertex_count': len(vertices),
+                'triangle_count': len(triangles),
+                'vertex_offset': offset,
+                'index_offset': offset + len(vertex_bytes),
+            })
+            blobs += [vertex_bytes, index_bytes]
+            offset += len(vertex_bytes) + len(index_bytes)
+        index['labels'].append(entry)
+
+    index_json = json.dumps(index, separators=(',', ':')).encode()
+    with open(path, 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('<I', len(index_json)))
+        out.write(index_json)
+        for blob in blobs:
+            out.write(blob)
+
+
+def read_mesh_index(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a mesh file")
+        (length,) = struct.unpack('<I', f.read(4))
+        return json.loads(f.read(length))
+
+
+def build_meshes(fieldfile):
+    """
+    Extract and store the label surfaces of a stored volume unless they exist; returns the path.
+    """
+    def write(tmp_path):
+        with fieldfile.storage.open(fieldfile.name, 'rb') as f:
+            header = read_header(f)
+        write_meshes(get_volume(fieldfile), header, tmp_path)
+
+    return build_once(mesh_path(volume_key(fieldfile)), write)
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:34
+
+import app.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_securepatientrecord_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('sha256', models.CharField(db_index=True, max_length=64)),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='patient',
+            name='mri_file',
+            field=models.FileField(blank=True, null=True, storage=app.storage.ContentAddressedStorage(), upload_to='mri_files/'),
+        ),
+        migrations.AlterField(
+            model_name='securepatientrecord',
+            name='file_path',
+            field=models.FileField(storage=app.storage.ContentAddressedStorage(), upload_to='patient_records/'),
+        ),
+    ]
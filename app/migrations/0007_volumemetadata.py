@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VolumeMetadata',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(db_index=True, max_length=64)),
+                ('shape', models.JSONField()),
+                ('spacing', models.JSONField()),
+                ('dtype', models.CharField(max_length=16)),
+                ('affine', models.JSONField()),
+                ('labels', models.JSONField(default=dict)),
+                ('tumor_volume_ml', models.FloatField(default=0)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+                ('patient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='volume_metadata', to='app.patient')),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_volumemetadata'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['physician', 'last_name', 'id'], name='patient_physician_name_idx'),
+        ),
+    ]
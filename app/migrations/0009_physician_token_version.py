@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_patient_physician_name_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='physician',
+            name='token_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
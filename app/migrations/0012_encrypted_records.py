@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:04
+
+import app.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='securepatientrecord',
+            name='file_path',
+            field=models.FileField(storage=app.storage.EncryptedContentAddressedStorage(), upload_to='patient_records/'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_encrypted_records'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='volumemetadata',
+            name='thumbnails',
+            field=models.JSONField(default=dict),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:20
+
+import app.storage
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_volumemetadata_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='patient',
+            name='mri_file',
+            field=app.storage.BlobFileField(blank=True, null=True, storage=app.storage.ContentAddressedStorage(), upload_to='mri_files/'),
+        ),
+        migrations.AlterField(
+            model_name='securepatientrecord',
+            name='file_path',
+            field=app.storage.BlobFileField(storage=app.storage.EncryptedContentAddressedStorage(), upload_to='patient_records/'),
+        ),
+    ]
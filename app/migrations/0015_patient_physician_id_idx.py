@@ -0,0 +1,17 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_blob_file_fields'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['physician', 'id'], name='patient_physician_id_idx'),
+        ),
+    ]
@@ -1,6 +1,11 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 
+from .storage import BlobFileField, content_addressed_storage, encrypted_storage
+
 class SecurePatientRecord(models.Model):
     # Linking to the Physician model
     physician = models.ForeignKey('Physician', related_name='patient_records', on_delete=models.CASCADE)
@@ -8,7 +13,7 @@ class SecurePatientRecord(models.Model):
     # Additional fields for patient records
     record_date = models.DateField(auto_now_add=True)  # Automatically sets the date when record is created
     description = models.TextField(blank=True, null=True)  # Optional field for record details
-    file_path = models.FileField(upload_to='patient_records/')  # Store files related to the patient records
+    file_path = BlobFileField(upload_to='patient_records/', storage=encrypted_storage)  # Encrypted at rest (see app.encryption)
 
     def __str__(self):
         # Return a string representation that could include the date and description
@@ -36,6 +41,7 @@ class Physician(AbstractBaseUser, PermissionsMixin):
     last_name = models.CharField(max_length=30)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)  # Use is_staff instead of is_admin
+    token_version = models.PositiveIntegerField(default=0)  # Bumped to revoke every token issued so far
 
     objects = PhysicianManager()
 
@@ -51,4 +57,149 @@ class Patient(models.Model):
     last_name = models.CharField(max_length=100)
     email = models.EmailField(unique=True)
     dob = models.DateField()
-    mri_file = models.FileField(upload_to='mri_files/', null=True, blank=True)
+    mri_file = BlobFileField(upload_to='mri_files/', storage=content_addressed_storage, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a physician's patients by name (see app.pagination)
+            models.Index(fields=['physician', 'last_name', 'id'], name='patient_physician_name_idx'),
+            # ... and by id; SQLite gets this from the implicit rowid, other databases do not
+            models.Index(fields=['physician', 'id'], name='patient_physician_id_idx'),
+        ]
+
+class UploadSession(models.Model):
+    # Resumable, chunked upload of a Patient.mri_file. Bytes land in a part file
+    # under CHUNKED_UPLOAD_DIR and are only moved into storage on commit.
+    STATUS_OPEN = 'open'
+    STATUS_COMMITTED = 'committed'
+    STATUS_CHOICES = [
+        (STATUS_OPEN, 'Open'),
+        (STATUS_COMMITTED, 'Committed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    physician = models.ForeignKey(Physician, related_name='upload_sessions', on_delete=models.CASCADE)
+    patient = models.ForeignKey(Patient, related_name='upload_sessions', on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()  # Total number of bytes the client announced
+    offset = models.BigIntegerField(default=0)  # Bytes received and verified so far
+    sha256 = models.CharField(max_length=64, blank=True)  # Optional digest of the whole file
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_OPEN)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+class StoredBlob(models.Model):
+    # One row per file in ContentAddressedStorage; ref_count is the number of
+    # Patient.mri_file / SecurePatientRecord.file_path values that point at it.
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+class VolumeMetadata(models.Model):
+    # Header fields and per-label volumetrics of a patient's MRI file, computed once on
+    # upload so lists and detail views never have to open the volume.
+    patient = models.OneToOneField(Patient, related_name='volume_metadata', on_delete=models.CASCADE)
+    sha256 = models.CharField(max_length=64, db_index=True)  # Content hash the row was computed from
+    shape = models.JSONField()
+    spacing = models.JSONField()  # Voxel size in mm
+    dtype = models.CharField(max_length=16)
+    affine = models.JSONField()
+    labels = models.JSONField(default=dict)  # {label: {voxels, volume_ml, bbox, centroid}}
+    tumor_volume_ml = models.FloatField(default=0)
+    thumbnails = models.JSONField(default=dict)  # {plane: PNG data URI} label MIPs for list previews
+    computed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.patient_id}: {self.tumor_volume_ml} mL"
+
+
+class OutboundEmail(models.Model):
+    # Email queued by a request and delivered later by the send_outbox worker (see app.outbox).
+    STATUS_QUEUED = 'queued'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    physician = models.ForeignKey(Physician, related_name='outbound_emails', null=True, on_delete=models.SET_NULL)
+    patient = models.ForeignKey(Patient, related_name='outbound_emails', null=True, on_delete=models.SET_NULL)
+    to = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)  # Not retried before this time
+    claimed_at = models.DateTimeField(null=True, blank=True)  # When a worker took it; lease for crash recovery
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.to}: {self.subject} ({self.status})"
+
+
+class Job(models.Model):
+    # Background work stored in the database and run by `manage.py run_workers` (see app.jobs).
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=64)  # Handler name registered in app.jobs
+    key = models.CharField(max_length=255)  # Content hash the job works on; one queued job per (kind, key)
+    payload = models.JSONField(default=dict)
+    priority = models.SmallIntegerField(default=0)  # Higher runs first
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_after'], name='job_due_idx'),
+            models.Index(fields=['key'], name='job_key_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], condition=models.Q(status='queued'), name='job_queued_dedup'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.key[:12]} ({self.status})"
+
+
+class RevokedCredential(models.Model):
+    # Denylisted JWT session ids and DRF token keys, by SHA-256 (see app.authentication.revoke).
+    # The 'auth' cache only fronts this table, so evicting a cache entry never un-revokes anything.
+    digest = models.CharField(max_length=64, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.digest[:12]} until {self.expires_at:%Y-%m-%d %H:%M}"
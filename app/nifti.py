@@ -0,0 +1,227 @@
+import gzip
+import struct
+import zlib
+
+import numpy as np
+
+# Minimal NIfTI-1/NIfTI-2 header support, enough to locate and interpret the
+# voxel data of a (possibly gzipped) .nii volume with numpy.
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+GZIP_MAGIC = b'\x1f\x8b'
+
+DATATYPES = {
+    2: 'u1',
+    4: 'i2',
+    8: 'i4',
+    16: 'f4',
+    64: 'f8',
+    256: 'i1',
+    512: 'u2',
+    768: 'u4',
+    1024: 'i8',
+    1280: 'u8',
+}
+
+
+class NiftiError(ValueError):
+    pass
+
+
+def open_volume(fileobj):
+    """
+    Return a file-like object over the uncompressed .nii bytes of `fileobj`.
+    """
+    magic = fileobj.read(2)
+    fileobj.seek(0)
+    if magic == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    return fileobj
+
+
+def read_header(fileobj):
+    stream = open_volume(fileobj)
+    return parse_header(stream.read(NIFTI2_HEADER_SIZE))
+
+
+class HeaderSniffer:
+    """
+    Validate the NIfTI header at the start of an upload as its raw bytes arrive.
+
+    Only the first few hundred bytes of a gzipped stream are inflated. feed()
+    raises NiftiError as soon as the data cannot be NIfTI, the header declares
+    more than `max_voxel_bytes` of voxels or more than `max_bytes` have been
+    received; `header` holds the parsed header once it is complete.
+    """
+
+    def __init__(self, max_bytes=None, max_voxel_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_voxel_bytes = max_voxel_bytes
+        self.header = None
+        self.received = 0
+        self._lead = b''
+        self._inflater = None
+        self._data = bytearray()
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        if self.max_bytes is not None and self.received > self.max_bytes:
+            raise NiftiError(f"File is larger than {self.max_bytes} bytes")
+        if self.header is not None or not chunk:
+            return self.header
+        if self._inflater is None and not self._data:
+            # The first two bytes tell a gzip stream from a plain .nii file.
+            self._lead += chunk
+            if len(self._lead) < 2:
+                return None
+            chunk, self._lead = self._lead, b''
+            if chunk[:2] == GZIP_MAGIC:
+                self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._inflater is not None:
+            try:
+                chunk = self._inflater.decompress(chunk, NIFTI2_HEADER_SIZE - len(self._data))
+            except zlib.error as e:
+                raise NiftiError(f"Not a valid gzip stream ({e})")
+        self._data += chunk[:NIFTI2_HEADER_SIZE - len(self._data)]
+        return self._parse(complete=False)
+
+    def finish(self):
+        """
+        Call at the end of the upload; returns the header or raises NiftiError.
+        """
+        if self.header is None:
+            self._data += self._lead
+            self._parse(complete=True)
+        return self.header
+
+    def _parse(self, complete):
+        if len(self._data) < 4:
+            if complete:
+                raise NiftiError('File is too short to be NIfTI')
+            return None
+        needed = header_size(bytes(self._data[:4]))
+        if len(self._data) < needed and not complete:
+            return None
+        header = parse_header(bytes(self._data[:needed]))
+        if self.max_voxel_bytes is not None and header['nbytes'] > self.max_voxel_bytes:
+            raise NiftiError(f"Volume of {header['nbytes']} bytes exceeds the {self.max_voxel_bytes} byte limit")
+        self.header = header
+        return header
+
+
+def header_size(lead):
+    """
+    NIfTI header size announced by the first four bytes (sizeof_hdr) in either byte order.
+    """
+    for endian in '<>':
+        sizeof_hdr = struct.unpack_from(endian + 'i', lead, 0)[0]
+        if sizeof_hdr in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+            return sizeof_hdr
+    raise NiftiError('Not a NIfTI file (bad sizeof_hdr)')
+
+
+def parse_header(data):
+    """
+    Parse the leading bytes of an uncompressed .nii file into a dict.
+    """
+    if len(data) < NIFTI1_HEADER_SIZE:
+        raise NiftiError('File is too short to be NIfTI')
+    for endian in '<>':
+        sizeof_hdr = struct.unpack_from(endian + 'i', data, 0)[0]
+        if sizeof_hdr == NIFTI1_HEADER_SIZE:
+            return _parse_nifti1(data, endian)
+        if sizeof_hdr == NIFTI2_HEADER_SIZE:
+            if len(data) < NIFTI2_HEADER_SIZE:
+                raise NiftiError('File is too short to be NIfTI-2')
+            return _parse_nifti2(data, endian)
+    raise NiftiError('Not a NIfTI file (bad sizeof_hdr)')
+
+
+def _parse_nifti1(data, endian):
+    magic = data[344:348]
+    if magic not in (b'n+1\x00', b'ni1\x00'):
+        raise NiftiError('Not a NIfTI-1 file (bad magic)')
+    dim = struct.unpack_from(endian + '8h', data, 40)
+    datatype, bitpix = struct.unpack_from(endian + '2h', data, 70)
+    pixdim = struct.unpack_from(endian + '8f', data, 76)
+    vox_offset, scl_slope, scl_inter = struct.unpack_from(endian + '3f', data, 108)
+    qform_code, sform_code = struct.unpack_from(endian + '2h', data, 252)
+    quatern = struct.unpack_from(endian + '6f', data, 256)
+    srow = struct.unpack_from(endian + '12f', data, 280)
+    return _build_header(1, endian, dim, datatype, bitpix, pixdim, vox_offset, scl_slope, scl_inter,
+                         qform_code, sform_code, quatern, srow)
+
+
+def _parse_nifti2(data, endian):
+    magic = data[4:12]
+    if magic[:3] not in (b'n+2', b'ni2'):
+        raise NiftiError('Not a NIfTI-2 file (bad magic)')
+    datatype, bitpix = struct.unpack_from(endian + '2h', data, 12)
+    dim = struct.unpack_from(endian + '8q', data, 16)
+    pixdim = struct.unpack_from(endian + '8d', data, 104)
+    vox_offset = struct.unpack_from(endian + 'q', data, 168)[0]
+    scl_slope, scl_inter = struct.unpack_from(endian + '2d', data, 176)
+    qform_code, sform_code = struct.unpack_from(endian + '2i', data, 344)
+    quatern = struct.unpack_from(endian + '6d', data, 352)
+    srow = struct.unpack_from(endian + '12d', data, 400)
+    return _build_header(2, endian, dim, datatype, bitpix, pixdim, vox_offset, scl_slope, scl_inter,
+                         qform_code, sform_code, quatern, srow)
+
+
+def _build_header(version, endian, dim, datatype, bitpix, pixdim, vox_offset, scl_slope, scl_inter,
+                  qform_code, sform_code, quatern, srow):
+    ndim = dim[0]
+    if not 1 <= ndim <= 7 or any(d < 1 for d in dim[1:ndim + 1]):
+        raise NiftiError(f"Invalid dimensions {dim[1:ndim + 1]}")
+    if datatype not in DATATYPES:
+        raise NiftiError(f"Unsupported datatype {datatype}")
+    dtype = np.dtype(endian + DATATYPES[datatype])
+    if dtype.itemsize * 8 != bitpix:
+        raise NiftiError(f"bitpix {bitpix} does not match datatype {datatype}")
+    shape = tuple(int(d) for d in dim[1:ndim + 1])
+    spacing = tuple(float(abs(p)) for p in pixdim[1:ndim + 1])
+    return {
+        'version': version,
+        'shape': shape,
+        'datatype': datatype,
+        'dtype': dtype.str,
+        'spacing': spacing,
+        'vox_offset': int(vox_offset),
+        'scl_slope': float(scl_slope),
+        'scl_inter': float(scl_inter),
+        'affine': _affine(qform_code, sform_code, quatern, srow, pixdim),
+        'nbytes': int(np.prod(shape, dtype=np.int64)) * dtype.itemsize,
+    }
+
+
+def _affine(qform_code, sform_code, quatern, srow, pixdim):
+    # Voxel-to-world transform, preferring sform over qform as the spec suggests.
+    if sform_code > 0:
+        rows = [list(srow[0:4]), list(srow[4:8]), list(srow[8:12])]
+    elif qform_code > 0:
+        b, c, d, qx, qy, qz = quatern
+        a = max(0.0, 1.0 - (b * b + c * c + d * d)) ** 0.5
+        rotation = np.array([
+            [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+            [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+            [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+        ])
+        qfac = -1.0 if pixdim[0] < 0 else 1.0
+        scale = np.array([pixdim[1], pixdim[2], pixdim[3] * qfac])
+        rotation = rotation * scale
+        rows = [list(rotation[0]) + [qx], list(rotation[1]) + [qy], list(rotation[2]) + [qz]]
+    else:
+        rows = [[pixdim[1], 0, 0, 0], [0, pixdim[2], 0, 0], [0, 0, pixdim[3], 0]]
+    return [[float(v) for v in row] for row in rows] + [[0.0, 0.0, 0.0, 1.0]]
+
+
+def load_volume(fileobj):
+    """
+    Read a whole volume into memory; prefer app.volume_cache for repeated access.
+    """
+    stream = open_volume(fileobj)
+    header = parse_header(stream.read(NIFTI2_HEADER_SIZE))
+    stream.seek(header['vox_offset'])
+    data = np.frombuffer(stream.read(header['nbytes']), dtype=header['dtype'])
+    return header, data.reshape(header['shape'], order='F')
@@ -0,0 +1,105 @@
+import logging
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+PATIENT_INFO_SUBJECT = 'Your Patient Information'
+PATIENT_INFO_BODY = 'Please visit this link to view your information: http://localhost:3000/patient-info'
+
+# A worker that dies mid-batch leaves rows in 'sending'; they are claimed again after this.
+CLAIM_LEASE = timedelta(minutes=10)
+
+
+def patient_info_email(physician, patient):
+    return OutboundEmail(
+        physician=physician, patient=patient, to=patient.email,
+        subject=PATIENT_INFO_SUBJECT, body=PATIENT_INFO_BODY,
+    )
+
+
+def enqueue_patient_info(physician, patients):
+    """
+    Queue the patient-information email for each patient; returns the number queued.
+    """
+    return len(OutboundEmail.objects.bulk_create(
+        [patient_info_email(physician, patient) for patient in patients], batch_size=500
+    ))
+
+
+def claim_batch(size):
+    """
+    Mark up to `size` due messages as sending and return them.
+
+    The conditional UPDATE is the claim: a row another worker took between the
+    SELECT and the UPDATE no longer matches, so every message has one owner.
+    """
+    now = timezone.now()
+    due = (Q(status=OutboundEmail.STATUS_QUEUED, next_attempt_at__lte=now) |
+           Q(status=OutboundEmail.STATUS_SENDING, claimed_at__lt=now - CLAIM_LEASE))
+    with transaction.atomic():
+        ids = list(OutboundEmail.objects.filter(due).order_by('next_attempt_at', 'id').values_list('id', flat=True)[:size])
+        OutboundEmail.objects.filter(due, id__in=ids).update(status=OutboundEmail.STATUS_SENDING, claimed_at=now)
+    return list(OutboundEmail.objects.filter(id__in=ids, status=OutboundEmail.STATUS_SENDING, claimed_at=now))
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(settings.OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.OUTBOX_RETRY_MAX_SECONDS))
+
+
+def deliver_batch(messages, connection):
+    """
+    Send `messages` over one open connection, recording each outcome; returns (sent, failed).
+
+    The connection is opened here (a no-op while it is already open) so the backend
+    does not open and close one per message. Every message is recorded as sent or
+    failed even if the loop is interrupted, so nothing is left in 'sending' to be
+    delivered twice once its lease expires.
+    """
+    sent, failed = [], []
+    try:
+        for outbound in messages:
+            outbound.attempts += 1
+            try:
+                message = EmailMessage(outbound.subject, outbound.body, settings.DEFAULT_FROM_EMAIL, [outbound.to],
+                                       connection=connection)
+                connection.open()
+                if not connection.send_messages([message]):
+                    raise smtplib.SMTPRecipientsRefused({outbound.to: (550, b'No valid recipients')})
+            except (smtplib.SMTPException, OSError) as e:
+                outbound.last_error = f"{type(e).__name__}: {e}"
+                if outbound.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                    outbound.status = OutboundEmail.STATUS_FAILED
+                else:
+                    outbound.status = OutboundEmail.STATUS_QUEUED
+                    outbound.next_attempt_at = timezone.now() + retry_delay(outbound.attempts)
+                failed.append(outbound)
+                if isinstance(e, (smtplib.SMTPServerDisconnected, OSError)):
+                    # Drop the broken connection; the next open() starts a fresh one.
+                    connection.close()
+                continue
+            except Exception as e:
+                # The message itself is bad (a header with a newline, say); retrying won't help.
+                outbound.last_error = f"{type(e).__name__}: {e}"
+                outbound.status = OutboundEmail.STATUS_FAILED
+                failed.append(outbound)
+                continue
+            outbound.status = OutboundEmail.STATUS_SENT
+            outbound.sent_at = timezone.now()
+            outbound.last_error = ''
+            sent.append(outbound)
+    finally:
+        OutboundEmail.objects.bulk_update(
+            sent + failed, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'], batch_size=500
+        )
+    for outbound in failed:
+        logger.warning(f"Email {outbound.id} to {outbound.to} failed (attempt {outbound.attempts}): {outbound.last_error}")
+    return len(sent), len(failed)
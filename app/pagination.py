@@ -0,0 +1,96 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination that seeks on the ordering columns instead of using OFFSET.
+
+    The cursor holds the ordering values of the last row of the previous page, so
+    every page is a range scan on the (physician, last_name, id) or (physician, id)
+    index no matter how deep it is. ?ordering=name orders by (last_name, id); the
+    default is id.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 500
+    orderings = {
+        'id': ('id',),
+        'name': ('last_name', 'id'),
+    }
+    # Type each cursor value must have; bool is rejected even though it is an int.
+    cursor_types = {
+        'id': int,
+        'last_name': str,
+    }
+    max_cursor_id = 2 ** 63 - 1
+
+    def is_requested(self, request):
+        return self.cursor_query_param in request.query_params or self.page_size_query_param in request.query_params
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.orderings.get(request.query_params.get('ordering'), self.orderings['id'])
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self.seek(self.decode_cursor(cursor)))
+        page_size = self.get_page_size(request)
+        rows = list(queryset[:page_size + 1])
+        self.has_next = len(rows) > page_size
+        self.page = rows[:page_size]
+        return self.page
+
+    def seek(self, position):
+        # (a, b) > (va, vb)  ==  a > va OR (a = va AND b > vb)
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            equal = {name: position[name] for name in self.ordering[:i]}
+            condition |= Q(**equal, **{f"{field}__gt": position[field]})
+        return condition
+
+    def decode_cursor(self, cursor):
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise NotFound('Invalid cursor')
+        if not isinstance(position, dict) or not all(self.valid_position(position, field) for field in self.ordering):
+            raise NotFound('Invalid cursor')
+        return position
+
+    def valid_position(self, position, field):
+        value = position.get(field)
+        if type(value) is not self.cursor_types[field]:
+            return False
+        return field != 'id' or 0 <= value <= self.max_cursor_id
+
+    def encode_cursor(self, row):
+        position = {field: getattr(row, field) for field in self.ordering}
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
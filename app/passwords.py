@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import is_password_usable, make_password, verify_password
+from rest_framework.exceptions import Throttled
+
+
+class HashingPoolBusy(Throttled):
+    default_detail = 'Too many sign-in attempts in progress, please retry shortly.'
+    default_code = 'hashing_pool_busy'
+
+    def __init__(self):
+        super().__init__(wait=1)
+
+
+class HashingPool:
+    """
+    Bounded thread pool for password hashing.
+
+    PBKDF2 and the other hashers release the GIL while hashing, so a few
+    threads use the cores fully; at most PASSWORD_HASH_WORKERS hashes run
+    at once and PASSWORD_HASH_QUEUE more may wait. Past that, callers get
+    HashingPoolBusy (429) straight away instead of piling up request threads.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                workers = settings.PASSWORD_HASH_WORKERS
+                self._slots = threading.BoundedSemaphore(workers + settings.PASSWORD_HASH_QUEUE)
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        return self._executor
+
+    def submit(self, fn, *args):
+        executor = self._start()
+        if not self._slots.acquire(blocking=False):
+            raise HashingPoolBusy()
+        future = executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn, *args):
+        # Awaiting the future frees the event loop while the hash runs on the pool.
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+
+hashing_pool = HashingPool()
+
+_dummy_hash = None
+
+
+def dummy_hash():
+    # A real hash with the current hasher and parameters, so checking against it
+    # costs exactly what checking a stored password does.
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = make_password('not the password')
+    return _dummy_hash
+
+
+def verify(password, encoded):
+    """
+    Check `password` against `encoded` with one hash of constant cost.
+
+    Returns (is_correct, must_update). Unknown users (`encoded` None) and
+    unusable passwords are checked against a dummy hash, so every attempt
+    costs the same whatever the outcome.
+    """
+    if encoded is None or not is_password_usable(encoded):
+        verify_password(password, dummy_hash())
+        return False, False
+    return verify_password(password, encoded)
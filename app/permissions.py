@@ -13,3 +13,12 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
 
         # Write permissions are only allowed to the owner of the patient.
         return obj.physician == request.user
+
+
+class IsOwner(permissions.BasePermission):
+    """
+    Only the physician who owns an object may read or change it.
+    """
+
+    def has_object_permission(self, request, view, obj):
+        return obj.physician == request.user
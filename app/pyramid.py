@@ -0,0 +1,94 @@
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+from .derived import build_once
+from .render import first_frame
+from .volume_cache import get_volume, volume_key
+from .volumetrics import label_dtype
+
+# Downsampling factor of each pyramid level, finest first.
+LEVELS = (1, 2, 4, 8)
+BRICK_SIZE = 32
+
+# Container layout: MAGIC, the zlib-compressed bricks back to back, the JSON index,
+# then a trailer of (index offset, index length) as little-endian uint64 and MAGIC.
+MAGIC = b'NMPYR01\x00'
+TRAILER = struct.Struct('<QQ8s')
+
+
+def pyramid_path(key):
+    return os.path.join(str(settings.PYRAMID_DIR), f"{key}.bricks")
+
+
+def downsample(labels, factor):
+    """
+    Max-pool a 3D label volume by `factor`, so small structures survive at coarse levels.
+    """
+    pad = [(0, -n % factor) for n in labels.shape]
+    padded = np.pad(labels, pad)
+    x, y, z = (n // factor for n in padded.shape)
+    return padded.reshape(x, factor, y, factor, z, factor).max(axis=(1, 3, 5))
+
+
+def iter_bricks(level):
+    for bx in range(0, level.shape[0], BRICK_SIZE):
+        for by in range(0, level.shape[1], BRICK_SIZE):
+            for bz in range(0, level.shape[2], BRICK_SIZE):
+                brick = level[bx:bx + BRICK_SIZE, by:by + BRICK_SIZE, bz:bz + BRICK_SIZE]
+                yield (bx // BRICK_SIZE, by // BRICK_SIZE, bz // BRICK_SIZE), brick
+
+
+def write_pyramid(volume, path):
+    """
+    Write the brick container for `volume` (the first frame of a 4D series) to `path`.
+
+    Label maps are stored as uint8 (uint16 past label 255); other volumes keep their
+    own dtype, little-endian. The index records which.
+    """
+    labels = np.asarray(first_frame(volume))
+    dtype = label_dtype(labels) or labels.dtype.newbyteorder('<')
+    labels = labels.astype(dtype)
+    index = {'dtype': dtype.str.lstrip('|'), 'order': 'F', 'brick_size': BRICK_SIZE, 'levels': [], 'bricks': []}
+    with open(path, 'wb') as out:
+        out.write(MAGIC)
+        level = labels
+        for number, factor in enumerate(LEVELS):
+            if number:
+                level = downsample(level, factor // LEVELS[number - 1])
+            index['levels'].append({
+                'level': number,
+                'factor': factor,
+                'shape': list(level.shape),
+                'grid': [-(-n // BRICK_SIZE) for n in level.shape],
+            })
+            for (bx, by, bz), brick in iter_bricks(level):
+                data = zlib.compress(brick.tobytes(order='F'), 6)
+                index['bricks'].append([number, bx, by, bz, out.tell(), len(data)])
+                out.write(data)
+        index_bytes = json.dumps(index, separators=(',', ':')).encode()
+        index_offset = out.tell()
+        out.write(index_bytes)
+        out.write(TRAILER.pack(index_offset, len(index_bytes), MAGIC))
+
+
+def read_index(path):
+    with open(path, 'rb') as f:
+        f.seek(-TRAILER.size, os.SEEK_END)
+        index_offset, index_length, magic = TRAILER.unpack(f.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a brick pyramid")
+        f.seek(index_offset)
+        return json.loads(f.read(index_length))
+
+
+def build_pyramid(fieldfile):
+    """
+    Build the brick pyramid for a stored volume unless it already exists; returns its path.
+    """
+    path = pyramid_path(volume_key(fieldfile))
+    return build_once(path, lambda tmp_path: write_pyramid(get_volume(fieldfile), tmp_path))
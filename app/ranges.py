@@ -0,0 +1,187 @@
+import asyncio
+import os
+import re
+import uuid
+from functools import partial
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+from .encryption import iter_decrypted_range, plaintext_size
+
+BLOCK_SIZE = 64 * 1024
+RANGE_SPEC_RE = re.compile(r'^(\d*)-(\d*)$')
+# More disjoint ranges than this and the whole file is sent instead (RFC 9110 14.2).
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(header, size):
+    """
+    Parse a 'bytes=...' Range header into a list of inclusive (start, end) pairs.
+
+    Overlapping and adjacent ranges are merged, so no byte is sent twice. Returns
+    None when there is no usable Range header or more than MAX_RANGES ranges remain,
+    so the whole file should be sent; raises RangeNotSatisfiable when none of the
+    ranges overlap the file.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        match = RANGE_SPEC_RE.match(spec.strip())
+        if not match or match.groups() == ('', ''):
+            return None  # Malformed headers are ignored, as RFC 9110 allows.
+        first, last = match.groups()
+        if first == '':
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        if start < size and end >= start:
+            ranges.append((start, end))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged if len(merged) <= MAX_RANGES else None
+
+
+class FileRange:
+    """
+    File-like view of bytes start..end (inclusive) of an open file.
+
+    FileResponse hands it to the server's wsgi.file_wrapper, which sends it with
+    os.sendfile() from the file's current offset for Content-Length bytes; without
+    one, Django reads it in blocks and stops at the end of the range.
+    """
+
+    def __init__(self, f, start, end):
+        self.file = f
+        self.file.seek(start)
+        self.remaining = end - start + 1
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        block = self.file.read(size)
+        self.remaining -= len(block)
+        return block
+
+    def close(self):
+        self.file.close()
+
+
+def iter_file_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+async def aiter_file_range(path, start, end):
+    """
+    Async iter_file_range: each read runs on the default executor, so an ASGI worker
+    streams to many slow clients without holding a thread per download.
+    """
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, open, path, 'rb')
+    try:
+        await loop.run_in_executor(None, f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = await loop.run_in_executor(None, f.read, min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        f.close()
+
+
+def _multipart_header(boundary, content_type, start, end, size):
+    return (f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+
+
+def _iter_multipart(path, ranges, size, content_type, boundary, iter_range=iter_file_range):
+    for start, end in ranges:
+        yield _multipart_header(boundary, content_type, start, end, size)
+        yield from iter_range(path, start, end)
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+async def _aiter_multipart(path, ranges, size, content_type, boundary):
+    for start, end in ranges:
+        yield _multipart_header(boundary, content_type, start, end, size)
+        async for block in aiter_file_range(path, start, end):
+            yield block
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def ranged_file_response(request, path, content_type='application/octet-stream', asynchronous=False, decrypt=False,
+                         use_range=True):
+    """
+    Serve the file at `path`, honouring single and multi-part Range requests.
+
+    Whole files and single ranges go out as FileResponse, so a server with
+    wsgi.file_wrapper sends them with sendfile(). With `asynchronous`, the body is
+    an async iterator for async views; under ASGI Django would otherwise read a
+    synchronous body into memory in a thread. With `decrypt`, the file is an
+    encrypted record and only the chunks covering the requested ranges are
+    decrypted. `use_range=False` ignores the Range header (e.g. a stale If-Range).
+    """
+    size = plaintext_size(path) if decrypt else os.path.getsize(path)
+    try:
+        ranges = parse_range_header(request.headers.get('Range'), size) if use_range else None
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        return response
+
+    if decrypt:
+        iter_range, iter_multipart = iter_decrypted_range, partial(_iter_multipart, iter_range=iter_decrypted_range)
+    elif asynchronous:
+        iter_range, iter_multipart = aiter_file_range, _aiter_multipart
+    else:
+        iter_range, iter_multipart = iter_file_range, _iter_multipart
+    in_python = asynchronous or decrypt
+    if ranges is None and not in_python:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    elif ranges is None:
+        response = StreamingHttpResponse(iter_range(path, 0, size - 1), content_type=content_type)
+        response['Content-Length'] = str(size)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        if in_python:
+            response = StreamingHttpResponse(iter_range(path, start, end), status=206, content_type=content_type)
+        else:
+            response = FileResponse(FileRange(open(path, 'rb'), start, end), status=206, content_type=content_type)
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        boundary = uuid.uuid4().hex
+        response = StreamingHttpResponse(
+            iter_multipart(path, ranges, size, content_type, boundary),
+            status=206,
+            content_type=f"multipart/byteranges; boundary={boundary}",
+        )
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
@@ -0,0 +1,65 @@
+from urllib.parse import parse_qs
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from .authentication import CachedJWTAuthentication
+
+CREATED = 'created'
+UPDATED = 'updated'
+DELETED = 'deleted'
+
+
+def physician_group(physician_id):
+    return f"physician.{physician_id}"
+
+
+def publish_patient_changes(physician_id, changes):
+    """
+    Tell the physician's open sockets that patients changed; `changes` is [(patient id, action)].
+
+    One group message carries the whole list, so a bulk write costs one send.
+    """
+    layer = get_channel_layer()
+    if layer is None or not changes:
+        return
+    async_to_sync(layer.group_send)(physician_group(physician_id), {
+        'type': 'patients.changed',
+        'changes': [[patient_id, action] for patient_id, action in changes],
+    })
+
+
+def merge_action(previous, action):
+    # Deleted always wins; something created in this window stays 'created' however often it is edited.
+    if previous is None or action == DELETED:
+        return action
+    if previous == CREATED:
+        return CREATED
+    return action
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Authenticate WebSocket connections from a `?token=<access token>` query parameter.
+
+    Browsers cannot set an Authorization header on a WebSocket handshake.
+    """
+
+    async def __call__(self, scope, receive, send):
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+        scope = dict(scope, user=await self.get_user(token) if token else AnonymousUser())
+        return await super().__call__(scope, receive, send)
+
+    @database_sync_to_async
+    def get_user(self, raw_token):
+        authentication = CachedJWTAuthentication()
+        try:
+            user = authentication.get_user(authentication.get_validated_token(raw_token))
+        except (AuthenticationFailed, InvalidToken, TokenError):
+            return AnonymousUser()
+        return user
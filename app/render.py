@@ -0,0 +1,141 @@
+import base64
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+# Slice planes by name, as the index of the volume axis they cut across.
+AXES = {
+    'sagittal': 0,
+    'coronal': 1,
+    'axial': 2,
+}
+FORMATS = ('png', 'raw')
+
+# RGBA colors for BraTS labels: 1 necrotic core, 2 edema, 3 enhancing tumor
+# (4 is the enhancing-tumor label in pre-2023 BraTS releases).
+LABEL_COLORS = np.zeros((256, 4), dtype=np.uint8)
+LABEL_COLORS[1] = (255, 0, 0, 255)
+LABEL_COLORS[2] = (0, 200, 0, 255)
+LABEL_COLORS[3] = (255, 215, 0, 255)
+LABEL_COLORS[4] = (255, 215, 0, 255)
+
+
+def first_frame(volume):
+    # The 3D volume displayed and measured for a 4D (or higher) series is its first frame.
+    return volume[(slice(None),) * 3 + (0,) * (volume.ndim - 3)] if volume.ndim > 3 else volume
+
+
+def label_image(plane):
+    """
+    Orient a 2D plane for display as a uint8 label image; values outside 0..255 are clipped
+    rather than wrapped into other labels' colors.
+    """
+    # Volume axes run left-to-right / posterior-to-anterior / inferior-to-superior;
+    # images are drawn top row first.
+    return np.ascontiguousarray(np.flipud(np.clip(plane, 0, 255).T)).astype(np.uint8)
+
+
+def extract_slice(volume, axis, index):
+    """
+    Return one plane of `volume` as a uint8 label image, oriented for display.
+    """
+    return label_image(np.take(first_frame(volume), index, axis=AXES[axis]))
+
+
+def encode_png(rgba):
+    height, width, _ = rgba.shape
+    # Filter type 0 ("None") on every scanline.
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)]).tobytes()
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw, 6)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def render_slice(volume, axis, index, fmt):
+    """
+    Return (body, (rows, cols)) for one plane as a color-mapped PNG or raw uint8 labels.
+    """
+    labels = extract_slice(volume, axis, index)
+    if fmt == 'png':
+        return encode_png(LABEL_COLORS[labels]), labels.shape
+    return labels.tobytes(), labels.shape
+
+
+def mip_thumbnails(volume, size):
+    """
+    Color-mapped maximum-intensity projections of a label volume along each axis, as
+    {plane: PNG data URI} no more than `size` pixels on a side.
+
+    Higher labels win where they overlap, so the enhancing core shows through the edema.
+    """
+    volume = np.asarray(first_frame(volume))
+    thumbnails = {}
+    for axis, index in AXES.items():
+        image = downsample_max(label_image(volume.max(axis=index)), size)
+        thumbnails[axis] = 'data:image/png;base64,' + base64.b64encode(encode_png(LABEL_COLORS[image])).decode()
+    return thumbnails
+
+
+def downsample_max(image, size):
+    # Shrink by an integer factor, keeping the largest label in each block so small lesions survive.
+    factor = -(-max(image.shape) // size)
+    if factor <= 1:
+        return image
+    rows, cols = (-(-n // factor) * factor for n in image.shape)
+    padded = np.zeros((rows, cols), dtype=image.dtype)
+    padded[:image.shape[0], :image.shape[1]] = image
+    return padded.reshape(rows // factor, factor, cols // factor, factor).max(axis=(1, 3))
+
+
+class SliceCache:
+    """
+    Thread-safe, byte-bounded LRU of rendered slices for this process.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        return settings.SLICE_CACHE_MAX_BYTES
+
+    def get(self, key):
+        """
+        Return the cached (body, shape) for `key`, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, shape):
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key)[0])
+            self._entries[key] = (body, shape)
+            self._size += len(body)
+            while self._size > self.max_bytes and self._entries:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+slice_cache = SliceCache()
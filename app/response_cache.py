@@ -0,0 +1,82 @@
+import hashlib
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def response_cache():
+    return caches[settings.RESPONSE_CACHE_ALIAS]
+
+
+def version_key(physician_id):
+    return f"physician:{physician_id}:version"
+
+
+def get_version(physician_id):
+    cache = response_cache()
+    version = cache.get(version_key(physician_id))
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key(physician_id), version, None):
+            version = cache.get(version_key(physician_id), version)
+    return version
+
+
+def bump_version(physician_id):
+    # Every bump writes a fresh random token rather than incrementing: two concurrent
+    # bumps can never produce the same version, and a counter that was evicted and
+    # recreated can never repeat one an old ETag was built from.
+    response_cache().set(version_key(physician_id), uuid.uuid4().hex, None)
+
+
+def bump_versions_on_commit(physician_ids):
+    """
+    Invalidate the cached responses of these physicians once the current transaction commits.
+    """
+    physician_ids = set(physician_ids)
+    transaction.on_commit(lambda: [bump_version(pk) for pk in physician_ids])
+
+
+def versioned_response(handler):
+    """
+    Cache a GET handler's response data per physician, absolute URL and Accept header.
+
+    The URL includes scheme and host because serialized file fields are absolute
+    URLs built from the request.
+
+    The ETag is built from the physician's version and the request alone, so a
+    matching If-None-Match is answered with 304 before the handler runs; a
+    cached body is reused until any write bumps the version.
+    """
+    @wraps(handler)
+    def wrapped(request, *args, **kwargs):
+        physician_id = request.user.pk
+        version = get_version(physician_id)
+        variant = hashlib.sha256(
+            f"{request.build_absolute_uri()}|{request.META.get('HTTP_ACCEPT', '')}".encode()
+        ).hexdigest()[:32]
+        etag = quote_etag(f"{version}.{variant}")
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'Accept, Authorization'}
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        cache = response_cache()
+        key = f"response:{physician_id}:{variant}"
+        cached = cache.get(key)
+        if cached is not None and cached[0] == version:
+            return Response(cached[1], headers=headers)
+        response = handler(request, *args, **kwargs)
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        cache.set(key, (version, response.data), settings.RESPONSE_CACHE_TIMEOUT)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    return wrapped
@@ -0,0 +1,62 @@
+import json
+import struct
+
+import numpy as np
+
+from .render import first_frame
+
+# Region-of-interest transfer format: MAGIC, uint32 JSON header length, the JSON
+# header (shape, dtype, order, voxel offset, spacing, world origin of the first
+# voxel) and the cropped voxels as a little-endian array in Fortran order. Crops of a
+# 4D series keep every frame; bounds only ever cover the three spatial axes.
+MAGIC = b'NMROI001'
+
+
+def label_bounds(volume, label=None):
+    """
+    Half-open voxel bounds [(x0, x1), (y0, y1), (z0, z1)] of `label` (any non-zero label if None),
+    in the first frame of a 4D series like the precomputed VolumeMetadata bounds.
+    """
+    volume = first_frame(volume)
+    mask = volume != 0 if label is None else volume == label
+    bounds = []
+    for axis in range(3):
+        present = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != axis)))
+        if not len(present):
+            return None
+        bounds.append((int(present[0]), int(present[-1]) + 1))
+    return bounds
+
+
+def metadata_bounds(metadata, label=None):
+    """
+    The same bounds, read from precomputed VolumeMetadata instead of scanning the volume.
+    """
+    boxes = [stats['bbox'] for key, stats in metadata.labels.items()
+             if 'bbox' in stats and (label is None or key == str(label))]
+    if not boxes:
+        return None
+    low = np.min([box[0] for box in boxes], axis=0)
+    high = np.max([box[1] for box in boxes], axis=0)
+    return [(int(lo), int(hi) + 1) for lo, hi in zip(low, high)]
+
+
+def expand_bounds(bounds, margin, shape):
+    return [(max(lo - margin, 0), min(hi + margin, size)) for (lo, hi), size in zip(bounds, shape[:3])]
+
+
+def encode_roi(volume, bounds, spacing, affine):
+    (x0, x1), (y0, y1), (z0, z1) = bounds
+    # Slicing the memmap only reads the pages that hold the region.
+    crop = np.asarray(volume[x0:x1, y0:y1, z0:z1, ...])
+    dtype = crop.dtype.newbyteorder('<')
+    origin = np.array(affine) @ np.array([x0, y0, z0, 1.0])
+    header = json.dumps({
+        'shape': list(crop.shape),
+        'dtype': dtype.str,
+        'order': 'F',
+        'offset': [x0, y0, z0],
+        'spacing': list(spacing[:3]),
+        'origin': [round(float(v), 4) for v in origin[:3]],
+    }, separators=(',', ':')).encode()
+    return MAGIC + struct.pack('<I', len(header)) + header + crop.astype(dtype).tobytes(order='F')
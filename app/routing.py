@@ -0,0 +1,7 @@
+from django.urls import path
+
+from .views import NotificationConsumer
+
+websocket_urlpatterns = [
+    path('ws/patients/', NotificationConsumer.as_asgi()),
+]
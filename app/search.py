@@ -0,0 +1,121 @@
+import re
+
+from django.db import connections
+from django.db.models import Q
+
+from .models import Patient, SecurePatientRecord
+
+MAX_TERMS = 8
+
+# Per index: the FTS5 table, the table it mirrors, the indexed columns and their
+# bm25 weights (a surname hit outranks a first-name hit, which outranks an email hit).
+INDEXES = {
+    'patients': {
+        'model': Patient,
+        'table': 'app_patient_fts',
+        'columns': ('first_name', 'last_name', 'email'),
+        'weights': (5.0, 10.0, 1.0),
+    },
+    'records': {
+        'model': SecurePatientRecord,
+        'table': 'app_securepatientrecord_fts',
+        'columns': ('description',),
+        'weights': (1.0,),
+    },
+}
+
+
+def sqlite_statements(index):
+    table, content = index['table'], index['model']._meta.db_table
+    columns = ', '.join(index['columns'])
+    new = ', '.join(f"new.{column}" for column in index['columns'])
+    old = ', '.join(f"old.{column}" for column in index['columns'])
+    # External-content table: the index stores only tokens, the text stays in the
+    # model's table. The triggers keep it in sync for every write path, including
+    # bulk_create/bulk_update and raw SQL, which bypass model signals.
+    return [
+        f"CREATE VIRTUAL TABLE {table} USING fts5({columns}, content='{content}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {content} BEGIN "
+        f"INSERT INTO {table}(rowid, {columns}) VALUES (new.id, {new}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {content} BEGIN "
+        f"INSERT INTO {table}({table}, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE OF {columns} ON {content} BEGIN "
+        f"INSERT INTO {table}({table}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+        f"INSERT INTO {table}(rowid, {columns}) VALUES (new.id, {new}); END",
+        f"INSERT INTO {table}({table}) VALUES ('rebuild')",
+    ]
+
+
+def postgresql_statements(index):
+    # icontains compiles to UPPER(column) LIKE UPPER(%s), which a trigram GIN index can serve.
+    content = index['model']._meta.db_table
+    statements = ['CREATE EXTENSION IF NOT EXISTS pg_trgm']
+    for column in index['columns']:
+        statements.append(
+            f"CREATE INDEX IF NOT EXISTS {content}_{column}_trgm ON {content} USING gin (UPPER({column}) gin_trgm_ops)"
+        )
+    return statements
+
+
+def install_search_indexes(using='default'):
+    """
+    Create the search indexes (and their triggers) on `using` unless they exist.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        for index in INDEXES.values():
+            if connection.vendor == 'sqlite':
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [index['table']])
+                if cursor.fetchone():
+                    continue
+                statements = sqlite_statements(index)
+            elif connection.vendor == 'postgresql':
+                statements = postgresql_statements(index)
+            else:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query or '')[:MAX_TERMS]
+
+
+def match_expression(terms):
+    # Every term must match, each as a prefix: 'jo smi' finds 'John Smith'.
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def ranked_ids(index, physician, terms, limit, using='default'):
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        table, content = index['table'], index['model']._meta.db_table
+        weights = ', '.join(str(weight) for weight in index['weights'])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {table}.rowid FROM {table} JOIN {content} ON {content}.id = {table}.rowid "
+                f"WHERE {table} MATCH %s AND {content}.physician_id = %s "
+                f"ORDER BY bm25({table}, {weights}) LIMIT %s",
+                [match_expression(terms), physician.pk, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    condition = Q()
+    for term in terms:
+        condition &= Q(*[Q(**{f"{column}__icontains": term}) for column in index['columns']], _connector=Q.OR)
+    return list(index['model'].objects.using(using).filter(condition, physician=physician)
+                .order_by('id').values_list('id', flat=True)[:limit])
+
+
+def search(physician, query, kind, fields, limit):
+    """
+    The physician's rows of `kind` matching every term of `query`, best match first, as dicts of `fields`.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    index = INDEXES[kind]
+    ids = ranked_ids(index, physician, terms, limit)
+    rows = {row['id']: row for row in index['model'].objects.filter(id__in=ids).values(*fields)}
+    return [rows[pk] for pk in ids if pk in rows]
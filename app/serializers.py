@@ -1,5 +1,20 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import Patient, Physician
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from .authentication import VersionedRefreshToken
+from .jobs import job_statuses, volume_job_key
+from .models import Patient, Physician, UploadSession, VolumeMetadata
+from .nifti import NiftiError
+from .uploads import mri_sniffer
+
+def query_param_set(request, name):
+    if request is None:
+        return set()
+    params = getattr(request, 'query_params', request.GET)
+    return set(filter(None, params.get(name, '').split(',')))
+
+def expanded_fields(request):
+    return query_param_set(request, 'expand')
 
 class PhysicianSerializer(serializers.ModelSerializer):
     class Meta:
@@ -15,13 +30,118 @@ class PhysicianSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
+class VolumeMetadataSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = VolumeMetadata
+        fields = ('sha256', 'shape', 'spacing', 'dtype', 'affine', 'labels', 'tumor_volume_ml', 'computed_at')
+
 class PatientSerializer(serializers.ModelSerializer):
+    volume_metadata = VolumeMetadataSerializer(read_only=True)
+    processing = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
+
     class Meta:
         model = Patient
-        fields = ('id', 'first_name', 'last_name', 'email', 'dob', 'mri_file')  # Removed 'physician'
+        fields = ('id', 'first_name', 'last_name', 'email', 'dob', 'mri_file', 'volume_metadata', 'processing',
+                  'thumbnails')  # Removed 'physician'
+        # Only serialized when requested with ?expand=<name>[,<name>...]
+        expandable_fields = ('volume_metadata', 'processing', 'thumbnails')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        expand = expanded_fields(request)
+        for name in self.Meta.expandable_fields:
+            if name not in expand:
+                self.fields.pop(name)
+        # Sparse fieldsets: ?fields=id,last_name serializes only those fields on reads.
+        only = query_param_set(request, 'fields')
+        if only and request.method == 'GET':
+            for name in set(self.fields) - only - expand:
+                self.fields.pop(name)
+
+    def get_processing(self, obj):
+        # Background jobs for the current MRI file: {'state': ..., 'jobs': {kind: status}}.
+        # Looked up once for the whole list being serialized, not once per patient.
+        if not obj.mri_file:
+            return None
+        statuses = self.context.get('job_statuses')
+        if statuses is None:
+            patients = self.parent.instance if isinstance(self.parent, serializers.ListSerializer) else [obj]
+            statuses = self.context['job_statuses'] = job_statuses(
+                [volume_job_key(patient.mri_file.name) for patient in patients if patient.mri_file]
+            )
+        jobs = statuses.get(volume_job_key(obj.mri_file.name), {})
+        for state in ('failed', 'running', 'queued'):
+            if state in jobs.values():
+                return {'state': state, 'jobs': jobs}
+        return {'state': 'done', 'jobs': jobs}
+
+    def get_thumbnails(self, obj):
+        # Inline MIP previews ({plane: PNG data URI}) stored with the volume metadata, so a page
+        # of patients needs no file access; None until the metadata job has run.
+        metadata = getattr(obj, 'volume_metadata', None)
+        return (metadata.thumbnails or None) if metadata is not None else None
+
+    def validate_mri_file(self, value):
+        # NiftiUploadHandler normally checks the header while the upload streams in;
+        # otherwise only the start of the received file is inflated and checked here.
+        if not value:
+            return value
+        header = getattr(self.context.get('request'), 'nifti_upload_headers', {}).get('mri_file')
+        if header is None:
+            if value.size > settings.MRI_UPLOAD_MAX_BYTES:
+                raise serializers.ValidationError(f"File is larger than {settings.MRI_UPLOAD_MAX_BYTES} bytes")
+            sniffer = mri_sniffer()
+            try:
+                for chunk in value.chunks():
+                    if sniffer.feed(chunk) is not None:
+                        break
+                header = sniffer.finish()
+            except NiftiError as e:
+                raise serializers.ValidationError(str(e))
+            finally:
+                value.seek(0)
+        # Kept on the file so post-upload processing does not read the header again.
+        value.nifti_header = header
+        return value
+
+    def validate(self, attrs):
+        # Uploads skipped by NiftiUploadHandler never reach validate_mri_file.
+        error = getattr(self.context.get('request'), 'nifti_upload_errors', {}).get('mri_file')
+        if error:
+            raise serializers.ValidationError({'mri_file': [error]})
+        return attrs
 
     def create(self, validated_data):
         # Assuming 'request' is passed to the serializer's context in the view
         request = self.context.get('request')
         validated_data['physician'] = request.user
         return super().create(validated_data)
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'patient', 'filename', 'size', 'offset', 'sha256', 'status', 'created_at')
+        read_only_fields = ('id', 'patient', 'offset', 'status', 'created_at')
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('Size must be positive.')
+        if value > settings.MRI_UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(f"Size must be at most {settings.MRI_UPLOAD_MAX_BYTES} bytes.")
+        return value
+
+class BulkPatientSerializer(serializers.ModelSerializer):
+    # Per-item validation for the bulk endpoint; email uniqueness is checked for the whole
+    # batch with one query in app.bulk instead of one query per item.
+    id = serializers.IntegerField(required=False)
+
+    class Meta:
+        model = Patient
+        fields = ('id', 'first_name', 'last_name', 'email', 'dob')
+        extra_kwargs = {'email': {'validators': []}}
+
+
+class VersionedTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = VersionedRefreshToken
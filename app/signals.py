@@ -0,0 +1,164 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
+from django.dispatch import receiver
+
+from rest_framework.authtoken.models import Token
+
+from .authentication import forget_user, publish_user, revoke, token_cache
+from .jobs import enqueue_volume_jobs
+from .models import Patient, Physician, SecurePatientRecord, VolumeMetadata
+from .realtime import CREATED, DELETED, UPDATED, publish_patient_changes
+from .response_cache import bump_versions_on_commit
+from .search import install_search_indexes
+
+logger = logging.getLogger(__name__)
+
+# File fields backed by ContentAddressedStorage whose references are counted.
+BLOB_FIELDS = {
+    Patient: 'mri_file',
+    SecurePatientRecord: 'file_path',
+}
+
+
+@receiver(pre_save, sender=Patient)
+@receiver(pre_save, sender=SecurePatientRecord)
+def remember_previous_blob(sender, instance, **kwargs):
+    field_name = BLOB_FIELDS[sender]
+    previous = None
+    if not instance._state.adding and instance.pk is not None:
+        previous = sender.objects.filter(pk=instance.pk).values_list(field_name, flat=True).first()
+    instance._previous_blob = previous or None
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_save, sender=SecurePatientRecord)
+def count_blob_references(sender, instance, **kwargs):
+    field = instance._meta.get_field(BLOB_FIELDS[sender])
+    previous = getattr(instance, '_previous_blob', None)
+    current = getattr(instance, field.attname).name or None
+    # Names stored through the field already carry a reference taken by storage.save().
+    saved = instance.__dict__.pop('_saved_blobs', [])
+    held = current in saved
+    if held:
+        saved.remove(current)
+    for name in saved:  # Replaced before the row was saved.
+        transaction.on_commit(lambda name=name: field.storage.release(name))
+    if previous == current:
+        if held:  # The row already held a reference to this blob.
+            transaction.on_commit(lambda: field.storage.release(current))
+        return
+    if current and not held:
+        field.storage.acquire(current)
+    if previous:
+        transaction.on_commit(lambda: field.storage.release(previous))
+
+
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=SecurePatientRecord)
+def release_blob(sender, instance, **kwargs):
+    field = instance._meta.get_field(BLOB_FIELDS[sender])
+    name = getattr(instance, field.attname).name
+    if name:
+        transaction.on_commit(lambda: field.storage.release(name))
+
+
+@receiver(pre_save, sender=Patient)
+def remember_upload_header(sender, instance, **kwargs):
+    # Uploads arrive with the NIfTI header parsed while they streamed in (see app.uploads).
+    # An uploaded file is only reachable until the field commits it during this save;
+    # code that stores the file itself sets instance._nifti_header instead.
+    fieldfile = instance.mri_file
+    if fieldfile and not fieldfile._committed and hasattr(fieldfile.file, 'nifti_header'):
+        instance._nifti_header = fieldfile.file.nifti_header
+
+
+@receiver(post_save, sender=Patient)
+def process_new_volume(sender, instance, **kwargs):
+    # Derived data (volumetrics, brick pyramid, sparse label map, meshes) is rebuilt by
+    # background jobs whenever the MRI file changes. The jobs are queued in this
+    # transaction, so workers only see them once the new file is committed.
+    header = instance.__dict__.pop('_nifti_header', None)
+    if (instance.mri_file.name or None) == getattr(instance, '_previous_blob', None):
+        return
+    if not instance.mri_file:
+        VolumeMetadata.objects.filter(patient=instance).delete()
+        return
+    enqueue_volume_jobs(instance.mri_file.name, header)
+
+
+@receiver(post_migrate)
+def create_search_indexes(sender, using, **kwargs):
+    # The FTS5 tables are not models, so they are (re)created here after every migrate.
+    if sender.name == 'app':
+        install_search_indexes(using)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+@receiver(post_save, sender=SecurePatientRecord)
+@receiver(post_delete, sender=SecurePatientRecord)
+def invalidate_physician_responses(sender, instance, **kwargs):
+    bump_versions_on_commit([instance.physician_id])
+
+
+@receiver(post_save, sender=VolumeMetadata)
+def invalidate_volume_metadata_responses(sender, instance, **kwargs):
+    bump_versions_on_commit(Patient.objects.filter(pk=instance.patient_id).values_list('physician_id', flat=True))
+
+
+@receiver(post_save, sender=Physician)
+def invalidate_physician_info(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return  # Every login saves last_login; nothing the cached responses show.
+    bump_versions_on_commit([instance.pk])
+
+
+@receiver(pre_save, sender=Physician)
+def bump_token_version(sender, instance, update_fields=None, **kwargs):
+    # A password change or deactivation revokes every token issued before it.
+    if instance.__dict__.pop('_password_rehash', False):
+        return  # Same password re-hashed with current parameters by the login backend.
+    if instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and not {'password', 'is_active'} & set(update_fields):
+        return
+    previous = sender.objects.filter(pk=instance.pk).values('password', 'is_active', 'token_version').first()
+    if previous is None:
+        return
+    if previous['password'] != instance.password or (previous['is_active'] and not instance.is_active):
+        instance.token_version = previous['token_version'] + 1
+
+
+@receiver(post_save, sender=Physician)
+def publish_physician(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    transaction.on_commit(lambda: publish_user(instance))
+
+
+@receiver(post_delete, sender=Physician)
+def forget_physician(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: forget_user(pk))
+
+
+@receiver(post_delete, sender=Token)
+def revoke_deleted_token(sender, instance, **kwargs):
+    # Other processes may hold the token for up to AUTH_USER_CACHE_TTL seconds.
+    token_cache.discard(lambda key: key == instance.key)
+    revoke(instance.key, settings.AUTH_USER_CACHE_TTL)
+
+
+@receiver(post_save, sender=Patient)
+def publish_patient_save(sender, instance, created, **kwargs):
+    physician_id, change = instance.physician_id, (instance.pk, CREATED if created else UPDATED)
+    transaction.on_commit(lambda: publish_patient_changes(physician_id, [change]))
+
+
+@receiver(post_delete, sender=Patient)
+def publish_patient_delete(sender, instance, **kwargs):
+    physician_id, change = instance.physician_id, (instance.pk, DELETED)
+    transaction.on_commit(lambda: publish_patient_changes(physician_id, [change]))
@@ -0,0 +1,209 @@
+import hashlib
+import io
+import os
+import posixpath
+import re
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.fields.files import FieldFile
+from django.utils.deconstruct import deconstructible
+
+from .encryption import EncryptedFile, encrypt_stream, is_encrypted, plaintext_size
+
+BLOCK_SIZE = 64 * 1024
+
+# Blob names look like 'mri_files/ab/ab12...ef.nii.gz': the upload_to directory, a
+# two-character fan-out directory and the sha256 of the content.
+BLOB_NAME_RE = re.compile(r'(?:^|/)[0-9a-f]{2}/(?P<sha256>[0-9a-f]{64})(?P<ext>\.[^/]*)?$')
+# Django's collision suffix turns 'seg.nii.gz' into 'seg.nii_1SStMcA.gz'.
+NIFTI_GZ_RE = re.compile(r'\.nii(_[A-Za-z0-9]{7})?\.gz$')
+
+
+def content_hash(name):
+    """
+    Return the sha256 a blob name was derived from, or None for legacy names.
+    """
+    match = BLOB_NAME_RE.search(name or '')
+    return match.group('sha256') if match else None
+
+
+def blob_extension(name):
+    if NIFTI_GZ_RE.search(name):
+        return '.nii.gz'
+    return os.path.splitext(name)[1].lower()
+
+
+def blob_name(directory, sha256, original_name):
+    return posixpath.join(directory, sha256[:2], sha256 + blob_extension(original_name))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that names files by the sha256 of their content.
+
+    Saving bytes that are already stored returns the existing name instead of
+    writing a second copy. StoredBlob keeps a reference count per name, which
+    app.signals maintains from the models that point at it; the file is only
+    removed once nothing refers to it.
+
+    save() itself takes a reference, under the same row lock release() uses, so a
+    concurrent release cannot remove the blob before the row that will point at it
+    is written. BlobFieldFile hands that reference over to the row.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The final name depends on the content, so there is nothing to pick here.
+        return name
+
+    def _save(self, name, content):
+        from .models import StoredBlob
+
+        directory = posixpath.dirname(name)
+        tmp_path, owned, sha256, size = self._receive(directory, content)
+        name = blob_name(directory, sha256, name)
+        full_path = self.path(name)
+        with transaction.atomic():
+            blob, _ = StoredBlob.objects.select_for_update().get_or_create(
+                name=name, defaults={'sha256': sha256, 'size': size})
+            if os.path.exists(full_path):
+                if owned:
+                    os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                file_move_safe(tmp_path, full_path)
+                if self.file_permissions_mode is not None:
+                    os.chmod(full_path, self.file_permissions_mode)
+            StoredBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+        return name
+
+    def _receive(self, directory, content):
+        # Returns (path of the bytes to store, whether that file is ours to move, sha256, size).
+        if hasattr(content, 'temporary_file_path'):
+            tmp_path = content.temporary_file_path()
+            return (tmp_path, False) + self._hash_file(tmp_path)
+        tmp_path, sha256, size = self._spool(directory, content)
+        return tmp_path, True, sha256, size
+
+    def _spool(self, directory, content):
+        # Stream the upload to a temporary file next to its destination while hashing,
+        # so the final move is a rename on the same filesystem.
+        tmp_dir = self.path(directory)
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest, size = hashlib.sha256(), 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp:
+            if hasattr(content, 'seek'):
+                content.seek(0)
+            for chunk in content.chunks(BLOCK_SIZE):
+                tmp.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        return tmp_path, digest.hexdigest(), size
+
+    def _hash_file(self, path):
+        digest, size = hashlib.sha256(), 0
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                digest.update(block)
+                size += len(block)
+        return digest.hexdigest(), size
+
+    def delete(self, name):
+        from .models import StoredBlob
+
+        with transaction.atomic():
+            blob = StoredBlob.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                super().delete(name)
+            elif blob.ref_count <= 0:
+                blob.delete()
+                super().delete(name)
+            # Otherwise other rows still point at the blob; release() removes it later.
+
+    def acquire(self, name):
+        from .models import StoredBlob
+
+        sha256 = content_hash(name)
+        if sha256 is None:
+            return  # Legacy names are not tracked until dedupe_files folds them into blobs.
+        with transaction.atomic():
+            blob = StoredBlob.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                StoredBlob.objects.create(name=name, sha256=sha256, size=self.size(name), ref_count=1)
+            else:
+                StoredBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+
+    def release(self, name):
+        from .models import StoredBlob
+
+        with transaction.atomic():
+            StoredBlob.objects.filter(name=name, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+            blob = StoredBlob.objects.select_for_update().filter(name=name).first()
+            if blob is None or blob.ref_count > 0:
+                return
+            blob.delete()
+            # Still under the row lock, so a concurrent save() either sees the row
+            # gone and moves its own copy into place, or waits for this to finish.
+            super().delete(name)
+
+
+content_addressed_storage = ContentAddressedStorage()
+
+
+class BlobFieldFile(FieldFile):
+    def save(self, name, content, save=True):
+        super().save(name, content, save=False)
+        # storage.save() took a reference for the new name; app.signals hands it to
+        # the row when it is saved rather than taking a second one.
+        self.instance.__dict__.setdefault('_saved_blobs', []).append(self.name)
+        if save:
+            self.instance.save()
+
+    save.alters_data = True
+
+
+class BlobFileField(models.FileField):
+    # FileField for ContentAddressedStorage; see BlobFieldFile.
+    attr_class = BlobFieldFile
+
+
+@deconstructible
+class EncryptedContentAddressedStorage(ContentAddressedStorage):
+    """
+    Content-addressed storage that keeps files encrypted at rest (see app.encryption).
+
+    Uploads are encrypted chunk by chunk as they stream in; names still come from
+    the sha256 of the plaintext, so identical records are stored once. open() and
+    size() see the plaintext. Files written before encryption was enabled are
+    served as they are until `manage.py encrypt_records` has run.
+    """
+
+    def _receive(self, directory, content):
+        tmp_dir = self.path(directory)
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp:
+            if hasattr(content, 'seek'):
+                content.seek(0)
+            sha256, size = encrypt_stream(content.chunks(settings.RECORD_ENCRYPTION_CHUNK_SIZE), tmp)
+        return tmp_path, True, sha256, size
+
+    def _open(self, name, mode='rb'):
+        path = self.path(name)
+        if 'r' not in mode or '+' in mode or not is_encrypted(path):
+            return super()._open(name, mode)
+        return File(io.BufferedReader(EncryptedFile(path), buffer_size=BLOCK_SIZE), name)
+
+    def size(self, name):
+        path = self.path(name)
+        return plaintext_size(path) if is_encrypted(path) else super().size(name)
+
+
+encrypted_storage = EncryptedContentAddressedStorage()
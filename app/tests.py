@@ -1,9 +1,70 @@
+import base64
+import gzip
+import io
+import json
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import FileResponse, HttpRequest
+from django.test import override_settings
+from django.utils import timezone
+from django.core import mail
 from django.urls import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
-from django.contrib.auth import get_user_model
-from .models import Patient
+from rest_framework.authtoken.models import Token
+from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth.hashers import make_password, verify_password
+from .authentication import VersionedRefreshToken, token_cache, user_cache
+from .realtime import JWTAuthMiddleware
+from .routing import websocket_urlpatterns
+from .views import NotificationConsumer
+from .throttling import LoginEmailRateThrottle
+from .derived import build_once
+from .encryption import MAGIC, CorruptRecord, EncryptedFile, decode_key, file_key_id, is_encrypted, iter_decrypted_range, key_id
+from .jobs import HANDLERS, claim, enqueue, enqueue_volume_jobs
+from .models import Job, OutboundEmail, Patient, SecurePatientRecord, StoredBlob, UploadSession, VolumeMetadata
 from rest_framework_simplejwt.tokens import RefreshToken
+from .labelmap import NotALabelMap, decode_label_map, encode_label_map, encode_runs
+from .meshes import extract_surface, read_mesh_index, write_meshes
+from .render import downsample_max, extract_slice, mip_thumbnails, slice_cache
+from .nifti import HeaderSniffer, NiftiError
+from .pyramid import read_index, write_pyramid
+from .passwords import HashingPoolBusy, hashing_pool
+from .ranges import MAX_RANGES
+from .storage import ContentAddressedStorage, content_hash
+from .uploads import part_path
+from .volume_cache import VolumeCache
+from .volumetrics import metadata_fields
+
+
+def make_nifti(array, spacing=(1.0, 1.0, 1.0)):
+    # Build a gzipped NIfTI-1 file for a 3D (or 4D) float32 label volume.
+    header = bytearray(352)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, array.ndim, *array.shape, *(1,) * (7 - array.ndim))
+    struct.pack_into('<2h', header, 70, 16, 32)
+    struct.pack_into('<8f', header, 76, 1.0, *spacing, 0, 0, 0, 0)
+    struct.pack_into('<3f', header, 108, 352.0, 1.0, 0.0)
+    header[344:348] = b'n+1\x00'
+    return gzip.compress(bytes(header) + array.astype('<f4').tobytes(order='F'))
 
 class PhysicianPatientAPITests(APITestCase):
     @classmethod
@@ -129,16 +190,1159 @@ class PhysicianPatientAPITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
     # New Test for sending URL via email
-    @patch('django.core.mail.send_mail')
-    def test_send_patient_info_link(self, mock_send_mail):
+    def test_send_patient_info_link(self):
         self.client.force_authenticate(user=self.physician1)
         url = reverse('send-patient-info', args=[self.patient1.id])
         response = self.client.post(url)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
-        mock_send_mail.assert_called_once_with(
-            'Your Patient Information',
-            'Please review your information here: http://localhost:3000/patient-info',
-            'no-reply@example.com',
-            [self.patient1.email],
-            fail_silently=False,
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        queued = OutboundEmail.objects.get(patient=self.patient1)
+        self.assertEqual((queued.to, queued.subject), (self.patient1.email, 'Your Patient Information'))
+
+
+TEST_RECORD_KEY = base64.b64encode(b'test record encryption key 32 b!').decode()
+
+
+class MediaAPITestCase(APITestCase):
+    # Runs each test against a throwaway MEDIA_ROOT and cache directories.
+    physician_email = 'media@example.com'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.physician = get_user_model().objects.create_user(
+            email=cls.physician_email,
+            password='Testpass123',
+            first_name='Media',
+            last_name='Physician'
+        )
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            CHUNKED_UPLOAD_DIR=os.path.join(self.media_root, 'upload_sessions'),
+            VOLUME_CACHE_DIR=os.path.join(self.media_root, 'volume_cache'),
+            PYRAMID_DIR=os.path.join(self.media_root, 'pyramids'),
+            MESH_DIR=os.path.join(self.media_root, 'meshes'),
+            LABELMAP_DIR=os.path.join(self.media_root, 'labelmaps'),
+            RECORD_ENCRYPTION_KEY=TEST_RECORD_KEY,
+            RECORD_ENCRYPTION_OLD_KEYS=[],
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'responses': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'responses'},
+                'auth': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'auth'},
+                'throttle': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'throttle'},
+            },
         )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(caches['responses'].clear)
+        self.addCleanup(caches['auth'].clear)
+        self.addCleanup(caches['throttle'].clear)
+        self.addCleanup(user_cache.clear)
+        self.addCleanup(token_cache.clear)
+        self.client.force_authenticate(user=self.physician)
+
+    def make_patient(self, email, labels=None, content=None):
+        patient = Patient.objects.create(
+            physician=self.physician, first_name='Test', last_name='Patient', email=email, dob='1980-01-01'
+        )
+        if labels is not None:
+            content = make_nifti(labels)
+        if content is not None:
+            patient.mri_file.save('seg.nii.gz', ContentFile(content), save=True)
+        return patient
+
+    def run_jobs(self):
+        # Post-upload processing runs on the job queue; drain it in this process.
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('run_workers', '--once', '--concurrency', '1', stdout=io.StringIO())
+
+
+def make_labels():
+    labels = np.zeros((8, 6, 4), dtype=np.float32)
+    labels[2:4, 1:3, 1] = 2
+    labels[3, 2, 2] = 1
+    return labels
+
+
+class ChunkedUploadAPITests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = self.make_patient('scan@example.com')
+        self.payload = make_nifti(np.random.default_rng(0).random((40, 40, 32)))
+
+    def open_session(self):
+        url = reverse('patient-upload-session', args=[self.patient.id])
+        data = {'filename': 'study.nii.gz', 'size': len(self.payload), 'sha256': hashlib.sha256(self.payload).hexdigest()}
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+    def put_chunk(self, session_id, start, end, checksum=None):
+        chunk = self.payload[start:end]
+        return self.client.put(
+            reverse('upload-session-detail', args=[session_id]),
+            data=chunk,
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes {start}-{end - 1}/{len(self.payload)}',
+            HTTP_X_CHUNK_SHA256=checksum or hashlib.sha256(chunk).hexdigest(),
+        )
+
+    def test_chunked_upload_resume_and_commit(self):
+        session_id = self.open_session()
+        self.assertEqual(self.put_chunk(session_id, 0, 100 * 1024).data['offset'], 100 * 1024)
+
+        # A corrupted chunk is rejected and the offset stays at the last good byte.
+        response = self.put_chunk(session_id, 100 * 1024, len(self.payload), checksum='0' * 64)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('upload-session-detail', args=[session_id]))
+        self.assertEqual(response.data['offset'], 100 * 1024)
+
+        response = self.put_chunk(session_id, 0, 1024)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        self.assertEqual(self.put_chunk(session_id, 100 * 1024, len(self.payload)).status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('upload-session-commit', args=[session_id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Job.objects.get(kind='volume.metadata').payload['header']['shape'], [40, 40, 32])
+
+        self.patient.refresh_from_db()
+        with self.patient.mri_file.open('rb') as f:
+            self.assertEqual(f.read(), self.payload)
+        self.assertEqual(UploadSession.objects.get(pk=session_id).status, UploadSession.STATUS_COMMITTED)
+
+    def test_offset_is_rechecked_under_the_session_lock(self):
+        session_id = self.open_session()
+        stale = UploadSession.objects.get(pk=session_id)
+        self.assertEqual(self.put_chunk(session_id, 0, 1024).status_code, status.HTTP_200_OK)
+        # A duplicate PUT that read the session before the first one finished.
+        with patch('app.views.UploadSessionDetailView.get_object', return_value=stale):
+            response = self.put_chunk(session_id, 0, 1024)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], 1024)
+        self.assertEqual(os.path.getsize(part_path(stale)), 1024)
+
+    def test_session_deleted_while_waiting_for_the_lock(self):
+        session_id = self.open_session()
+        stale = UploadSession.objects.get(pk=session_id)
+        self.assertEqual(self.client.delete(reverse('upload-session-detail', args=[session_id])).status_code,
+                         status.HTTP_204_NO_CONTENT)
+        with patch('app.views.UploadSessionDetailView.get_object', return_value=stale):
+            self.assertEqual(self.put_chunk(session_id, 0, 1024).status_code, status.HTTP_404_NOT_FOUND)
+
+        self.assertTrue(os.path.exists(os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{session_id}.lock")))
+        call_command('clean_upload_locks', stdout=io.StringIO())
+        self.assertFalse(os.path.exists(os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{session_id}.lock")))
+
+    def test_commit_incomplete_upload(self):
+        session_id = self.open_session()
+        self.put_chunk(session_id, 0, 1024)
+        response = self.client.post(reverse('upload-session-commit', args=[session_id]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], 1024)
+
+
+class ContentAddressedStorageTests(MediaAPITestCase):
+    def test_identical_uploads_share_one_blob(self):
+        first = self.make_patient('first@example.com', content=b'identical volume bytes')
+        second = self.make_patient('second@example.com', content=b'identical volume bytes')
+        self.assertEqual(first.mri_file.name, second.mri_file.name)
+        digest = hashlib.sha256(b'identical volume bytes').hexdigest()
+        self.assertEqual(first.mri_file.name, f"mri_files/{digest[:2]}/{digest}.nii.gz")
+        self.assertEqual(StoredBlob.objects.get(name=first.mri_file.name).ref_count, 2)
+
+        path = first.mri_file.path
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(StoredBlob.objects.exists())
+
+    def test_save_holds_a_reference_until_the_row_takes_it(self):
+        first = self.make_patient('first@example.com', content=b'shared volume bytes')
+        second = self.make_patient('second@example.com')
+        second.mri_file.save('scan.nii.gz', ContentFile(b'shared volume bytes'), save=False)
+        blob = StoredBlob.objects.get(name=first.mri_file.name)
+        self.assertEqual(blob.ref_count, 2)
+
+        # The only saved row lets go of the blob before the second row is written.
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(os.path.exists(second.mri_file.path))
+        call_command('dedupe_files', '--prune', stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertTrue(os.path.exists(second.mri_file.path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.save()
+        self.assertEqual(StoredBlob.objects.get(name=second.mri_file.name).ref_count, 1)
+
+    def test_saving_the_same_content_again_keeps_one_reference(self):
+        patient = self.make_patient('same@example.com', content=b'unchanged volume bytes')
+        with self.captureOnCommitCallbacks(execute=True):
+            patient.mri_file.save('again.nii.gz', ContentFile(b'unchanged volume bytes'))
+        self.assertEqual(StoredBlob.objects.get(name=patient.mri_file.name).ref_count, 1)
+
+
+class BuildOnceTests(MediaAPITestCase):
+    def test_concurrent_callers_build_once(self):
+        path = os.path.join(self.media_root, 'derived', 'artifact.bin')
+        calls = []
+
+        def write(tmp_path):
+            calls.append(tmp_path)
+            time.sleep(0.05)
+            with open(tmp_path, 'wb') as f:
+                f.write(b'artifact')
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            results = list(pool.map(lambda _: build_once(path, write), range(3)))
+        self.assertEqual(results, [path] * 3)
+        self.assertEqual(len(calls), 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'artifact')
+
+
+class VolumeCacheTests(MediaAPITestCase):
+    def test_volume_is_inflated_once_and_memory_mapped(self):
+        labels = make_labels()
+        patient = self.make_patient('vol@example.com', labels=labels)
+
+        cache = VolumeCache()
+        volume = cache.get(patient.mri_file)
+        self.assertIsInstance(volume, np.memmap)
+        np.testing.assert_array_equal(volume, labels)
+        with patch('app.volume_cache.open_volume') as mock_open_volume:
+            np.testing.assert_array_equal(cache.get(patient.mri_file), labels)
+        mock_open_volume.assert_not_called()
+
+    def test_concurrent_first_reads_inflate_once(self):
+        patient = self.make_patient('race@example.com', labels=make_labels())
+        cache = VolumeCache()
+        inflate, calls = cache._inflate, []
+
+        def slow_inflate(stream, path):
+            calls.append(path)
+            time.sleep(0.05)
+            inflate(stream, path)
+
+        with patch.object(cache, '_inflate', side_effect=slow_inflate):
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                volumes = list(pool.map(lambda _: cache.get(patient.mri_file), range(3)))
+        self.assertEqual(len(calls), 1)
+        for volume in volumes:
+            np.testing.assert_array_equal(volume, make_labels())
+
+
+class MRISliceAPITests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        slice_cache.clear()
+        self.patient = self.make_patient('slice@example.com', labels=make_labels())
+        self.url = reverse('patient-mri-slice', args=[self.patient.id])
+
+    def test_png_slice_with_etag(self):
+        response = self.client.get(self.url, {'axis': 'axial', 'index': 1, 'format': 'png'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response.content.startswith(b'\x89PNG'))
+
+        response = self.client.get(self.url, {'axis': 'axial', 'index': 1, 'format': 'png'},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_raw_slice(self):
+        response = self.client.get(self.url, {'axis': 'axial', 'index': 1, 'format': 'raw'})
+        self.assertEqual(response['X-Slice-Shape'], '6,8')
+        plane = np.frombuffer(response.content, dtype=np.uint8).reshape(6, 8)
+        np.testing.assert_array_equal(plane, np.flipud(make_labels()[:, :, 1].T))
+
+    def test_slice_index_out_of_range(self):
+        response = self.client.get(self.url, {'axis': 'axial', 'index': 4})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MRIPyramidAPITests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.labels = np.zeros((40, 36, 20), dtype=np.float32)
+        self.labels[30:34, 4:8, 2:6] = 3
+        self.patient = self.make_patient('pyramid@example.com', labels=self.labels)
+
+    def test_pyramid_index_and_brick_access(self):
+        index = self.client.get(reverse('patient-mri-pyramid', args=[self.patient.id])).data
+        self.assertEqual([level['factor'] for level in index['levels']], [1, 2, 4, 8])
+        self.assertEqual(index['levels'][1]['shape'], [20, 18, 10])
+        bricks = {tuple(brick[:4]): brick[4:] for brick in index['bricks']}
+
+        data_url = reverse('patient-mri-pyramid-data', args=[self.patient.id])
+        offset, length = bricks[(0, 0, 0, 0)]
+        response = self.client.get(data_url, HTTP_RANGE=f'bytes={offset}-{offset + length - 1}')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        brick = np.frombuffer(zlib.decompress(b''.join(response.streaming_content)), dtype=np.uint8)
+        np.testing.assert_array_equal(brick.reshape(32, 32, 20, order='F'), self.labels[:32, :32, :])
+
+        response = self.client.get(data_url, {'bricks': '3/0/0/0,0/1/0/0'})
+        lengths = [int(n) for n in response['X-Brick-Lengths'].split(',')]
+        coarse = np.frombuffer(zlib.decompress(response.content[:lengths[0]]), dtype=np.uint8)
+        self.assertEqual(coarse.reshape(5, 5, 3, order='F')[3, 0, 0], 3)
+
+    def test_4d_series_and_wide_labels_keep_their_values(self):
+        series = np.zeros((40, 36, 20, 2), dtype=np.float32)
+        series[30:34, 4:8, 2:6, 0] = 300
+        patient = self.make_patient('pyramid-4d@example.com', labels=series)
+        index = self.client.get(reverse('patient-mri-pyramid', args=[patient.id])).data
+        self.assertEqual(index['dtype'], '<u2')
+        self.assertEqual(index['levels'][0]['shape'], [40, 36, 20])
+
+        with tempfile.NamedTemporaryFile() as tmp:
+            write_pyramid(np.linspace(-1, 1, 8 * 6 * 4, dtype='>f4').reshape(8, 6, 4), tmp.name)
+            self.assertEqual(read_index(tmp.name)['dtype'], '<f4')
+
+
+class VolumeMetadataTests(MediaAPITestCase):
+    def test_metadata_computed_on_upload_and_expanded(self):
+        patient = self.make_patient('meta@example.com', labels=make_labels())
+        self.run_jobs()
+        metadata = VolumeMetadata.objects.get(patient=patient)
+        self.assertEqual(metadata.shape, [8, 6, 4])
+        self.assertEqual(metadata.labels['2']['voxels'], 4)
+        self.assertEqual(metadata.labels['2']['bbox'], [[2, 1, 1], [3, 2, 1]])
+        self.assertEqual(metadata.labels['1']['centroid'], [3.0, 2.0, 2.0])
+        self.assertAlmostEqual(metadata.tumor_volume_ml, 0.005)
+
+        url = reverse('physician-patient-list')
+        self.assertNotIn('volume_metadata', self.client.get(url).data[0])
+        response = self.client.get(url, {'expand': 'volume_metadata'})
+        self.assertEqual(response.data[0]['volume_metadata']['labels']['1']['voxels'], 1)
+
+    def test_intensity_volume_records_header_without_labels(self):
+        intensities = np.linspace(-500, 1200, 8 * 6 * 4, dtype=np.float32).reshape(8, 6, 4)
+        patient = self.make_patient('t1@example.com', labels=intensities)
+        self.run_jobs()
+        metadata = VolumeMetadata.objects.get(patient=patient)
+        self.assertEqual(metadata.shape, [8, 6, 4])
+        self.assertEqual(metadata.labels, {})
+        self.assertEqual(metadata.tumor_volume_ml, 0)
+        self.assertEqual(Job.objects.get(kind='volume.metadata').status, Job.STATUS_DONE)
+
+
+class AnalyzeVolumesCommandTests(MediaAPITestCase):
+    def test_analyzes_each_study_once_and_skips_unchanged(self):
+        other_labels = make_labels()
+        other_labels[0, 0, 0] = 3
+        patients = [
+            self.make_patient('a@example.com', labels=make_labels()),
+            self.make_patient('b@example.com', labels=make_labels()),
+            self.make_patient('c@example.com', labels=other_labels),
+        ]
+        out = io.StringIO()
+        call_command('analyze_volumes', workers=2, batch_size=2, stdout=out)
+        self.assertIn('Analyzed 3, skipped 0 unchanged', out.getvalue())
+        self.assertEqual(VolumeMetadata.objects.get(patient=patients[2]).labels['3']['voxels'], 1)
+
+        out = io.StringIO()
+        call_command('analyze_volumes', workers=2, physician=self.physician.email, stdout=out)
+        self.assertIn('Analyzed 0, skipped 3 unchanged', out.getvalue())
+
+
+class MeshTests(MediaAPITestCase):
+    def test_single_voxel_surface_is_a_closed_cube(self):
+        mask = np.zeros((3, 3, 3), dtype=bool)
+        mask[1, 1, 1] = True
+        vertices, triangles = extract_surface(mask)
+        self.assertEqual(len(vertices), 8)
+        self.assertEqual(len(triangles), 12)
+        # Outward winding: the face on the +x side has a normal pointing along +x.
+        v0, v1, v2 = vertices[triangles].astype(float)[np.argmax(vertices[triangles][:, :, 0].min(axis=1))]
+        self.assertGreater(np.cross(v1 - v0, v2 - v0)[0], 0)
+
+    def test_mesh_endpoint_keyed_by_content_hash(self):
+        patient = self.make_patient('mesh@example.com', labels=make_labels())
+        self.run_jobs()
+        sha256 = patient.volume_metadata.sha256
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('mesh', args=[sha256]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = b''.join(response.streaming_content)
+        self.assertEqual(content[:8], b'NMMESH01')
+        (length,) = struct.unpack('<I', content[8:12])
+        index = json.loads(content[12:12 + length])
+        self.assertEqual([entry['label'] for entry in index['labels']], [1, 2])
+        self.assertEqual(index['labels'][0]['lods'][0]['triangle_count'], 12)
+
+        self.assertEqual(self.client.get(reverse('mesh', args=['0' * 64])).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_4d_series_meshes_come_from_the_first_frame(self):
+        series = np.zeros((8, 6, 4, 2), dtype=np.float32)
+        series[3, 2, 2, 0] = 1
+        series[..., 1] = 2
+        with tempfile.NamedTemporaryFile() as tmp:
+            write_meshes(series, {'spacing': [1.0, 1.0, 1.0, 1.0], 'affine': None}, tmp.name)
+            index = read_mesh_index(tmp.name)
+        self.assertEqual([entry['label'] for entry in index['labels']], [1])
+        self.assertEqual(index['labels'][0]['lods'][0]['triangle_count'], 12)
+
+
+class SparseLabelMapTests(MediaAPITestCase):
+    def test_runs_break_at_label_changes_and_rows(self):
+        volume = np.zeros((4, 2, 1), dtype=np.float32)
+        volume[1:4, 0, 0] = [1, 1, 2]
+        volume[0, 1, 0] = 2
+        starts, lengths, labels = encode_runs(volume)
+        self.assertEqual(starts.tolist(), [1, 3, 4])
+        self.assertEqual(lengths.tolist(), [2, 1, 1])
+        self.assertEqual(labels.tolist(), [1, 2, 2])
+
+    def test_endpoint_round_trip(self):
+        patient = self.make_patient('sparse@example.com', labels=make_labels())
+        response = self.client.get(reverse('patient-mri-labels', args=[patient.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        decoded = decode_label_map(b''.join(response.streaming_content))
+        np.testing.assert_array_equal(decoded, make_labels().astype(np.uint8))
+
+    def test_wide_labels_and_4d_series(self):
+        series = np.zeros((4, 3, 2, 2), dtype=np.int16)
+        series[1, 1, 1, 0] = 256
+        series[2, 0, 0, 0] = 3
+        series[..., 1] = 7
+        decoded = decode_label_map(encode_label_map(series))
+        self.assertEqual(decoded.dtype, np.uint16)
+        np.testing.assert_array_equal(decoded, series[..., 0])
+
+        with self.assertRaises(NotALabelMap):
+            encode_runs(np.full((2, 2, 2), -1, dtype=np.int16))
+        patient = self.make_patient('sparse-t1@example.com', labels=np.linspace(-1, 1, 24, dtype=np.float32).reshape(4, 3, 2))
+        response = self.client.get(reverse('patient-mri-labels', args=[patient.id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MRIRegionAPITests(MediaAPITestCase):
+    def read_roi(self, response):
+        (length,) = struct.unpack('<I', response.content[8:12])
+        header = json.loads(response.content[12:12 + length])
+        data = np.frombuffer(response.content[12 + length:], dtype=header['dtype'])
+        return header, data.reshape(header['shape'], order='F')
+
+    def test_crop_to_label_with_margin(self):
+        patient = self.make_patient('roi@example.com', labels=make_labels())
+        response = self.client.get(reverse('patient-mri-roi', args=[patient.id]), {'label': 2, 'margin': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        header, crop = self.read_roi(response)
+        self.assertEqual(header['offset'], [1, 0, 0])
+        np.testing.assert_array_equal(crop, make_labels()[1:5, 0:4, 0:3])
+
+    def test_crop_uses_precomputed_bounds_and_explicit_bounds(self):
+        patient = self.make_patient('roi2@example.com', labels=make_labels())
+        self.run_jobs()
+        url = reverse('patient-mri-roi', args=[patient.id])
+        with patch('app.views.label_bounds') as mock_label_bounds:
+            header, crop = self.read_roi(self.client.get(url))
+        mock_label_bounds.assert_not_called()
+        self.assertEqual(header['shape'], [2, 2, 2])
+
+        header, crop = self.read_roi(self.client.get(url, {'bounds': '0,0,0,8,6,1'}))
+        self.assertEqual(header['shape'], [8, 6, 1])
+
+    def test_crop_of_4d_series_keeps_every_frame(self):
+        series = np.stack([make_labels(), make_labels() * 0 + 1], axis=3)
+        patient = self.make_patient('roi-4d@example.com', labels=series)
+        response = self.client.get(reverse('patient-mri-roi', args=[patient.id]), {'label': 2, 'margin': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        header, crop = self.read_roi(response)
+        self.assertEqual(header['offset'], [1, 0, 0])
+        self.assertEqual(header['shape'], [4, 4, 3, 2])
+        np.testing.assert_array_equal(crop, series[1:5, 0:4, 0:3])
+
+
+class PatientListPaginationTests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        for i, last_name in enumerate(['Young', 'Adams', 'Moss', 'Adams', 'Baker']):
+            Patient.objects.create(physician=self.physician, first_name=f'P{i}', last_name=last_name,
+                                   email=f'p{i}@example.com', dob='1980-01-01')
+
+    def test_keyset_pages_by_name(self):
+        url = reverse('physician-patient-list')
+        response = self.client.get(url, {'ordering': 'name', 'page_size': 2})
+        names = [row['last_name'] for row in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            names += [row['last_name'] for row in response.data['results']]
+        self.assertEqual(names, ['Adams', 'Adams', 'Baker', 'Moss', 'Young'])
+
+    def test_sparse_fieldset_and_unpaginated_list(self):
+        url = reverse('physician-patient-list')
+        response = self.client.get(url, {'fields': 'id,last_name'})
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(set(response.data[0]), {'id', 'last_name'})
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('physician-patient-list'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_values_are_type_checked(self):
+        url = reverse('physician-patient-list')
+        for position, ordering in [({'id': {}}, 'id'), ({'id': '3'}, 'id'), ({'id': True}, 'id'),
+                                   ({'id': 2 ** 70}, 'id'), ({'last_name': 5, 'id': 1}, 'name'),
+                                   ({'last_name': 'Adams', 'id': None}, 'name')]:
+            cursor = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+            response = self.client.get(url, {'cursor': cursor, 'ordering': ordering})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, position)
+
+
+class PhysicianExportTests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = self.make_patient('export@example.com', labels=make_labels())
+        self.run_jobs()
+        SecurePatientRecord.objects.create(physician=self.physician, description='Follow-up', file_path='patient_records/a.pdf')
+
+    def test_ndjson_export(self):
+        response = self.client.get(reverse('physician-export'))
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['type'] for line in lines], ['patient', 'record'])
+        self.assertEqual(lines[0]['email'], 'export@example.com')
+        self.assertEqual(lines[0]['volume_metadata__labels']['2']['voxels'], 4)
+        self.assertEqual(lines[1]['description'], 'Follow-up')
+
+    def test_csv_export(self):
+        response = self.client.get(reverse('physician-export'), {'format': 'csv', 'table': 'records'})
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(rows[0], 'id,record_date,description,file_path')
+        self.assertEqual(len(rows), 2)
+
+
+class PatientBulkAPITests(MediaAPITestCase):
+    def test_bulk_create_reports_per_item_results(self):
+        Patient.objects.create(physician=self.physician, first_name='Old', last_name='Timer',
+                               email='taken@example.com', dob='1950-01-01')
+        items = [
+            {'first_name': 'A', 'last_name': 'One', 'email': 'a1@example.com', 'dob': '1990-01-01'},
+            {'first_name': 'B', 'last_name': 'Two', 'email': 'taken@example.com', 'dob': '1990-01-01'},
+            {'first_name': 'C', 'last_name': 'Three', 'email': 'a1@example.com', 'dob': '1990-01-01'},
+            {'first_name': 'D', 'last_name': 'Four', 'email': 'not-an-email', 'dob': '1990-01-01'},
+        ]
+        response = self.client.post(reverse('patient-bulk'), items, format='json')
+        self.assertEqual([r['status'] for r in response.data['results']], ['created', 'error', 'error', 'error'])
+        self.assertIn('email', response.data['results'][1]['errors'])
+        self.assertEqual(Patient.objects.get(id=response.data['results'][0]['id']).physician, self.physician)
+
+    def test_bulk_update_and_delete(self):
+        first = self.make_patient('u1@example.com')
+        second = self.make_patient('u2@example.com')
+        items = [{'id': first.id, 'last_name': 'Renamed'}, {'id': second.id, 'email': 'u1@example.com'}, {'id': 999}]
+        response = self.client.patch(reverse('patient-bulk'), items, format='json')
+        self.assertEqual([r['status'] for r in response.data['results']], ['updated', 'error', 'error'])
+        first.refresh_from_db()
+        self.assertEqual(first.last_name, 'Renamed')
+
+        response = self.client.delete(reverse('patient-bulk'), {'ids': [first.id, 999]}, format='json')
+        self.assertEqual([r['status'] for r in response.data['results']], ['deleted', 'error'])
+        self.assertFalse(Patient.objects.filter(id=first.id).exists())
+
+
+class SearchAPITests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = get_user_model().objects.create_user(email='other@example.com', first_name='O', last_name='Ther', password='pw')
+        Patient.objects.bulk_create([
+            Patient(physician=self.physician, first_name='Johanna', last_name='Smithers', email='jo@example.com', dob='1980-01-01'),
+            Patient(physician=self.physician, first_name='John', last_name='Baker', email='john.smith@example.com', dob='1980-01-01'),
+            Patient(physician=self.other, first_name='John', last_name='Smith', email='js@example.com', dob='1980-01-01'),
+        ])
+        SecurePatientRecord.objects.create(physician=self.physician, description='Glioblastoma resection follow-up',
+                                           file_path='patient_records/a.pdf')
+
+    def test_prefix_search_is_ranked_and_scoped(self):
+        response = self.client.get(reverse('search'), {'q': 'jo smith', 'type': 'patients'})
+        self.assertEqual(response.status_code, 200)
+        # A surname match ranks above an email match; the other physician's John Smith is not visible.
+        self.assertEqual([p['last_name'] for p in response.data['patients']], ['Smithers', 'Baker'])
+
+    def test_index_follows_updates_and_deletes(self):
+        patient = Patient.objects.get(email='jo@example.com')
+        Patient.objects.filter(pk=patient.pk).update(last_name='Walker')
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'walk'}).data['patients'][0]['id'], patient.id)
+        patient.delete()
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'walk'}).data['patients'], [])
+
+    def test_record_search(self):
+        response = self.client.get(reverse('search'), {'q': 'gliob'})
+        self.assertEqual(response.data['records'][0]['description'], 'Glioblastoma resection follow-up')
+        self.assertEqual(self.client.get(reverse('search')).status_code, 400)
+
+
+class VersionedResponseCacheTests(MediaAPITestCase):
+    def test_if_none_match_short_circuits_until_a_write(self):
+        patient = self.make_patient('cached@example.com')
+        url = reverse('physician-patient-list')
+        first = self.client.get(url)
+        etag = first['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data, first.data)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            patient.last_name = 'Changed'
+            patient.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data[0]['last_name'], 'Changed')
+
+    @override_settings(ALLOWED_HOSTS=['testserver', 'other.example.com'])
+    def test_cached_per_host_and_scheme(self):
+        self.make_patient('hosts@example.com', content=b'volume bytes')
+        url = reverse('physician-patient-list')
+        self.assertTrue(self.client.get(url).data[0]['mri_file'].startswith('http://testserver/'))
+        response = self.client.get(url, HTTP_HOST='other.example.com')
+        self.assertTrue(response.data[0]['mri_file'].startswith('http://other.example.com/'))
+        response = self.client.get(url, secure=True)
+        self.assertTrue(response.data[0]['mri_file'].startswith('https://testserver/'))
+
+    def test_bulk_writes_invalidate(self):
+        url = reverse('physician-patient-list')
+        etag = self.client.get(url)['ETag']
+        item = {'first_name': 'B', 'last_name': 'Ulk', 'email': 'bulk@example.com', 'dob': '1990-01-01'}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('patient-bulk'), [item], format='json')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([p['email'] for p in response.data], ['bulk@example.com'])
+
+
+class CachedAuthenticationTests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=None)
+        tokens = self.client.post(reverse('login'), {'email': self.physician_email, 'password': 'Testpass123'}).data
+        self.refresh = tokens['refresh']
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+
+    def test_warm_requests_skip_the_user_query(self):
+        url = reverse('physician-patient-list')
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_password_change_revokes_tokens(self):
+        self.assertEqual(self.client.get(reverse('physician-info')).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.physician.set_password('Newpass456')
+            self.physician.save()
+        self.assertEqual(self.client.get(reverse('physician-info')).status_code, 401)
+
+    def test_revoked_session_rejects_refreshed_access_tokens(self):
+        self.assertEqual(self.client.post(reverse('token_revoke')).status_code, 204)
+        self.assertEqual(self.client.get(reverse('physician-info')).status_code, 401)
+        access = self.client.post(reverse('token_refresh'), {'refresh': self.refresh}).data['access']
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {access}")
+        self.assertEqual(self.client.get(reverse('physician-info')).status_code, 401)
+
+    def test_revocations_survive_cache_eviction(self):
+        self.assertEqual(self.client.post(reverse('token_revoke')).status_code, 204)
+        caches[settings.AUTH_CACHE_ALIAS].clear()
+        self.assertEqual(self.client.get(reverse('physician-info')).status_code, 401)
+
+    def test_deleted_drf_token_is_denied(self):
+        token = Token.objects.create(user=self.physician)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        self.assertEqual(self.client.get(reverse('physician-info')).status_code, 200)
+        token.delete()
+        self.assertEqual(self.client.get(reverse('physician-info')).status_code, 401)
+        caches[settings.AUTH_CACHE_ALIAS].clear()
+        self.assertEqual(self.client.get(reverse('physician-info')).status_code, 401)
+
+
+class LoginHashingTests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=None)
+
+    def login(self, email, password):
+        return self.client.post(reverse('login'), {'email': email, 'password': password})
+
+    def test_every_attempt_costs_one_hash(self):
+        with patch('app.passwords.verify_password', wraps=verify_password) as verify:
+            for email, password in ((self.physician_email, 'wrong'), ('nobody@example.com', 'wrong')):
+                verify.reset_mock()
+                self.assertEqual(self.login(email, password).status_code, 401)
+                self.assertEqual(verify.call_count, 1)
+            verify.reset_mock()
+            self.assertEqual(self.client.post(reverse('token_obtain_pair'), {'email': self.physician_email, 'password': 'wrong'}).status_code, 401)
+            self.assertEqual(verify.call_count, 1)
+
+    def test_outdated_hash_is_upgraded_without_revoking_tokens(self):
+        get_user_model().objects.filter(pk=self.physician.pk).update(password=make_password('Testpass123', hasher='pbkdf2_sha1'))
+        self.assertEqual(self.login(self.physician_email, 'Testpass123').status_code, 200)
+        self.physician.refresh_from_db()
+        self.assertTrue(self.physician.password.startswith('pbkdf2_sha256$'))
+        self.assertEqual(self.physician.token_version, 0)
+
+    def test_attempts_per_email_are_throttled(self):
+        with patch.object(LoginEmailRateThrottle, 'THROTTLE_RATES', {'login_email': '2/min'}):
+            self.login(self.physician_email, 'wrong')
+            self.login(self.physician_email.upper(), 'wrong')
+            self.assertEqual(self.login(self.physician_email, 'Testpass123').status_code, 429)
+            caches[settings.AUTH_CACHE_ALIAS].clear()
+            self.assertEqual(self.login(self.physician_email, 'Testpass123').status_code, 429)
+            caches[settings.THROTTLE_CACHE_ALIAS].clear()
+            self.assertEqual(self.login(self.physician_email, 'Testpass123').status_code, 200)
+
+    async def test_async_login_awaits_the_hashing_pool(self):
+        url = reverse('async-login')
+        with patch.object(hashing_pool, 'run', side_effect=AssertionError('hashed on the request thread')), \
+                patch.object(hashing_pool, 'arun', wraps=hashing_pool.arun) as arun:
+            response = await self.async_client.post(url, {'email': self.physician_email, 'password': 'Testpass123'},
+                                                    content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('access', response.json())
+            response = await self.async_client.post(url, {'email': self.physician_email, 'password': 'wrong'},
+                                                    content_type='application/json')
+            self.assertEqual(response.status_code, 401)
+        self.assertEqual(arun.await_count, 2)
+
+    async def test_async_login_outside_pool_capacity_is_throttled(self):
+        with patch.object(hashing_pool, 'submit', side_effect=HashingPoolBusy):
+            response = await self.async_client.post(reverse('async-login'), {'email': self.physician_email, 'password': 'Testpass123'},
+                                                    content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+
+    def test_busy_pool_fails_non_drf_logins_quietly(self):
+        with patch.object(hashing_pool, 'submit', side_effect=HashingPoolBusy):
+            self.assertIsNone(authenticate(HttpRequest(), username=self.physician_email, password='Testpass123'))
+            self.assertEqual(self.login(self.physician_email, 'Testpass123').status_code, 429)
+
+
+class EmailOutboxTests(MediaAPITestCase):
+    def test_request_queues_and_worker_delivers(self):
+        patient = self.make_patient('outbox@example.com')
+        response = self.client.post(reverse('send-patient-info', args=[patient.id]))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(mail.outbox), 0)
+
+        call_command('send_outbox', '--once', stdout=io.StringIO())
+        self.assertEqual([m.to for m in mail.outbox], [['outbox@example.com']])
+        self.assertEqual(OutboundEmail.objects.get(patient=patient).status, OutboundEmail.STATUS_SENT)
+
+    def test_notify_all_and_retry_with_backoff(self):
+        for i in range(3):
+            self.make_patient(f'all{i}@example.com')
+        response = self.client.post(reverse('notify-all-patients'))
+        self.assertEqual(json.loads(response.content)['queued'], 3)
+
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('connection refused')):
+            call_command('send_outbox', '--once', stdout=io.StringIO())
+        # Failed messages are not due again until their backoff has passed.
+        self.assertEqual(set(OutboundEmail.objects.values_list('status', 'attempts')), {(OutboundEmail.STATUS_QUEUED, 1)})
+        call_command('send_outbox', '--once', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+
+        OutboundEmail.objects.update(next_attempt_at=timezone.now())
+        call_command('send_outbox', '--once', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend')
+    def test_batch_uses_one_smtp_connection(self):
+        for i in range(5):
+            self.make_patient(f'smtp{i}@example.com')
+        self.client.post(reverse('notify-all-patients'))
+        with patch('django.core.mail.backends.smtp.smtplib.SMTP') as smtp:
+            call_command('send_outbox', '--once', stdout=io.StringIO())
+        self.assertEqual(smtp.call_count, 1)
+        self.assertEqual(smtp.return_value.sendmail.call_count, 5)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.STATUS_SENT).count(), 5)
+
+    def test_bad_message_does_not_abort_the_batch(self):
+        for i in range(3):
+            self.make_patient(f'bad{i}@example.com')
+        self.client.post(reverse('notify-all-patients'))
+        bad = OutboundEmail.objects.order_by('id').first()
+        OutboundEmail.objects.filter(pk=bad.pk).update(subject='Injected\nBcc: someone@example.com')
+
+        call_command('send_outbox', '--once', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+        bad.refresh_from_db()
+        self.assertEqual(bad.status, OutboundEmail.STATUS_FAILED)
+        self.assertIn('BadHeaderError', bad.last_error)
+        self.assertFalse(OutboundEmail.objects.filter(status=OutboundEmail.STATUS_SENDING).exists())
+
+
+@override_settings(REALTIME_DEBOUNCE_SECONDS=0.05, REALTIME_MAX_DELAY_SECONDS=0.5)
+class RealtimeUpdateTests(MediaAPITestCase):
+    async def connect(self, application, path='/ws/patients/', user=None):
+        communicator = WebsocketCommunicator(application, path)
+        if user is not None:
+            communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_burst_of_edits_becomes_one_frame(self):
+        patient = await sync_to_async(self.make_patient)('live@example.com')
+        communicator, connected = await self.connect(NotificationConsumer.as_asgi(), user=self.physician)
+        self.assertTrue(connected)
+
+        def edit():
+            with self.captureOnCommitCallbacks(execute=True):
+                for i in range(100):
+                    patient.last_name = f'Edit {i}'
+                    patient.save()
+        await sync_to_async(edit)()
+
+        frame = await communicator.receive_json_from(timeout=2)
+        self.assertEqual(frame, {'type': 'patients.changed', 'patients': [{'id': patient.id, 'action': 'updated'}]})
+        self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+        await communicator.disconnect()
+
+    async def test_socket_requires_an_access_token(self):
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        _, connected = await self.connect(application)
+        self.assertFalse(connected)
+        token = VersionedRefreshToken.for_user(self.physician).access_token
+        communicator, connected = await self.connect(application, f'/ws/patients/?token={token}')
+        self.assertTrue(connected)
+        await communicator.disconnect()
+
+
+@override_settings(RECORD_ENCRYPTION_CHUNK_SIZE=16)
+class RecordEncryptionTests(MediaAPITestCase):
+    content = bytes(range(256)) * 3
+
+    def make_record(self, content=None):
+        record = SecurePatientRecord(physician=self.physician, description='Scan report')
+        record.file_path.save('report.pdf', ContentFile(self.content if content is None else content), save=True)
+        return record
+
+    def test_stored_encrypted_and_read_back(self):
+        record = self.make_record()
+        with open(record.file_path.path, 'rb') as f:
+            stored = f.read()
+        self.assertTrue(stored.startswith(MAGIC))
+        self.assertNotIn(self.content[:32], stored)
+        self.assertEqual(record.file_path.size, len(self.content))
+        with record.file_path.open('rb') as f:
+            f.seek(100)
+            self.assertEqual(f.read(50), self.content[100:150])
+        self.assertEqual(record.file_path.name, self.make_record().file_path.name)
+        self.assertEqual(self.make_record(b'').file_path.size, 0)
+
+    def test_range_request_decrypts_only_covering_chunks(self):
+        record = self.make_record()
+        url = reverse('secure-record', args=[record.id])
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        opened = []
+        original = EncryptedFile._open_chunk
+
+        def open_chunk(f, index, sealed):
+            opened.append(index)
+            return original(f, index, sealed)
+
+        with patch.object(EncryptedFile, '_open_chunk', open_chunk):
+            response = self.client.get(url, HTTP_RANGE='bytes=40-49')
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join(response.streaming_content), self.content[40:50])
+        self.assertEqual(opened, [2, 3])
+
+        other = get_user_model().objects.create_user(email='other-rec@example.com', password='x', first_name='O', last_name='P')
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_tampered_or_truncated_file_is_rejected(self):
+        path = self.make_record().file_path.path
+        with open(path, 'rb') as f:
+            stored = f.read()
+        for damaged in (stored[:40] + bytes([stored[40] ^ 1]) + stored[41:], stored[:-(16 + 16)]):
+            with open(path, 'wb') as f:
+                f.write(damaged)
+            with self.assertRaises(CorruptRecord):
+                list(iter_decrypted_range(path, 0, len(self.content)))
+
+    def test_encrypt_records_command(self):
+        record = self.make_record()
+        with open(record.file_path.path, 'wb') as f:
+            f.write(self.content)
+        call_command('encrypt_records', stdout=io.StringIO())
+        self.assertTrue(is_encrypted(record.file_path.path))
+        with record.file_path.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_key_must_be_configured(self):
+        with override_settings(RECORD_ENCRYPTION_KEY=''), self.assertRaises(ImproperlyConfigured):
+            self.make_record()
+
+    def test_key_rotation(self):
+        record = self.make_record()
+        path = record.file_path.path
+        self.assertEqual(file_key_id(path), key_id(decode_key(TEST_RECORD_KEY)))
+        new_key = base64.b64encode(b'rotated record encryption key 32').decode()
+
+        def read():
+            with record.file_path.storage.open(record.file_path.name) as f:
+                return f.read()
+
+        with override_settings(RECORD_ENCRYPTION_KEY=new_key), self.assertRaises(CorruptRecord):
+            read()
+        with override_settings(RECORD_ENCRYPTION_KEY=new_key, RECORD_ENCRYPTION_OLD_KEYS=[TEST_RECORD_KEY]):
+            self.assertEqual(read(), self.content)
+            call_command('encrypt_records', '--rotate', stdout=io.StringIO())
+        self.assertEqual(file_key_id(path), key_id(decode_key(new_key)))
+        with override_settings(RECORD_ENCRYPTION_KEY=new_key):
+            self.assertEqual(read(), self.content)
+
+
+class NiftiUploadValidationTests(MediaAPITestCase):
+    def create(self, content, name='scan.nii.gz'):
+        data = {'first_name': 'New', 'last_name': 'Scan', 'email': 'new-scan@example.com', 'dob': '1980-01-01',
+                'mri_file': SimpleUploadedFile(name, content)}
+        return self.client.post(reverse('patient-create'), data, format='multipart')
+
+    def test_sniffer_inflates_only_the_header(self):
+        content = make_nifti(make_labels())
+        sniffer = HeaderSniffer()
+        headers = [sniffer.feed(content[i:i + 1]) for i in range(len(content))]
+        self.assertEqual(sniffer.finish()['shape'], (8, 6, 4))
+        self.assertIsNone(headers[0])
+        self.assertLessEqual(len(sniffer._data), 540)
+        with self.assertRaises(NiftiError):
+            HeaderSniffer().feed(gzip.compress(b'not a nifti file' * 100))
+        with self.assertRaises(NiftiError):
+            HeaderSniffer(max_voxel_bytes=100).feed(content)
+
+    def test_invalid_upload_is_rejected_before_storage(self):
+        with patch.object(ContentAddressedStorage, '_save') as mock_save:
+            response = self.create(b'\x1f\x8b garbage' * 1000)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('mri_file', response.data)
+        mock_save.assert_not_called()
+        self.assertFalse(Patient.objects.filter(email='new-scan@example.com').exists())
+
+        with override_settings(MRI_MAX_VOXEL_BYTES=100):
+            response = self.create(make_nifti(make_labels()))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('exceeds', response.data['mri_file'][0])
+
+    def test_valid_upload_keeps_parsed_header_for_jobs(self):
+        response = self.create(make_nifti(make_labels()))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        job = Job.objects.get(kind='volume.metadata')
+        self.assertEqual(job.payload['header']['shape'], [8, 6, 4])
+        with patch('app.volumetrics.read_header') as mock_read_header:
+            self.run_jobs()
+        mock_read_header.assert_not_called()
+        self.assertEqual(VolumeMetadata.objects.get(patient_id=response.data['id']).shape, [8, 6, 4])
+
+    def test_chunked_upload_rejects_bad_first_chunk(self):
+        patient = self.make_patient('chunk-scan@example.com')
+        payload = os.urandom(4096)
+        response = self.client.post(reverse('patient-upload-session', args=[patient.id]),
+                                    {'filename': 'study.nii.gz', 'size': len(payload)})
+        session_id = response.data['id']
+        response = self.client.put(reverse('upload-session-detail', args=[session_id]), data=payload,
+                                   content_type='application/octet-stream',
+                                   HTTP_CONTENT_RANGE=f'bytes 0-{len(payload) - 1}/{len(payload)}')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['offset'], 0)
+
+
+class FileDownloadTests(MediaAPITestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        self.patient = self.make_patient('download@example.com', content=self.content)
+        self.url = reverse('patient-mri-file', args=[self.patient.id])
+
+    def test_full_and_ranged_downloads_use_file_response(self):
+        response = self.client.get(self.url)
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['ETag'], f'"{content_hash(self.patient.mri_file.name)}"')
+        self.assertIn('attachment', response['Content-Disposition'])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9,20-29')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+
+    def test_overlapping_and_excess_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-,0-,0-')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19,0-9,15-29')
+        self.assertEqual(response['Content-Range'], f'bytes 0-29/{len(self.content)}')
+
+        many = ','.join(f'{i}-{i}' for i in range(0, 2 * (MAX_RANGES + 1), 2))
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={many}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_conditional_requests(self):
+        first = self.client.get(self.url)
+        etag, last_modified = first['ETag'], first['Last-Modified']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code,
+                         status.HTTP_206_PARTIAL_CONTENT)
+        stale = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(stale.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(stale.streaming_content), self.content)
+
+    def test_offload_to_front_proxy_and_ownership(self):
+        with override_settings(FILE_DOWNLOAD_OFFLOAD='x-accel'):
+            response = self.client.get(self.url)
+            self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.patient.mri_file.name}')
+            self.assertEqual(response.content, b'')
+            record = SecurePatientRecord(physician=self.physician, description='Report')
+            record.file_path.save('report.pdf', ContentFile(b'%PDF secret'), save=True)
+            response = self.client.get(reverse('secure-record', args=[record.id]))
+            self.assertNotIn('X-Accel-Redirect', response)
+            self.assertEqual(b''.join(response.streaming_content), b'%PDF secret')
+        with override_settings(FILE_DOWNLOAD_OFFLOAD='x-sendfile'):
+            self.assertEqual(self.client.get(self.url)['X-Sendfile'], self.patient.mri_file.path)
+
+        other = get_user_model().objects.create_user(email='other-dl@example.com', password='x', first_name='O', last_name='P')
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ThumbnailTests(MediaAPITestCase):
+    def decode(self, uri):
+        self.assertTrue(uri.startswith('data:image/png;base64,'))
+        png = base64.b64decode(uri.split(',', 1)[1])
+        self.assertEqual(png[:8], b'\x89PNG\r\n\x1a\n')
+        return struct.unpack('>II', png[16:24])  # IHDR width, height
+
+    def test_mips_are_small_and_keep_small_lesions(self):
+        labels = np.zeros((200, 100, 50), dtype=np.float32)
+        labels[123, 45, 7] = 4
+        labels[10:20, 10:20, 10:20] = 2
+        image = downsample_max(extract_slice(labels.max(axis=2, keepdims=True), 'axial', 0), 64)
+        self.assertEqual(image.shape, (25, 50))
+        self.assertEqual(image.max(), 4)
+        thumbnails = mip_thumbnails(labels, 64)
+        self.assertEqual(set(thumbnails), {'sagittal', 'coronal', 'axial'})
+        self.assertEqual(self.decode(thumbnails['axial']), (50, 25))
+
+    def test_4d_series_and_out_of_range_values(self):
+        series = np.zeros((8, 6, 4, 3), dtype=np.float32)
+        series[2, 1, 1, 0] = 2
+        series[5, 4, 2, 0] = 300  # Would wrap to label 44 when cast
+        series[..., 1:] = 1
+        metadata = metadata_fields({'shape': series.shape, 'spacing': (1.0, 1.0, 1.0, 1.0), 'dtype': 'float32',
+                                    'affine': None}, series)
+        self.assertEqual(set(metadata['labels']), {'0', '2', '300'})
+        self.assertEqual(self.decode(metadata['thumbnails']['axial']), (8, 6))
+        image = extract_slice(series, 'axial', 2)
+        self.assertEqual(image.shape, (6, 8))
+        self.assertEqual(image.max(), 255)
+
+    def test_thumbnails_expanded_without_file_access(self):
+        for i in range(3):
+            self.make_patient(f'thumb{i}@example.com', labels=make_labels())
+        self.run_jobs()
+        url = reverse('physician-patient-list')
+        self.assertNotIn('thumbnails', self.client.get(url).data[0])
+        with patch('app.volume_cache.VolumeCache.get') as mock_get, self.assertNumQueries(1):
+            response = self.client.get(url, {'expand': 'thumbnails'})
+        mock_get.assert_not_called()
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(self.decode(response.data[0]['thumbnails']['coronal']), (8, 4))
+
+
+class JobQueueTests(MediaAPITestCase):
+    def test_upload_queues_deduplicated_jobs_by_priority(self):
+        patient = self.make_patient('jobs@example.com', labels=make_labels())
+        enqueue_volume_jobs(patient.mri_file.name)
+        self.assertEqual(Job.objects.count(), 4)
+        self.assertEqual(claim('test').kind, 'volume.metadata')
+
+        response = self.client.get(reverse('physician-patient-list'), {'expand': 'processing'})
+        self.assertEqual(response.data[0]['processing']['state'], 'running')
+        self.assertEqual(response.data[0]['processing']['jobs']['volume.meshes'], Job.STATUS_QUEUED)
+
+    def test_failed_job_is_retried_then_marked_failed(self):
+        calls = []
+
+        def broken(payload):
+            calls.append(payload)
+            raise ValueError('broken')
+
+        with patch.dict(HANDLERS, {'test.broken': (broken, 0)}), override_settings(JOB_MAX_ATTEMPTS=2):
+            enqueue('test.broken', 'abc')
+            self.run_jobs()
+            job = Job.objects.get(kind='test.broken')
+            self.assertEqual((job.status, job.attempts), (Job.STATUS_QUEUED, 1))
+            Job.objects.update(run_after=timezone.now())
+            self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_FAILED, 2))
+        self.assertIn('ValueError', job.last_error)
+        self.assertEqual(len(calls), 2)
+
+    def test_processing_done_after_workers_run(self):
+        patient = self.make_patient('jobs-done@example.com', labels=make_labels())
+        url = reverse('patient-detail', args=[patient.id])
+        self.assertEqual(self.client.get(url, {'expand': 'processing'}).data['processing']['state'], 'queued')
+        self.run_jobs()
+        response = self.client.get(url, {'expand': 'processing'})
+        self.assertEqual(response.data['processing']['state'], 'done')
+        self.assertTrue(VolumeMetadata.objects.filter(patient=patient).exists())
+
+
+class AsyncEndpointTests(MediaAPITestCase):
+    def setUp(self):
+        super().setUp()
+        token = VersionedRefreshToken.for_user(self.physician).access_token
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+    async def test_detail_get_patch_delete(self):
+        patient = await sync_to_async(self.make_patient)('async@example.com')
+        url = reverse('async-patient-detail', args=[patient.id])
+        self.assertEqual((await self.async_client.get(url)).status_code, 401)
+        response = await self.async_client.get(url, headers=self.headers)
+        self.assertEqual(response.json()['email'], 'async@example.com')
+        response = await self.async_client.patch(url, {'last_name': 'Async'}, content_type='application/json', headers=self.headers)
+        self.assertEqual(response.json()['last_name'], 'Async')
+        self.assertEqual((await self.async_client.delete(url, headers=self.headers)).status_code, 204)
+        self.assertFalse(await Patient.objects.filter(pk=patient.pk).aexists())
+
+    async def test_detail_expands_processing(self):
+        patient = await sync_to_async(self.make_patient)('async-jobs@example.com', labels=make_labels())
+        url = reverse('async-patient-detail', args=[patient.id])
+        response = await self.async_client.get(url, {'expand': 'processing,volume_metadata'}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['processing']['state'], 'queued')
+        self.assertIsNone(response.json()['volume_metadata'])
+
+    async def test_upload_then_ranged_download(self):
+        patient = await sync_to_async(self.make_patient)('async-mri@example.com')
+        url = reverse('async-patient-mri', args=[patient.id])
+        content = make_nifti(make_labels())
+        sha256 = hashlib.sha256(content).hexdigest()
+        response = await self.async_client.put(f'{url}?filename=seg.nii.gz', content, content_type='application/octet-stream',
+                                               headers={**self.headers, 'X-Content-SHA256': sha256})
+        self.assertEqual(response.status_code, 200)
+        await patient.arefresh_from_db()
+        self.assertEqual(patient.mri_file.name, f"mri_files/{sha256[:2]}/{sha256}.nii.gz")
+
+        response = await self.async_client.get(url, headers={**self.headers, 'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), content[10:20])
+
+    async def test_send_patient_info_is_queued(self):
+        patient = await sync_to_async(self.make_patient)('async-mail@example.com')
+        response = await self.async_client.post(reverse('async-send-patient-info', args=[patient.id]), headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(await OutboundEmail.objects.filter(patient=patient).aexists())
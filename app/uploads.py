@@ -0,0 +1,184 @@
+import fcntl
+import hashlib
+import os
+import re
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.http import Http404
+
+from .nifti import HeaderSniffer, NiftiError
+
+# Size of the blocks copied from the request stream to disk. Memory use of a
+# chunk upload is bounded by this, whatever the chunk size is.
+BLOCK_SIZE = 64 * 1024
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class ChunkError(Exception):
+    pass
+
+
+class PartFile(File):
+    """
+    A part file that FileSystemStorage can move into place instead of copying.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class NiftiUploadHandler(FileUploadHandler):
+    """
+    Check MRI files while Django parses a multipart upload.
+
+    Installed ahead of the default handlers, it sees every chunk first. An
+    `mri_file` whose first bytes are not an acceptable NIfTI volume is skipped,
+    so the rest of it is never written to memory or disk; the error is kept in
+    request.nifti_upload_errors for the serializer to report. The parsed header
+    is kept in request.nifti_upload_headers.
+    """
+    field_names = ('mri_file',)
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.sniffer = mri_sniffer() if field_name in self.field_names else None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.sniffer is not None:
+            try:
+                self.sniffer.feed(raw_data)
+            except NiftiError as e:
+                self.sniffer = None
+                self.remember('nifti_upload_errors', str(e))
+                raise SkipFile()
+        return raw_data
+
+    def file_complete(self, file_size):
+        if self.sniffer is not None:
+            try:
+                self.remember('nifti_upload_headers', self.sniffer.finish())
+            except NiftiError as e:
+                self.remember('nifti_upload_errors', str(e))
+        return None  # The next handler stores the file.
+
+    def remember(self, attr, value):
+        setattr(self.request, attr, {**getattr(self.request, attr, {}), self.field_name: value})
+
+
+def part_path(session):
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{session.id}.part")
+
+
+def lock_path(session):
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{session.id}.lock")
+
+
+@contextmanager
+def locked_session(session):
+    """
+    Hold an exclusive lock on an upload session across processes and reload its state.
+
+    Chunk writes and the commit run under it, so two requests can never both pass
+    the offset check and append to the part file at once. A session deleted while
+    the request waited for the lock is a 404. The lock file outlives the session,
+    so every waiter locks the same file; clean_upload_locks removes it later.
+    """
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    with open(lock_path(session), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                session.refresh_from_db(fields=['offset', 'status'])
+            except type(session).DoesNotExist:
+                raise Http404('Upload session not found')
+            yield session
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def parse_content_range(header):
+    """
+    Parse a 'bytes start-end/total' header into (start, end_exclusive, total).
+    """
+    match = CONTENT_RANGE_RE.match(header or '')
+    if not match:
+        raise ChunkError('Content-Range must look like "bytes start-end/total"')
+    start, end, total = (int(value) for value in match.groups())
+    if end < start:
+        raise ChunkError('Content-Range end is before start')
+    return start, end + 1, total
+
+
+def mri_sniffer():
+    return HeaderSniffer(max_bytes=settings.MRI_UPLOAD_MAX_BYTES, max_voxel_bytes=settings.MRI_MAX_VOXEL_BYTES)
+
+
+def write_chunk(session, stream, start, end, expected_sha256='', sniffer=None):
+    """
+    Stream bytes [start, end) from the request into the session's part file.
+
+    The chunk is hashed as it is written; if it is short or its digest does not
+    match, the part file is truncated back to the last good offset. A `sniffer`
+    sees each block before it is written, so a first chunk that is not NIfTI is
+    rejected before it reaches the disk.
+    """
+    path = part_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = hashlib.sha256()
+    remaining = end - start
+    with open(path, 'ab') as part:
+        if part.tell() < start:
+            raise ChunkError('Part file is shorter than the session offset')
+        # Drop anything past the last good offset (e.g. a half-written retry);
+        # in append mode every write then lands at `start`.
+        part.truncate(start)
+        while remaining > 0:
+            block = stream.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            if sniffer is not None:
+                try:
+                    sniffer.feed(block)
+                except NiftiError as e:
+                    part.truncate(start)
+                    raise ChunkError(str(e))
+            part.write(block)
+            digest.update(block)
+            remaining -= len(block)
+        if remaining:
+            part.truncate(start)
+            raise ChunkError(f"Chunk ended {remaining} bytes early")
+        if expected_sha256 and digest.hexdigest() != expected_sha256.lower():
+            part.truncate(start)
+            raise ChunkError('Chunk checksum mismatch')
+    return end
+
+
+def copy_stream(stream, path, sniffer=None):
+    """
+    Copy a whole request body to `path` block by block; returns its sha256.
+
+    With a `sniffer`, NiftiError is raised at the first block that shows the body is not
+    an acceptable volume, before the rest is copied.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = hashlib.sha256()
+    with open(path, 'wb') as out:
+        for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+            if sniffer is not None:
+                sniffer.feed(block)
+            out.write(block)
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
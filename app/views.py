@@ -4,15 +4,37 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
-from .models import Patient, Physician, SecurePatientRecord
-from .serializers import PatientSerializer, PhysicianSerializer
+from .models import Patient, Physician, SecurePatientRecord, UploadSession, VolumeMetadata
+from .serializers import PatientSerializer, PhysicianSerializer, UploadSessionSerializer, expanded_fields
+from .authentication import VersionedRefreshToken, revoke_credentials
+from .bulk import MAX_ITEMS, bulk_create_patients, bulk_delete_patients, bulk_update_patients
+from .downloads import download_response
+from .export import iter_csv, iter_ndjson
+from .labelmap import NotALabelMap, build_label_map
+from .meshes import build_meshes, mesh_path
+from .nifti import NiftiError, read_header
+from .outbox import enqueue_patient_info
+from .pyramid import build_pyramid, read_index
+from .ranges import ranged_file_response
+from .realtime import merge_action, physician_group
+from .render import AXES, FORMATS, render_slice, slice_cache
+from .response_cache import versioned_response
+from .roi import encode_roi, expand_bounds, label_bounds, metadata_bounds
+from .search import INDEXES, search
+from .storage import blob_extension
+from .throttling import LoginEmailRateThrottle, LoginIPRateThrottle
+from .uploads import (ChunkError, PartFile, file_sha256, locked_session, mri_sniffer, parse_content_range,
+                      part_path, write_chunk)
+from .volume_cache import get_volume, volume_key
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from rest_framework import generics
-from .permissions import IsOwnerOrReadOnly
-from rest_framework_simplejwt.tokens import RefreshToken
+from .pagination import KeysetPagination
+from .permissions import IsOwner, IsOwnerOrReadOnly
+from rest_framework_simplejwt.views import TokenObtainPairView
 import logging
-from django.core.mail import send_mail
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
@@ -20,41 +42,58 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import api_view, permission_classes
 from django_otp.oath import TOTP
 from django_otp.plugins.otp_totp.models import TOTPDevice
-from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+import asyncio
 import json
+import os
 
 logger = logging.getLogger(__name__)
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+# Real-time patient updates for the physician's frontend (ws/patients/?token=<access token>).
+# Changes published to the physician's group are coalesced per patient and sent as one
+# frame once the burst has been quiet for REALTIME_DEBOUNCE_SECONDS (or REALTIME_MAX_DELAY_SECONDS
+# after its first change at the latest): {"type": "patients.changed", "patients": [{"id", "action"}]}.
+class NotificationConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close(code=4401)
+            return
+        self.group = physician_group(user.pk)
+        self.pending = {}
+        self.flush_task = None
+        await self.channel_layer.group_add(self.group, self.channel_name)
         await self.accept()
 
     async def disconnect(self, close_code):
-        pass
+        if getattr(self, 'group', None):
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+        if getattr(self, 'flush_task', None):
+            self.flush_task.cancel()
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        await self.send(text_data=json.dumps({'message': message}))
+    async def patients_changed(self, event):
+        loop = asyncio.get_running_loop()
+        for patient_id, action in event['changes']:
+            self.pending[patient_id] = merge_action(self.pending.get(patient_id), action)
+        self.last_change = loop.time()
+        if self.flush_task is None:
+            self.first_change = self.last_change
+            self.flush_task = asyncio.ensure_future(self.flush())
 
-@api_view(['POST'])
-@permission_classes([IsAuthenticated])
-def send_patient_info(request, patient_id):
-    if not request.user.is_authenticated or not hasattr(request.user, 'doctor'):
-        return JsonResponse({"error": "Unauthorized access"}, status=403)
-
-    try:
-        patient = Patient.objects.get(id=patient_id, doctor=request.user.doctor)
-        send_mail(
-            'Your Patient Information',
-            'Please visit this link to view your information: http://localhost:3000/patient-info',
-            'your_email@example.com',
-            [patient.email],
-            fail_silently=False,
-        )
-        return JsonResponse({"status": "Email sent successfully"})
-    except Patient.DoesNotExist:
-        return JsonResponse({"error": "Patient not found"}, status=404)
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            deadline = min(self.last_change + settings.REALTIME_DEBOUNCE_SECONDS,
+                           self.first_change + settings.REALTIME_MAX_DELAY_SECONDS)
+            if loop.time() >= deadline:
+                break
+            await asyncio.sleep(deadline - loop.time())
+        pending, self.pending, self.flush_task = self.pending, {}, None
+        await self.send_json({
+            'type': 'patients.changed',
+            'patients': [{'id': patient_id, 'action': action} for patient_id, action in pending.items()],
+        })
 
 # Physician SignUp View
 class PhysicianSignUpView(APIView):
@@ -65,7 +104,7 @@ class PhysicianSignUpView(APIView):
             user.set_password(user.password)
             user.save()
             logger.info(f"New physician signed up: {user.email}")
-            refresh = RefreshToken.for_user(user)
+            refresh = VersionedRefreshToken.for_user(user)
             return Response({
                 'refresh': str(refresh),
                 'access': str(refresh.access_token),
@@ -74,14 +113,34 @@ class PhysicianSignUpView(APIView):
             logger.error(f"Physician signup validation error: {serializer.errors}")
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-# Encryption at Rest for Patient Records
-class SecurePatientDetailView(generics.RetrieveAPIView):
-    queryset = SecurePatientRecord.objects.all()
-    permission_classes = [IsAuthenticated]
+# Downloads of stored files, for the owning physician only (see app.downloads).
+class OwnedFileDownloadView(APIView):
+    permission_classes = [IsAuthenticated, IsOwner]
+    model = None
+    file_field = None
 
-    def get_object(self):
-        patient_id = self.kwargs.get('pk')
-        return SecurePatientRecord.objects.get(id=patient_id)
+    def get(self, request, pk):
+        obj = get_object_or_404(self.model, pk=pk)
+        self.check_object_permissions(request, obj)
+        fieldfile = getattr(obj, self.file_field)
+        if not fieldfile or not os.path.exists(fieldfile.path):
+            return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
+        return download_response(request, fieldfile, self.download_name(obj, fieldfile))
+
+    def download_name(self, obj, fieldfile):
+        return f"{self.model.__name__.lower()}-{obj.pk}{blob_extension(fieldfile.name)}"
+
+
+class PatientMRIFileView(OwnedFileDownloadView):
+    model = Patient
+    file_field = 'mri_file'
+
+
+# Encryption at Rest for Patient Records
+# Streams the decrypted record file; Range requests only decrypt the chunks they cover.
+class SecurePatientDetailView(OwnedFileDownloadView):
+    model = SecurePatientRecord
+    file_field = 'file_path'
 
 # Two-Factor Authentication
 @api_view(['POST'])
@@ -99,43 +158,41 @@ class PatientRealtimeUpdateView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        # Example implementation that needs real-time handling
-        patient_data = request.data
-        patient = Patient.objects.get(id=patient_data['id'])
-        patient.diagnosis = patient_data['diagnosis']
-        patient.save()
-        # Notify all subscribed clients
-        NotificationConsumer.send(json.dumps({
-            'type': 'update',
-            'message': f'Patient {patient.id} updated'
-        }))
+        patient = get_object_or_404(Patient, pk=request.data.get('id'), physician=request.user)
+        serializer = PatientSerializer(patient, data=request.data, partial=True, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        # Saving publishes the change to the physician's sockets (see app.signals).
+        serializer.save()
         return Response({"message": "Patient updated and notifications sent"})
 
 
+# Emails are queued in the outbox and delivered by `manage.py send_outbox`, so these
+# return 202 without waiting on the SMTP server.
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def send_patient_info(request, patient_id):
-    if not request.user.is_authenticated or not hasattr(request.user, 'doctor'):
-        return JsonResponse({"error": "Unauthorized access"}, status=403)
-
     try:
-        patient = Patient.objects.get(id=patient_id, doctor=request.user.doctor)
-        send_mail(
-            'Your Patient Information',
-            'Please visit this link to view your information: http://localhost:3000/patient-info',
-            'your_email@example.com',  # Your sender email
-            [patient.email],  # Recipient email
-            fail_silently=False,
-        )
-        return JsonResponse({"status": "Email sent successfully"})
+        patient = Patient.objects.get(id=patient_id, physician=request.user)
     except Patient.DoesNotExist:
         return JsonResponse({"error": "Patient not found"}, status=404)
+    enqueue_patient_info(request.user, [patient])
+    return JsonResponse({"status": "Email queued"}, status=202)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def notify_all_patients(request):
+    patients = Patient.objects.filter(physician=request.user).only('id', 'email').iterator(chunk_size=2000)
+    queued = enqueue_patient_info(request.user, patients)
+    logger.info(f"{request.user.email} queued patient information emails for {queued} patients")
+    return JsonResponse({"status": "Emails queued", "queued": queued}, status=202)
 
 
 logger = logging.getLogger(__name__)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@versioned_response
 def get_physician_info(request):
     """
     Get the currently logged-in physician's information.
@@ -166,7 +223,7 @@ class PhysicianSignUpView(APIView):
             logger.info(f"New physician signed up: {user.email}")
 
             # Generate tokens for the user
-            refresh = RefreshToken.for_user(user)
+            refresh = VersionedRefreshToken.for_user(user)
             return Response({
                 'refresh': str(refresh),
                 'access': str(refresh.access_token),
@@ -184,14 +241,20 @@ class PatientDetailUpdateDeleteView(generics.RetrieveUpdateDestroyAPIView):
     def get_object(self):
         return get_object_or_404(self.get_queryset(), pk=self.kwargs["pk"], physician=self.request.user)
 
+    @method_decorator(versioned_response)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
 # Login View: This view handles physician login.
 class LoginView(APIView):
+    throttle_classes = [LoginIPRateThrottle, LoginEmailRateThrottle]
+
     def post(self, request, *args, **kwargs):
         email = request.data.get('email')
         password = request.data.get('password')
         user = authenticate(request, username=email, password=password)
         if user is not None:
-            refresh = RefreshToken.for_user(user)
+            refresh = VersionedRefreshToken.for_user(user)
             return Response({
                 'refresh': str(refresh),
                 'access': str(refresh.access_token),
@@ -200,13 +263,37 @@ class LoginView(APIView):
         else:
             return Response({'message': 'Invalid Credentials'}, status=status.HTTP_401_UNAUTHORIZED)
 
+# simplejwt's token endpoint, with the same login throttles as LoginView.
+class ThrottledTokenObtainPairView(TokenObtainPairView):
+    throttle_classes = [LoginIPRateThrottle, LoginEmailRateThrottle]
+
+# Logout: revokes the JWT session (the refresh token and every access token minted from it),
+# or deletes the DRF token, that the request was authenticated with.
+class TokenRevokeView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        if not revoke_credentials(request.auth):
+            return Response({'error': 'These credentials cannot be revoked'}, status=status.HTTP_400_BAD_REQUEST)
+        logger.info(f"Credentials revoked for {request.user.email}")
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 # Physician's Patient List View: This view lists all patients associated with the logged-in physician and allows for the creation of new patients.
 class PhysicianPatientListView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @method_decorator(versioned_response)
     def get(self, request):
         patients = Patient.objects.filter(physician=request.user)
-        serializer = PatientSerializer(patients, many=True)
+        if expanded_fields(request) & {'volume_metadata', 'thumbnails'}:
+            patients = patients.select_related('volume_metadata')
+        # Pagination is opt-in (?cursor= / ?page_size=) so existing clients still get a plain list.
+        paginator = KeysetPagination()
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(patients, request, view=self)
+            serializer = PatientSerializer(page, many=True, context={'request': request})
+            return paginator.get_paginated_response(serializer.data)
+        serializer = PatientSerializer(patients, many=True, context={'request': request})
         return Response(serializer.data)
 
     def post(self, request):
@@ -218,3 +305,374 @@ class PhysicianPatientListView(APIView):
         else:
             logger.error(f"Patient creation error: {serializer.errors}")
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+# Chunked MRI upload: open a session for a patient, PUT byte ranges with a Content-Range header
+# (and optionally an X-Chunk-SHA256 digest), then commit. A client that lost its connection
+# GETs the session to learn the last good offset and resumes from there.
+class PatientUploadSessionView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        patient = get_object_or_404(Patient, pk=pk, physician=request.user)
+        serializer = UploadSessionSerializer(data=request.data)
+        if serializer.is_valid():
+            serializer.save(physician=request.user, patient=patient)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+class UploadSessionDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get_object(self, pk):
+        return get_object_or_404(UploadSession, pk=pk, physician=self.request.user)
+
+    def get(self, request, pk):
+        session = self.get_object(pk)
+        return Response(UploadSessionSerializer(session).data)
+
+    def put(self, request, pk):
+        session = self.get_object(pk)
+        try:
+            start, end, total = parse_content_range(request.headers.get('Content-Range'))
+        except ChunkError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if total != session.size or end > session.size:
+            return Response({'error': 'Content-Range does not match the session size'}, status=status.HTTP_400_BAD_REQUEST)
+        # The offset is checked and advanced under the session lock; a concurrent PUT of the
+        # same chunk waits here and then sees the new offset.
+        with locked_session(session):
+            if session.status != UploadSession.STATUS_OPEN:
+                return Response({'error': 'Upload session is already committed'}, status=status.HTTP_409_CONFLICT)
+            if start != session.offset:
+                # Out-of-order or duplicate chunk: tell the client where to resume.
+                return Response({'error': 'Chunk does not start at the session offset', 'offset': session.offset},
+                                status=status.HTTP_409_CONFLICT)
+            # Read the raw request stream; touching request.data would buffer the whole body.
+            # The first chunk carries the NIfTI header and is checked before it is written.
+            sniffer = mri_sniffer() if start == 0 else None
+            try:
+                session.offset = write_chunk(session, request.stream, start, end,
+                                             request.headers.get('X-Chunk-SHA256', ''), sniffer=sniffer)
+            except ChunkError as e:
+                logger.error(f"Upload session {session.id} rejected chunk {start}-{end}: {e}")
+                return Response({'error': str(e), 'offset': session.offset}, status=status.HTTP_400_BAD_REQUEST)
+            session.save(update_fields=['offset', 'updated_at'])
+        return Response(UploadSessionSerializer(session).data)
+
+    def delete(self, request, pk):
+        session = self.get_object(pk)
+        with locked_session(session):
+            if os.path.exists(part_path(session)):
+                os.remove(part_path(session))
+            session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class UploadSessionCommitView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        session = get_object_or_404(UploadSession, pk=pk, physician=request.user)
+        with locked_session(session):
+            if session.status != UploadSession.STATUS_OPEN:
+                return Response({'error': 'Upload session is already committed'}, status=status.HTTP_409_CONFLICT)
+            if session.offset != session.size:
+                return Response({'error': 'Upload is incomplete', 'offset': session.offset}, status=status.HTTP_409_CONFLICT)
+            path = part_path(session)
+            if session.sha256 and file_sha256(path) != session.sha256.lower():
+                return Response({'error': 'File checksum mismatch'}, status=status.HTTP_400_BAD_REQUEST)
+            patient = session.patient
+            with open(path, 'rb') as f:
+                try:
+                    header = read_header(f)
+                except NiftiError as e:
+                    return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                f.seek(0)
+                patient._nifti_header = header  # Spares the metadata job from reading it again.
+                # The part file is moved into storage instead of copied; it is left behind
+                # only when identical content is already stored.
+                patient.mri_file.save(session.filename, PartFile(f), save=True)
+            if os.path.exists(path):
+                os.remove(path)
+            session.status = UploadSession.STATUS_COMMITTED
+            # Requests still waiting for the lock see the committed status once they get it.
+            session.save(update_fields=['status', 'updated_at'])
+        logger.info(f"MRI upload {session.id} committed for patient {patient.id}")
+        return Response(PatientSerializer(patient, context={'request': request}).data)
+
+
+class RawFormatMixin:
+    # Views whose ?format= picks their own output encoding rather than a DRF renderer.
+    def perform_content_negotiation(self, request, force=False):
+        return super().perform_content_negotiation(request, force=True)
+
+# Single rendered plane of a patient's segmentation volume. Slices are keyed by the volume's
+# content hash, so the ETag is known before any rendering and repeat requests are cache hits.
+class PatientMRISliceView(RawFormatMixin, APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        patient = get_object_or_404(Patient, pk=pk, physician=request.user)
+        if not patient.mri_file:
+            return Response({'error': 'Patient has no MRI file'}, status=status.HTTP_404_NOT_FOUND)
+        axis = request.query_params.get('axis', 'axial')
+        fmt = request.query_params.get('format', 'png')
+        try:
+            index = int(request.query_params.get('index', ''))
+        except ValueError:
+            return Response({'error': 'index must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if axis not in AXES or fmt not in FORMATS:
+            return Response({'error': f"axis must be one of {list(AXES)} and format one of {list(FORMATS)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        key = (volume_key(patient.mri_file), axis, index, fmt)
+        etag = quote_etag('-'.join(str(part) for part in key))
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            entry = slice_cache.get(key)
+            if entry is None:
+                volume = get_volume(patient.mri_file)
+                if not 0 <= index < volume.shape[AXES[axis]]:
+                    return Response({'error': 'index is out of range'}, status=status.HTTP_400_BAD_REQUEST)
+                entry = render_slice(volume, axis, index, fmt)
+                slice_cache.set(key, *entry)
+            body, (rows, cols) = entry
+            response = HttpResponse(body, content_type='image/png' if fmt == 'png' else 'application/octet-stream')
+            response['X-Slice-Shape'] = f"{rows},{cols}"
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+# Multi-resolution brick pyramid of a patient's volume. The index lists every brick's byte
+# range in the container; clients fetch bricks with Range requests or in one batch.
+class PatientMRIPyramidView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        patient = get_object_or_404(Patient, pk=pk, physician=request.user)
+        if not patient.mri_file:
+            return Response({'error': 'Patient has no MRI file'}, status=status.HTTP_404_NOT_FOUND)
+        index = read_index(build_pyramid(patient.mri_file))
+        index['data_url'] = request.build_absolute_uri(reverse('patient-mri-pyramid-data', args=[patient.id]))
+        response = Response(index)
+        response['ETag'] = quote_etag(f"{volume_key(patient.mri_file)}-pyramid")
+        return response
+
+class PatientMRIPyramidDataView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        patient = get_object_or_404(Patient, pk=pk, physician=request.user)
+        if not patient.mri_file:
+            return Response({'error': 'Patient has no MRI file'}, status=status.HTTP_404_NOT_FOUND)
+        path = build_pyramid(patient.mri_file)
+        etag = quote_etag(f"{volume_key(patient.mri_file)}-pyramid")
+        if request.query_params.get('bricks'):
+            response = self.batch(path, request.query_params['bricks'])
+        elif etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = ranged_file_response(request, path)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def batch(self, path, bricks):
+        # ?bricks=level/x/y/z,... returns the compressed bricks back to back, in request order.
+        locations = {tuple(brick[:4]): brick[4:] for brick in read_index(path)['bricks']}
+        try:
+            wanted = [locations[tuple(int(n) for n in brick.split('/'))] for brick in bricks.split(',')]
+        except (KeyError, ValueError):
+            return Response({'error': 'Unknown brick; use level/x/y/z from the pyramid index'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        chunks = []
+        with open(path, 'rb') as f:
+            for offset, length in wanted:
+                f.seek(offset)
+                chunks.append(f.read(length))
+        response = HttpResponse(b''.join(chunks), content_type='application/octet-stream')
+        response['X-Brick-Lengths'] = ','.join(str(length) for _, length in wanted)
+        return response
+
+
+# Tumor surface meshes, addressed by the volume's content hash. The URL never changes meaning,
+# so responses can be cached indefinitely by the browser.
+class MeshView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, sha256):
+        # The hash comes from volume_metadata.sha256, so look it up there (indexed).
+        metadata = (VolumeMetadata.objects.select_related('patient')
+                    .filter(sha256=sha256, patient__physician=request.user).first())
+        patient = metadata.patient if metadata is not None else None
+        if patient is None or not patient.mri_file or volume_key(patient.mri_file) != sha256:
+            return Response({'error': 'Mesh not found'}, status=status.HTTP_404_NOT_FOUND)
+        etag = quote_etag(f"{sha256}-mesh")
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            path = mesh_path(sha256)
+            if not os.path.exists(path):
+                build_meshes(patient.mri_file)
+            response = ranged_file_response(request, path)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response
+
+
+# The patient's segmentation as a sparse run-length encoded label map (see app.labelmap),
+# typically several times smaller than the .nii.gz and far cheaper to decode.
+class PatientSparseLabelMapView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        patient = get_object_or_404(Patient, pk=pk, physician=request.user)
+        if not patient.mri_file:
+            return Response({'error': 'Patient has no MRI file'}, status=status.HTTP_404_NOT_FOUND)
+        etag = quote_etag(f"{volume_key(patient.mri_file)}-rle")
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            try:
+                path = build_label_map(patient.mri_file)
+            except NotALabelMap as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            response = ranged_file_response(request, path)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+# Cropped sub-volume around the tumor (or explicit voxel bounds), read from the memory-mapped
+# volume cache. ?label=N&margin=M crops to a label's bounding box, ?bounds=x0,y0,z0,x1,y1,z1
+# to a half-open voxel box.
+class PatientMRIRegionView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        patient = get_object_or_404(Patient, pk=pk, physician=request.user)
+        if not patient.mri_file:
+            return Response({'error': 'Patient has no MRI file'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            label = request.query_params.get('label')
+            label = int(label) if label not in (None, '', 'tumor') else None
+            margin = max(int(request.query_params.get('margin', 0)), 0)
+            explicit = request.query_params.get('bounds')
+            explicit = [int(v) for v in explicit.split(',')] if explicit else None
+        except ValueError:
+            return Response({'error': 'label, margin and bounds must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        if explicit is not None and len(explicit) != 6:
+            return Response({'error': 'bounds must be x0,y0,z0,x1,y1,z1'}, status=status.HTTP_400_BAD_REQUEST)
+
+        sha256 = volume_key(patient.mri_file)
+        metadata = VolumeMetadata.objects.filter(patient=patient, sha256=sha256).first()
+        if metadata is not None:
+            spacing, affine = metadata.spacing, metadata.affine
+        else:
+            with patient.mri_file.open('rb') as f:
+                header = read_header(f)
+            spacing, affine = header['spacing'], header['affine']
+        volume = get_volume(patient.mri_file)
+
+        if explicit is not None:
+            bounds = list(zip(explicit[:3], explicit[3:]))
+        elif metadata is not None:
+            bounds = metadata_bounds(metadata, label)
+        else:
+            bounds = label_bounds(volume, label)
+        if bounds is None:
+            return Response({'error': 'Label not present in the volume'}, status=status.HTTP_404_NOT_FOUND)
+        bounds = expand_bounds(bounds, margin, volume.shape)
+        if any(lo >= hi for lo, hi in bounds):
+            return Response({'error': 'bounds select no voxels'}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = HttpResponse(encode_roi(volume, bounds, spacing, affine), content_type='application/octet-stream')
+        response['ETag'] = quote_etag(f"{sha256}-roi-{'-'.join(str(v) for box in bounds for v in box)}")
+        return response
+
+
+# Bulk export of the physician's cohort, streamed row by row from .values() iterators so memory
+# stays flat. ?format=ndjson (default) emits patients then records, one JSON object per line;
+# ?format=csv&table=patients|records emits a single table.
+class PhysicianExportView(RawFormatMixin, APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        fmt = request.query_params.get('format', 'ndjson')
+        if fmt == 'ndjson':
+            response = StreamingHttpResponse(iter_ndjson(request.user), content_type='application/x-ndjson')
+        elif fmt == 'csv':
+            table = request.query_params.get('table', 'patients')
+            response = StreamingHttpResponse(iter_csv(request.user, table), content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="{table}.csv"'
+        else:
+            return Response({'error': 'format must be ndjson or csv'}, status=status.HTTP_400_BAD_REQUEST)
+        logger.info(f"Cohort export ({fmt}) started by {request.user.email}")
+        return response
+
+
+# Batch patient import/maintenance: POST a list of patients to create, PATCH a list of partial
+# patients with ids to update, DELETE {"ids": [...]}. Items are validated together and written in
+# chunked bulk statements; the response has one result per item, in request order.
+class PatientBulkView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get_items(self, data):
+        if not isinstance(data, list):
+            return None, Response({'error': 'Expected a list of patients'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(data) > MAX_ITEMS:
+            return None, Response({'error': f"At most {MAX_ITEMS} patients per request"}, status=status.HTTP_400_BAD_REQUEST)
+        return data, None
+
+    def respond(self, results, action):
+        errors = sum(1 for result in results if result['status'] == 'error')
+        logger.info(f"Bulk {action} by {self.request.user.email}: {len(results) - errors} ok, {errors} failed")
+        return Response({'results': results, 'succeeded': len(results) - errors, 'failed': errors})
+
+    def post(self, request):
+        items, error = self.get_items(request.data)
+        if error:
+            return error
+        return self.respond(bulk_create_patients(request.user, items), 'create')
+
+    def patch(self, request):
+        items, error = self.get_items(request.data)
+        if error:
+            return error
+        return self.respond(bulk_update_patients(request.user, items), 'update')
+
+    def delete(self, request):
+        ids, error = self.get_items(request.data.get('ids') if isinstance(request.data, dict) else None)
+        if error:
+            return error
+        if not all(isinstance(pk, int) for pk in ids):
+            return Response({'error': 'ids must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        return self.respond(bulk_delete_patients(request.user, ids), 'delete')
+
+
+# Full-text search over the physician's patients (name, email) and records (description).
+# ?q= terms are prefix-matched and all must match; ?type=patients|records limits the search.
+class SearchView(APIView):
+    permission_classes = [IsAuthenticated]
+    max_limit = 100
+    fields = {
+        'patients': ('id', 'first_name', 'last_name', 'email', 'dob'),
+        'records': ('id', 'record_date', 'description'),
+    }
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'q is required'}, status=status.HTTP_400_BAD_REQUEST)
+        kind = request.query_params.get('type')
+        if kind is not None and kind not in INDEXES:
+            return Response({'error': f"type must be one of {', '.join(INDEXES)}"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), self.max_limit)
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        kinds = [kind] if kind else list(INDEXES)
+        return Response({name: search(request.user, query, name, self.fields[name], limit) for name in kinds})
@@ -0,0 +1,133 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+from django.conf import settings
+
+from .nifti import NIFTI2_HEADER_SIZE, open_volume, parse_header
+from .storage import content_hash
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def volume_key(fieldfile):
+    """
+    Content hash identifying the volume behind a FileField value.
+    """
+    sha256 = content_hash(fieldfile.name)
+    if sha256:
+        return sha256
+    # Legacy name outside ContentAddressedStorage: hash the stored bytes instead.
+    digest = hashlib.sha256()
+    with fieldfile.storage.open(fieldfile.name, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class VolumeCache:
+    """
+    On-disk cache of decompressed NIfTI volumes, shared by all worker processes.
+
+    Each study is inflated once into a .npy file named by its content hash and
+    handed out as a read-only numpy.memmap. Entries are written to a temporary
+    file and renamed into place under an flock, so concurrent readers either see
+    a complete entry or none. File mtimes record last use; once the cache grows
+    past VOLUME_CACHE_MAX_BYTES the least recently used entries are unlinked
+    (existing memmaps of them stay valid until closed).
+    """
+
+    @property
+    def root(self):
+        return str(settings.VOLUME_CACHE_DIR)
+
+    @property
+    def max_bytes(self):
+        return settings.VOLUME_CACHE_MAX_BYTES
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.npy")
+
+    def get(self, fieldfile):
+        """
+        Return the volume stored in `fieldfile` as a read-only memmap.
+        """
+        key = volume_key(fieldfile)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._build(fieldfile, key)
+        return np.load(path, mmap_mode='r')
+
+    def _build(self, fieldfile, key):
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(key)
+        # The lock file is never removed: a process blocked on it must end up holding
+        # the same lock any later caller would take.
+        with open(os.path.join(self.root, f"{key}.lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(path):
+                    return  # Another process built it while we waited.
+                with fieldfile.storage.open(fieldfile.name, 'rb') as f:
+                    self._inflate(open_volume(f), path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.evict(keep=path)
+
+    def _inflate(self, stream, path):
+        header = parse_header(stream.read(NIFTI2_HEADER_SIZE))
+        stream.seek(header['vox_offset'])
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        os.close(fd)
+        try:
+            # Write the .npy header, then stream the voxel bytes straight after it.
+            array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.dtype(header['dtype']),
+                                              shape=header['shape'], fortran_order=True)
+            offset = array.offset
+            del array
+            remaining = header['nbytes']
+            with open(tmp_path, 'r+b') as out:
+                out.seek(offset)
+                while remaining > 0:
+                    block = stream.read(min(BLOCK_SIZE, remaining))
+                    if not block:
+                        raise ValueError('Volume data is truncated')
+                    out.write(block)
+                    remaining -= len(block)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def evict(self, keep=None):
+        """
+        Unlink least recently used entries until the cache fits its byte budget.
+        """
+        entries = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+volume_cache = VolumeCache()
+
+
+def get_volume(fieldfile):
+    return volume_cache.get(fieldfile)
@@ -0,0 +1,114 @@
+import numpy as np
+from django.conf import settings
+
+from .nifti import read_header
+from .render import first_frame, mip_thumbnails
+from .volume_cache import get_volume, volume_key
+
+
+# Largest value still treated as a segmentation label rather than an intensity.
+MAX_LABEL = 65535
+
+
+def is_label_map(values):
+    """
+    Whether `values` (the non-zero voxels of a volume) look like segmentation labels:
+    non-negative integers, whatever the stored dtype.
+    """
+    if values.dtype.kind == 'b':
+        return True
+    if values.dtype.kind not in 'iuf':
+        return False
+    if not values.size:
+        return True
+    if values.min() < 0 or values.max() > MAX_LABEL:
+        return False
+    return values.dtype.kind != 'f' or bool(np.all(np.floor(values) == values))
+
+
+def label_dtype(volume):
+    """
+    Smallest dtype that holds the labels of a label map (uint8, or uint16 past 255), or
+    None when `volume` is not one.
+    """
+    values = np.asarray(volume)[np.asarray(volume) != 0]
+    if not is_label_map(values):
+        return None
+    return np.dtype('u1') if not values.size or values.max() <= 255 else np.dtype('<u2')
+
+
+def label_statistics(volume, spacing):
+    """
+    Per-label voxel counts, volumes (mL), bounding boxes and centroids of a 3D label map.
+
+    Background dominates segmentation volumes, so the whole grid is scanned once
+    for non-zero voxels and everything else is computed from those with bincount
+    and reduceat. Coordinates are voxel indices; centroids are in voxel units.
+    Intensity images (signed or fractional values) have no labels and give {}.
+    """
+    flat = np.asarray(volume).reshape(-1, order='F')
+    voxel_ml = float(np.prod(spacing[:3])) / 1000.0
+    nonzero = np.flatnonzero(flat)
+    values = flat[nonzero]
+    if not is_label_map(values):
+        return {}
+    labels = values.astype(np.int64)
+    stats = {}
+    if len(nonzero):
+        coords = np.stack(np.unravel_index(nonzero, volume.shape, order='F'), axis=1)
+        counts = np.bincount(labels)
+        sums = np.stack([np.bincount(labels, weights=coords[:, axis], minlength=len(counts)) for axis in range(3)], axis=1)
+        order = np.argsort(labels, kind='stable')
+        sorted_labels, sorted_coords = labels[order], coords[order]
+        present, starts = np.unique(sorted_labels, return_index=True)
+        mins = np.minimum.reduceat(sorted_coords, starts, axis=0)
+        maxs = np.maximum.reduceat(sorted_coords, starts, axis=0)
+        for label, low, high in zip(present, mins, maxs):
+            count = int(counts[label])
+            stats[str(int(label))] = {
+                'voxels': count,
+                'volume_ml': round(count * voxel_ml, 4),
+                'bbox': [low.tolist(), high.tolist()],
+                'centroid': [round(float(v), 3) for v in sums[label] / count],
+            }
+    background = len(flat) - len(nonzero)
+    stats['0'] = {'voxels': background, 'volume_ml': round(background * voxel_ml, 4)}
+    return stats
+
+
+def metadata_fields(header, volume):
+    """
+    VolumeMetadata field values for a parsed header and its voxel array.
+
+    Labels and thumbnails both describe the first frame of a 4D series.
+    """
+    volume = first_frame(volume)
+    labels = label_statistics(volume, header['spacing'])
+    return {
+        'shape': list(header['shape']),
+        'spacing': list(header['spacing']),
+        'dtype': header['dtype'],
+        'affine': header['affine'],
+        'labels': labels,
+        'tumor_volume_ml': round(sum(stats['volume_ml'] for label, stats in labels.items() if label != '0'), 4),
+        'thumbnails': mip_thumbnails(volume, settings.THUMBNAIL_SIZE),
+    }
+
+
+def update_volume_metadata(patient, header=None):
+    """
+    Create or refresh the VolumeMetadata row for a patient's current MRI file.
+
+    `header` is the already parsed NIfTI header of the file, when the caller has it.
+    """
+    from .models import VolumeMetadata
+
+    fieldfile = patient.mri_file
+    if header is None:
+        with fieldfile.storage.open(fieldfile.name, 'rb') as f:
+            header = read_header(f)
+    fields = metadata_fields(header, get_volume(fieldfile))
+    metadata, _ = VolumeMetadata.objects.update_or_create(
+        patient=patient, defaults={'sha256': volume_key(fieldfile), **fields}
+    )
+    return metadata
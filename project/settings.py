@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -60,12 +61,16 @@ MIDDLEWARE = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'app.authentication.CachedTokenAuthentication',
+        'app.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.AllowAny',
     ),
+    'DEFAULT_THROTTLE_RATES': {
+        'login_ip': '30/min',
+        'login_email': '10/min',
+    },
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
         'rest_framework.parsers.FormParser',
@@ -73,9 +78,25 @@ REST_FRAMEWORK = {
     ],
 }
 
+SIMPLE_JWT = {
+    # Adds the token_version and session claims checked by app.authentication
+    'TOKEN_OBTAIN_SERIALIZER': 'app.serializers.VersionedTokenObtainPairSerializer',
+}
+
 CORS_ORIGIN_ALLOW_ALL = True
 
 ROOT_URLCONF = "project.urls"
+ASGI_APPLICATION = "project.asgi.application"
+
+# Per-physician groups for real-time patient updates (see app.realtime). The in-memory
+# layer only reaches sockets in the same process; use channels_redis with several workers.
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+REALTIME_DEBOUNCE_SECONDS = 0.25
+REALTIME_MAX_DELAY_SECONDS = 1.0
 
 TEMPLATES = [
     {
@@ -152,9 +173,86 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 AUTH_USER_MODEL = 'app.Physician'
 # Optional, if you're using a custom authentication backend
 AUTHENTICATION_BACKENDS = [
+    # Subclasses ModelBackend, so permissions still work; listing ModelBackend as well
+    # would hash the password a second time on every failed login.
     'app.backends.EmailAuthenticationBackend',
-    'django.contrib.auth.backends.ModelBackend',
 ]
+# Password hashes run on a bounded thread pool (see app.passwords)
+PASSWORD_HASH_WORKERS = 4
+PASSWORD_HASH_QUEUE = 32
+
+# MRI uploads are checked as they stream in (see app.uploads.NiftiUploadHandler): the upload
+# size and the voxel data size declared by the NIfTI header are capped.
+MRI_UPLOAD_MAX_BYTES = 1024 ** 3
+MRI_MAX_VOXEL_BYTES = 2 * 1024 ** 3
+FILE_UPLOAD_HANDLERS = [
+    'app.uploads.NiftiUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# Part files of in-progress chunked MRI uploads (see app.uploads)
+CHUNKED_UPLOAD_DIR = BASE_DIR / 'upload_sessions'
+
+# Decompressed MRI volumes shared by all workers (see app.volume_cache)
+VOLUME_CACHE_DIR = BASE_DIR / 'volume_cache'
+VOLUME_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Multi-resolution brick containers built from each MRI volume (see app.pyramid)
+PYRAMID_DIR = BASE_DIR / 'pyramids'
+# Tumor label surface meshes, by volume content hash (see app.meshes)
+MESH_DIR = BASE_DIR / 'meshes'
+# Run-length encoded label maps for transfer, by volume content hash (see app.labelmap)
+LABELMAP_DIR = BASE_DIR / 'labelmaps'
+# Secure patient record files are encrypted in authenticated chunks (see app.encryption).
+# The key is base64 of 32 bytes and must be set before records are stored. After a rotation,
+# list the retired keys (comma separated) in RECORD_ENCRYPTION_OLD_KEYS until
+# `manage.py encrypt_records --rotate` has re-encrypted everything with the new key.
+RECORD_ENCRYPTION_KEY = os.environ.get('RECORD_ENCRYPTION_KEY', '')
+RECORD_ENCRYPTION_OLD_KEYS = [key for key in os.environ.get('RECORD_ENCRYPTION_OLD_KEYS', '').split(',') if key]
+RECORD_ENCRYPTION_CHUNK_SIZE = 1024 * 1024
+RECORD_ENCRYPTION_WORKERS = 4
+# Let the front proxy send downloaded files (see app.downloads): None, 'x-accel' for nginx, with
+# an internal location at FILE_DOWNLOAD_ACCEL_PREFIX aliased to MEDIA_ROOT, or 'x-sendfile'.
+FILE_DOWNLOAD_OFFLOAD = os.environ.get('FILE_DOWNLOAD_OFFLOAD') or None
+FILE_DOWNLOAD_ACCEL_PREFIX = '/protected-media/'
+# Longest side in pixels of the MIP previews stored with each volume's metadata (see app.render)
+THUMBNAIL_SIZE = 64
+# Per-process LRU of rendered MRI slices (see app.render)
+SLICE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Per-physician versioned API responses (see app.response_cache). File-based so every
+    # worker process sees the same version; LocMemCache is enough for a single process.
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'response_cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Token versions and revocation lookups (see app.authentication); must be shared by
+    # every worker process for revocation to take effect everywhere. Both are backed by
+    # the database, so culling only costs a query; MAX_ENTRIES keeps that rare.
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'auth_cache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # Login attempt counters (see app.throttling). Kept apart from 'auth' because anyone
+    # can fill them with new IPs and emails, and culling here only forgets old counts.
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'throttle_cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+RESPONSE_CACHE_ALIAS = 'responses'
+RESPONSE_CACHE_TIMEOUT = 300
+AUTH_CACHE_ALIAS = 'auth'
+THROTTLE_CACHE_ALIAS = 'throttle'
+# How long a process reuses a resolved user or DRF token before re-reading it
+AUTH_USER_CACHE_TTL = 30
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.yourserver.com'
@@ -162,6 +260,17 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = 'your_email@example.com'
 EMAIL_HOST_PASSWORD = 'your_email_password'
+DEFAULT_FROM_EMAIL = 'your_email@example.com'
+# Outbound email queue drained by `manage.py send_outbox` (see app.outbox)
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BASE_SECONDS = 30
+OUTBOX_RETRY_MAX_SECONDS = 3600
+OUTBOX_POLL_INTERVAL = 5
+# Background jobs run by `manage.py run_workers` (see app.jobs)
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BASE_SECONDS = 60
+JOB_POLL_INTERVAL = 2
 
 LOGGING = {
     'version': 1,
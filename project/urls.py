@@ -8,8 +8,26 @@ from app.views import (
     PatientCreateView,
     get_physician_info,
     send_patient_info,
+    notify_all_patients,
+    PatientUploadSessionView,
+    UploadSessionDetailView,
+    UploadSessionCommitView,
+    PatientMRISliceView,
+    PatientMRIPyramidView,
+    PatientMRIPyramidDataView,
+    MeshView,
+    PatientSparseLabelMapView,
+    PatientMRIRegionView,
+    PhysicianExportView,
+    PatientBulkView,
+    SearchView,
+    TokenRevokeView,
+    ThrottledTokenObtainPairView,
+    SecurePatientDetailView,
+    PatientMRIFileView,
 )
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework_simplejwt.views import TokenRefreshView
+from app import async_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -17,9 +35,30 @@ urlpatterns = [
     path('login/', LoginView.as_view(), name='login'),
     path('physician/info/', get_physician_info, name='physician-info'),  # New endpoint to fetch physician info
     path('patients/', PhysicianPatientListView.as_view(), name='physician-patient-list'),
+    path('search/', SearchView.as_view(), name='search'),
+    path('patients/bulk/', PatientBulkView.as_view(), name='patient-bulk'),
+    path('patients/export/', PhysicianExportView.as_view(), name='physician-export'),
     path('patients/create/', PatientCreateView.as_view(), name='patient-create'),  
     path('patients/<int:pk>/', PatientDetailUpdateDeleteView.as_view(), name='patient-detail'),
-    path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('patients/<int:pk>/mri/file/', PatientMRIFileView.as_view(), name='patient-mri-file'),
+    path('patients/<int:pk>/mri/slice/', PatientMRISliceView.as_view(), name='patient-mri-slice'),
+    path('patients/<int:pk>/mri/pyramid/', PatientMRIPyramidView.as_view(), name='patient-mri-pyramid'),
+    path('patients/<int:pk>/mri/pyramid/data/', PatientMRIPyramidDataView.as_view(), name='patient-mri-pyramid-data'),
+    path('patients/<int:pk>/mri/labels/', PatientSparseLabelMapView.as_view(), name='patient-mri-labels'),
+    path('patients/<int:pk>/mri/roi/', PatientMRIRegionView.as_view(), name='patient-mri-roi'),
+    path('patients/<int:pk>/mri/uploads/', PatientUploadSessionView.as_view(), name='patient-upload-session'),
+    path('records/<int:pk>/', SecurePatientDetailView.as_view(), name='secure-record'),
+    path('meshes/<str:sha256>/', MeshView.as_view(), name='mesh'),
+    path('uploads/<uuid:pk>/', UploadSessionDetailView.as_view(), name='upload-session-detail'),
+    path('uploads/<uuid:pk>/commit/', UploadSessionCommitView.as_view(), name='upload-session-commit'),
+    path('api/token/', ThrottledTokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/token/revoke/', TokenRevokeView.as_view(), name='token_revoke'),
     path('api/send-patient-info/<int:patient_id>/', send_patient_info, name='send-patient-info'),
+    path('api/send-patient-info/all/', notify_all_patients, name='notify-all-patients'),
+    # Async versions of the I/O-bound endpoints for ASGI deployments (see app.async_views)
+    path('async/login/', async_views.login, name='async-login'),
+    path('async/patients/<int:pk>/', async_views.patient_detail, name='async-patient-detail'),
+    path('async/patients/<int:pk>/mri/', async_views.patient_mri_file, name='async-patient-mri'),
+    path('async/send-patient-info/<int:patient_id>/', async_views.send_patient_info, name='async-send-patient-info'),
 ]
\ No newline at end of file